@@ -3,12 +3,12 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake'
 
-import os
+import os, traceback
 from functools import partial
 try:
-    from qt.core import QToolButton, QMenu
+    from qt.core import QToolButton, QMenu, QTimer
 except ImportError:
-    from PyQt5.Qt import QToolButton, QMenu
+    from PyQt5.Qt import QToolButton, QMenu, QTimer
 
 try:
     load_translations()
@@ -18,10 +18,13 @@ except NameError:
 from calibre.gui2 import question_dialog
 from calibre.gui2.actions import InterfaceAction
 from calibre.gui2.dialogs.message_box import ErrorNotification
-from calibre.ptempfile import PersistentTemporaryDirectory, remove_dir
+from calibre.ptempfile import PersistentTemporaryDirectory, PersistentTemporaryFile, remove_dir
+from calibre.utils.config import config_dir
 
 import calibre_plugins.count_pages.config as cfg
 from calibre_plugins.count_pages.config import ALL_STATISTICS
+from calibre_plugins.count_pages.cache import StatisticsCache
+from calibre_plugins.count_pages.checkpoint import CountRun, get_interrupted_runs
 from calibre_plugins.count_pages.common_icons import set_plugin_icon_resources, get_icon
 from calibre_plugins.count_pages.common_menus import unregister_menu_actions, create_menu_action_unique
 from calibre_plugins.count_pages.common_dialogs import ProgressBarDialog
@@ -29,6 +32,10 @@ from calibre_plugins.count_pages.jobs import call_plugin_callback
 from calibre_plugins.count_pages.dialogs import QueueProgressDialog, TotalStatisticsDialog
 
 
+# Milliseconds between applying the results checkpointed by running jobs
+CHECKPOINT_INTERVAL = 15000
+
+
 class CountPagesAction(InterfaceAction):
 
     name = 'Count Pages'
@@ -47,7 +54,7 @@ class CountPagesAction(InterfaceAction):
         set_plugin_icon_resources(self.name, icon_resources)
 
         self.rebuild_menus()
-        self.nltk_pickle = self._get_nltk_resource()
+        self.nltk_pickle_path = self._get_nltk_resource()
 
         # Assign our menu to this action and an icon
         self.qaction.setMenu(self.menu)
@@ -58,12 +65,23 @@ class CountPagesAction(InterfaceAction):
         # Used to store callback details when called from another plugin.
         self.plugin_callback = None
 
+        # Batch jobs running, whose results are applied to the library as
+        # they are checkpointed rather than only when the job completes
+        self.checkpoint_jobs = set()
+        self.checkpoint_timer = QTimer(self.gui)
+        self.checkpoint_timer.setInterval(CHECKPOINT_INTERVAL)
+        self.checkpoint_timer.timeout.connect(self._apply_checkpointed_results)
+
+    def initialization_complete(self):
+        self._resume_interrupted_runs()
+
     def about_to_show_menu(self):
         self.rebuild_menus()
 
     def library_changed(self, db):
         # We need to reapply keyboard shortcuts after switching libraries
         self.rebuild_menus()
+        self._resume_interrupted_runs()
 
     def location_selected(self, loc):
         self.is_library_selected = loc == 'library'
@@ -121,10 +139,27 @@ class CountPagesAction(InterfaceAction):
     def _get_nltk_resource(self):
         # Retrieve the english pickle file. Can't do it from within the nltk code
         # because of our funky situation of executing a plugin from a zip file.
-        # So we retrieve it here and pass it through when executing jobs.
+        # So we extract it here to a file outside the zip, and pass the path to
+        # it when executing jobs, for each worker to load it only once.
         ENGLISH_PICKLE_FILE = 'nltk_lite/english.pickle'
         pickle_data = self.load_resources([ENGLISH_PICKLE_FILE])[ENGLISH_PICKLE_FILE]
-        return pickle_data
+        pickle_path = os.path.join(config_dir, 'plugins', 'Count Pages', 'english.pickle')
+        try:
+            existing_data = None
+            if os.path.exists(pickle_path):
+                with open(pickle_path, 'rb') as f:
+                    existing_data = f.read()
+            if existing_data != pickle_data:
+                if not os.path.exists(os.path.dirname(pickle_path)):
+                    os.makedirs(os.path.dirname(pickle_path))
+                with open(pickle_path, 'wb') as f:
+                    f.write(pickle_data)
+        except Exception as e:
+            print("Error writing nltk pickle to {0}: {1}".format(pickle_path, e))
+            with PersistentTemporaryFile('_english.pickle') as f:
+                f.write(pickle_data)
+            pickle_path = f.name
+        return pickle_path
 
     def _count_pages_on_selected(self, mode, download_source=None):
         if not self.is_library_selected:
@@ -254,53 +289,108 @@ class CountPagesAction(InterfaceAction):
 
         c = cfg.plugin_prefs[cfg.STORE_NAME]
         batch_size = c.get(cfg.KEY_BATCH_SIZE, cfg.DEFAULT_STORE_VALUES[cfg.KEY_BATCH_SIZE])
-        batches = self._split_jobs([b[0] for b in books_to_scan], batch_size)
+        book_file_access = c.get(cfg.KEY_BOOK_FILE_ACCESS, cfg.DEFAULT_STORE_VALUES[cfg.KEY_BOOK_FILE_ACCESS])
+        readability_samples = c.get(cfg.KEY_READABILITY_SAMPLES, cfg.DEFAULT_STORE_VALUES[cfg.KEY_READABILITY_SAMPLES])
         db = self.gui.current_db
-        
+
+        # Answer any statistics we can from those previously computed for
+        # unchanged format files, only counting the remaining statistics
+        statistics_cache = StatisticsCache(db, pages_algorithm, custom_chars_per_page, icu_wordcount,
+                                           readability_samples)
+        total_books = len(books_to_scan)
+        books_to_scan, cached_stats_map, format_keys_map = statistics_cache.apply(books_to_scan, page_count_mode)
+        scan_ids = set(b[0] for b in books_to_scan)
+        all_cached_stats_map = dict((book_id, stats) for book_id, stats in cached_stats_map.items()
+                                    if book_id not in scan_ids)
+        if all_cached_stats_map:
+            print("All statistics answered from cache for %d books" % len(all_cached_stats_map))
+            self._statistics_available(statistics_cols_map, all_cached_stats_map,
+                                       _('Statistics for %d books were unchanged since last counted') % len(all_cached_stats_map),
+                                       self.plugin_callback)
+        batches = self._split_jobs([b[0] for b in books_to_scan], batch_size)
+
+        # Persist the books to count, so the run can be resumed if interrupted
+        run = None
+        if books_to_scan:
+            settings = {'statistics_cols_map': statistics_cols_map, 'pages_algorithm': pages_algorithm,
+                        'custom_chars_per_page': custom_chars_per_page, 'icu_wordcount': icu_wordcount,
+                        'page_count_mode': page_count_mode, 'download_source': download_source}
+            try:
+                run = CountRun.create(db.library_id, settings, books_to_scan)
+                run.pending_batches = 0
+                run.failed = False
+                run.interrupted = False
+            except:
+                traceback.print_exc()
+
         for i, batch_ids in enumerate(batches):
             batch_tdir = PersistentTemporaryDirectory('_count_pages_batch_{0}'.format(i), prefix='')
             try:
-                # Copy only this batch's books to the batch temp directory
-                batch_books = self._copy_batch_files(books_to_scan, batch_ids, batch_tdir, db)
+                # Prepare only this batch's books for the job
+                batch_books = self._prepare_batch_files(books_to_scan, batch_ids, batch_tdir, db, book_file_access)
                 
                 # Create and queue the job
                 self._create_batch_job(batch_books, batch_tdir, statistics_cols_map, 
                                       pages_algorithm, custom_chars_per_page, icu_wordcount,
-                                      page_count_mode, download_source, i + 1, len(batches))
+                                      page_count_mode, download_source, i + 1, len(batches),
+                                      statistics_cache, format_keys_map, cached_stats_map,
+                                      readability_samples, run)
+                if run:
+                    run.pending_batches += 1
             except Exception as e:
                 print("Error processing batch {0}: {1}".format(i, e))
                 remove_dir(batch_tdir)
+        if run and not run.pending_batches:
+            run.remove()
         
-        self.gui.status_bar.show_message(_('Counting statistics in %d books') % len(books_to_scan))
+        self.gui.status_bar.show_message(_('Counting statistics in %d books') % total_books)
         self.plugin_callback = None
 
-    def _copy_batch_files(self, books_to_scan, batch_ids, batch_tdir, db):
-        '''Copy only this batch's books to the batch temp directory'''
+    def _prepare_batch_files(self, books_to_scan, batch_ids, batch_tdir, db, book_file_access):
+        '''
+        Prepare this batch's books for the job. Depending on the book file access
+        option, the books are copied to the batch temp directory now, or their
+        library paths are passed for each child job to link or copy the book
+        only when it is counted, or to read the library file directly.
+        '''
         batch_books = []
         for book_id, title_author, format_code, download_sources, statistics_to_run in books_to_scan:
             if book_id in batch_ids:
-                # Copy the book file if a format was specified (not download-only)
-                dest_file = None
+                dest_file = source_path = None
+                # Download-only counts have no format to read
                 if format_code:
                     dest_file = os.path.join(batch_tdir, '{0}.{1}'.format(book_id, format_code))
-                    try:
-                        with open(dest_file, 'w+b') as f:
-                            db.copy_format_to(book_id, format_code.upper(), f, index_is_id=True)
-                    except Exception as e:
-                        print("Error copying format {0} for book {1}: {2}".format(format_code, book_id, e))
-                        continue
-                batch_books.append((book_id, title_author, dest_file, download_sources, statistics_to_run))
+                    if book_file_access != 'Copy':
+                        try:
+                            source_path = db.format_abspath(book_id, format_code.upper(), index_is_id=True)
+                        except Exception as e:
+                            print("Error finding format {0} for book {1}: {2}".format(format_code, book_id, e))
+                    if source_path:
+                        if book_file_access == 'Library':
+                            dest_file = None
+                    else:
+                        try:
+                            with open(dest_file, 'w+b') as f:
+                                db.copy_format_to(book_id, format_code.upper(), f, index_is_id=True)
+                        except Exception as e:
+                            print("Error copying format {0} for book {1}: {2}".format(format_code, book_id, e))
+                            continue
+                batch_books.append((book_id, title_author, dest_file, download_sources, statistics_to_run, source_path))
         return batch_books
 
     def _create_batch_job(self, batch_books, batch_tdir, statistics_cols_map, 
                          pages_algorithm, custom_chars_per_page, icu_wordcount,
-                         page_count_mode, download_source, batch_num, total_batches):
+                         page_count_mode, download_source, batch_num, total_batches,
+                         statistics_cache, format_keys_map, cached_stats_map,
+                         readability_samples, run):
         '''Create and queue a batch job with the appropriate parameters'''
         func = 'arbitrary_n'
         cpus = self.gui.job_manager.server.pool_size
+        checkpoint_path = run.get_batch_path(batch_num) if run else None
         args = ['calibre_plugins.count_pages.jobs', 'do_count_statistics',
-                (batch_books, pages_algorithm, self.nltk_pickle, custom_chars_per_page,
-                icu_wordcount, page_count_mode, download_source, cpus)]
+                (batch_books, pages_algorithm, self.nltk_pickle_path, custom_chars_per_page,
+                icu_wordcount, page_count_mode, download_source, cpus,
+                readability_samples, checkpoint_path)]
         
         desc = _('Count Page/Word Statistics') + (' (%d of %d)' % (batch_num, total_batches))
         job = self.gui.job_manager.run_job(
@@ -313,6 +403,18 @@ class CountPagesAction(InterfaceAction):
         job.page_count_mode = page_count_mode
         job.download_source = download_source
         job.plugin_callback = self.plugin_callback
+        job.statistics_cache = statistics_cache
+        job.format_keys_map = dict((b[0], format_keys_map[b[0]]) for b in batch_books if b[0] in format_keys_map)
+        job.cached_stats_map = dict((b[0], cached_stats_map[b[0]]) for b in batch_books if b[0] in cached_stats_map)
+        job.run = run
+        job.library_id = self.gui.current_db.library_id
+        job.checkpoint_path = checkpoint_path
+        job.checkpoint_offset = 0
+        job.applied_ids = set()
+        if run:
+            self.checkpoint_jobs.add(job)
+            if not self.checkpoint_timer.isActive():
+                self.checkpoint_timer.start()
 
     def _split_jobs(self, ids, batch_size):
         ans = []
@@ -327,44 +429,171 @@ class CountPagesAction(InterfaceAction):
         # Clean up the batch temp directory
         if job.tdir:
             remove_dir(job.tdir)
-        
+        self.checkpoint_jobs.discard(job)
+        if not self.checkpoint_jobs:
+            self.checkpoint_timer.stop()
+
+        if job.library_id != self.gui.current_db.library_id:
+            # The user has switched libraries while the job was running, so the
+            # book ids are not for this library. The results of a run are left
+            # in its checkpoint to be resumed when that library is next opened.
+            print("Ignoring statistics counted for another library")
+            if job.run:
+                job.run.interrupted = True
+                self._batch_finished(job)
+            if job.failed:
+                return self.gui.job_exception(job, dialog_title=_('Failed to count statistics'))
+            return
         if job.failed:
+            # Keep the statistics of any books counted before the job failed,
+            # leaving the remaining books of the run to be resumed
+            if job.run:
+                job.run.failed = True
+                book_statistics_map = self._read_checkpointed_results(job)
+                if book_statistics_map:
+                    self._statistics_available(job.statistics_cols_map, book_statistics_map,
+                                               job.details, None, job.run)
+                self._batch_finished(job)
             return self.gui.job_exception(job, dialog_title=_('Failed to count statistics'))
         self.gui.status_bar.show_message(_('Counting statistics batch completed'), 3000)
-        book_statistics_map = job.result
-
+        book_statistics_map, text_analysis_map = job.result
+        unapplied_statistics_map = dict((book_id, stats) for book_id, stats in book_statistics_map.items()
+                                        if book_id not in job.applied_ids)
+        job.statistics_cache.store(unapplied_statistics_map, text_analysis_map,
+                                   job.format_keys_map, job.page_count_mode)
+        for book_id, cached_stats in job.cached_stats_map.items():
+            book_statistics_map.setdefault(book_id, {}).update(cached_stats)
+        self._statistics_available(job.statistics_cols_map, book_statistics_map,
+                                   job.details, job.plugin_callback, job.run, job.applied_ids)
+        self._batch_finished(job)
+
+    def _read_checkpointed_results(self, job):
+        '''
+        Return the statistics of the books the job has counted since we last
+        read its checkpoint, storing them in the statistics cache
+        '''
+        book_statistics_map, text_analysis_map, job.checkpoint_offset = \
+            job.run.read_batch_results(job.checkpoint_path, job.checkpoint_offset)
+        job.statistics_cache.store(book_statistics_map, text_analysis_map,
+                                   job.format_keys_map, job.page_count_mode)
+        for book_id in book_statistics_map:
+            if book_id in job.cached_stats_map:
+                book_statistics_map[book_id].update(job.cached_stats_map[book_id])
+        return book_statistics_map
+
+    def _apply_checkpointed_results(self):
+        '''
+        Periodically write the statistics checkpointed by the running jobs to
+        the library, so a long run is not lost if calibre is closed. When asking
+        for confirmation the results are instead all offered when each job completes.
+        '''
+        if cfg.plugin_prefs[cfg.STORE_NAME].get(cfg.KEY_ASK_FOR_CONFIRMATION,
+                                                cfg.DEFAULT_STORE_VALUES[cfg.KEY_ASK_FOR_CONFIRMATION]):
+            return
+        library_id = self.gui.current_db.library_id
+        for job in list(self.checkpoint_jobs):
+            if job.library_id != library_id:
+                continue
+            book_statistics_map = self._read_checkpointed_results(job)
+            if book_statistics_map:
+                print("Applying checkpointed statistics for %d books" % len(book_statistics_map))
+                self._update_database_columns((job.statistics_cols_map, book_statistics_map, job.run, library_id),
+                                              show_progress=False)
+                job.applied_ids.update(book_statistics_map.keys())
+
+    def _batch_finished(self, job):
+        run = job.run
+        if run:
+            run.pending_batches -= 1
+            if not run.pending_batches:
+                if run.interrupted:
+                    run.release()
+                elif not run.failed:
+                    run.remove()
+
+    def _resume_interrupted_runs(self):
+        '''
+        Offer to resume counting the books of runs for this library which were
+        interrupted by calibre closing, applying any statistics already counted
+        '''
+        db = self.gui.current_db
+        if db is None:
+            return
+        resumable_runs = []
+        total_books = 0
+        for run in get_interrupted_runs(db.library_id):
+            try:
+                remaining_books = run.get_remaining_books()
+                book_statistics_map = run.get_unapplied_results()[0]
+                settings = run.get_settings()
+            except:
+                traceback.print_exc()
+                run.remove()
+                continue
+            if not remaining_books and not book_statistics_map:
+                run.remove()
+                continue
+            resumable_runs.append((run, settings, remaining_books, book_statistics_map))
+            total_books += len(remaining_books) + len(book_statistics_map)
+        if not resumable_runs:
+            return
+        if not question_dialog(self.gui, _('Resume counting statistics'), '<p>' +
+                    _('Counting statistics did not complete for <b>%d book(s)</b> '
+                      'the last time this library was open.') % total_books + '<p>' +
+                    _('Do you want to resume counting them?'),
+                    show_copy_button=False):
+            for run, settings, remaining_books, book_statistics_map in resumable_runs:
+                run.remove()
+            return
+        for run, settings, remaining_books, book_statistics_map in resumable_runs:
+            if book_statistics_map:
+                self._statistics_available(settings['statistics_cols_map'], book_statistics_map,
+                                           _('Statistics counted before counting was interrupted'), None)
+            self._queue_job(remaining_books, **settings)
+            run.remove()
+
+    def _statistics_available(self, statistics_cols_map, book_statistics_map, details, plugin_callback,
+                              run=None, applied_ids=()):
+        # Books whose statistics were already applied from a checkpoint
+        # are still included in the results for any plugin callback
+        unapplied_statistics_map = dict((book_id, stats) for book_id, stats in book_statistics_map.items()
+                                        if book_id not in applied_ids)
         if len(book_statistics_map) == 0:
             # Must have been some sort of error in processing this book
             msg = _('Failed to generate any statistics. <b>View Log</b> for details')
-            p = ErrorNotification(job.details, _('Count log'), _('Count Pages failed'), msg,
+            p = ErrorNotification(details, _('Count log'), _('Count Pages failed'), msg,
                     show_copy_button=False, parent=self.gui)
             p.show()
-        else:            
-            payload = (job.statistics_cols_map, book_statistics_map)
+        elif unapplied_statistics_map:
+            payload = (statistics_cols_map, unapplied_statistics_map, run, self.gui.current_db.library_id)
             
             if cfg.plugin_prefs[cfg.STORE_NAME].get(cfg.KEY_ASK_FOR_CONFIRMATION, 
                                                     cfg.DEFAULT_STORE_VALUES[cfg.KEY_ASK_FOR_CONFIRMATION]):
-                all_ids = set(book_statistics_map.keys())
+                all_ids = set(unapplied_statistics_map.keys())
                 msg = _('<p>Count Pages plugin found <b>%d statistics(s)</b>. ') % len(all_ids) + \
                       _('Proceed with updating columns in your library?')
                 self.gui.proceed_question(self._update_database_columns,
-                        payload, job.details,
+                        payload, details,
                         _('Count log'), _('Count complete'), msg,
                         show_copy_button=False)
             else:
                 self._update_database_columns(payload)
 
-        if job.plugin_callback:
-            print("_get_statistics_completed: have callback:", job.plugin_callback)
-            call_plugin_callback(job.plugin_callback, self.gui, plugin_results=book_statistics_map)
+        if plugin_callback:
+            print("_get_statistics_completed: have callback:", plugin_callback)
+            call_plugin_callback(plugin_callback, self.gui, plugin_results=book_statistics_map)
 
-    def _update_database_columns(self, payload):
-        (statistics_cols_map, book_statistics_map) = payload
+    def _update_database_columns(self, payload, show_progress=True):
+        (statistics_cols_map, book_statistics_map, run, library_id) = payload
+        if library_id != self.gui.current_db.library_id:
+            # The library was switched while awaiting confirmation
+            print("Not updating statistics counted for another library")
+            return
  
         total_books = len(book_statistics_map)
         # It is possible the progress dialog is currently visible from another thread running another batch
         # So we won't display for this batch if that is the case
-        was_progress_visible = hasattr(self, 'pb') and self.pb and self.pb.isVisible()
+        was_progress_visible = not show_progress or (hasattr(self, 'pb') and self.pb and self.pb.isVisible())
         if not was_progress_visible:
             self.progressbar(_('Updating statistics'), on_top=True)
             self.show_progressbar(total_books)
@@ -392,8 +621,10 @@ class CountPagesAction(InterfaceAction):
             else:
                 print("Book with id %d is no longer in the library." % book_id)
 
-        for col_name, book_statistics_map in col_name_books_map.items():
-            db_ref.set_field(col_name, book_statistics_map)
+        for col_name, col_book_statistics_map in col_name_books_map.items():
+            db_ref.set_field(col_name, col_book_statistics_map)
+        if run:
+            run.mark_applied(book_statistics_map.keys())
 
         if book_ids_to_update:
             print("About to refresh GUI - book_ids_to_update=", book_ids_to_update)
@@ -401,7 +632,8 @@ class CountPagesAction(InterfaceAction):
             self.gui.library_view.model().refresh_ids(book_ids_to_update,
                                       current_row=self.gui.library_view.currentIndex().row())
 
-        self.hide_progressbar()
+        if not was_progress_visible:
+            self.hide_progressbar()
 
     def _do_show_totals(self, book_ids, statistics_cols_map):
         totals = {}
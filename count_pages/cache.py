@@ -0,0 +1,159 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import calibre_plugins.count_pages.config as cfg
+from calibre_plugins.count_pages.statistics import (get_gunning_fog_index,
+                                    get_flesch_reading_ease, get_flesch_kincaid_grade_level,
+                                    EPUB_EXTENSIONS)
+
+# Name of the custom book data storing the statistics computed for each book
+CACHE_NAME = 'count_pages_cache'
+# Key in the results of a job for the text analysis aggregates of a book,
+# which are cached so all the readability statistics can be answered from them
+RESULT_TEXT_ANALYSIS = 'TextAnalysis'
+
+READABILITY_STATISTICS = [cfg.STATISTIC_FLESCH_READING, cfg.STATISTIC_FLESCH_GRADE,
+                          cfg.STATISTIC_GUNNING_FOG]
+TEXT_ANALYSIS_KEYS = ['wordCount', 'syllableCount', 'complexwordCount',
+                      'sentenceCount', 'averageWordsPerSentence']
+
+
+class StatisticsCache(object):
+    '''
+    Statistics computed for the format file of each book are stored as custom
+    book data, keyed by the settings they were computed with. When the format
+    file is unchanged (same size and modification time) a repeat count of the
+    book is answered from the cache, without copying or converting it.
+    '''
+    def __init__(self, db, pages_algorithm, custom_chars_per_page, icu_wordcount, readability_samples=0):
+        self.db = db
+        self.stat_keys = {
+            cfg.STATISTIC_PAGE_COUNT: 'PageCount:%d' % pages_algorithm,
+            cfg.STATISTIC_WORD_COUNT: 'WordCount:icu' if icu_wordcount else 'WordCount',
+            RESULT_TEXT_ANALYSIS: RESULT_TEXT_ANALYSIS
+            }
+        if readability_samples:
+            self.stat_keys[RESULT_TEXT_ANALYSIS] += ':samples%d' % readability_samples
+        if pages_algorithm == 3:
+            self.stat_keys[cfg.STATISTIC_PAGE_COUNT] += ':%d' % custom_chars_per_page
+        self._cache_map = None
+
+    def get_stat_key(self, statistic, format_key):
+        '''
+        Return the key this statistic is cached under for the format file of
+        this format key. ePub formats are read directly from the zip rather
+        than with the input plugin, so have keys of their own.
+        '''
+        stat_key = self.stat_keys[statistic]
+        if '.' + format_key[0] in EPUB_EXTENSIONS:
+            stat_key += ':zip'
+        return stat_key
+
+    def get_format_key(self, book_id, format_code):
+        '''
+        Return the (format, size, mtime) identifying the current content of
+        this format file, or None if it cannot be determined.
+        '''
+        try:
+            stat_metadata = self.db.format_metadata(book_id, format_code.upper())
+        except:
+            return None
+        if not stat_metadata or 'mtime' not in stat_metadata:
+            return None
+        return (format_code.lower(), stat_metadata['size'], stat_metadata['mtime'].isoformat())
+
+    def get_cached_statistics(self, book_id, format_key, statistics_to_run):
+        '''
+        Return a dictionary of those statistics to run which are cached for
+        this format of the book.
+        '''
+        if self._cache_map is None:
+            self._cache_map = self.db.get_all_custom_book_data(CACHE_NAME, default={})
+        book_data = self._cache_map.get(book_id, None)
+        if not book_data or format_key is None or tuple(book_data.get('format', ())) != format_key:
+            return {}
+        cached_stats = book_data.get('stats', {})
+        results = {}
+        for statistic in statistics_to_run:
+            if statistic in READABILITY_STATISTICS:
+                text_analysis = cached_stats.get(self.get_stat_key(RESULT_TEXT_ANALYSIS, format_key), None)
+                if text_analysis:
+                    results[statistic] = get_readability_statistic(statistic, text_analysis)
+            else:
+                value = cached_stats.get(self.get_stat_key(statistic, format_key), None)
+                if value:
+                    results[statistic] = value
+        return results
+
+    def apply(self, books_to_scan, page_count_mode):
+        '''
+        Given the books to scan, return a tuple of the books which still need
+        counting (with any cached statistics removed from those to run), the
+        statistics answered from the cache for each book id, and the format key
+        of each book to count so its results can be cached when complete.
+        '''
+        remaining_books = []
+        cached_stats_map = {}
+        format_keys_map = {}
+        for book_id, title_author, format_code, download_sources, statistics_to_run in books_to_scan:
+            if not format_code:
+                remaining_books.append((book_id, title_author, format_code, download_sources, statistics_to_run))
+                continue
+            format_key = self.get_format_key(book_id, format_code)
+            cacheable_stats = [s for s in statistics_to_run
+                               if not (s == cfg.STATISTIC_PAGE_COUNT and page_count_mode == 'Download')]
+            cached_stats = self.get_cached_statistics(book_id, format_key, cacheable_stats)
+            if cached_stats:
+                cached_stats_map[book_id] = cached_stats
+            statistics_to_run = [s for s in statistics_to_run if s not in cached_stats]
+            if statistics_to_run:
+                if format_key is not None:
+                    format_keys_map[book_id] = format_key
+                remaining_books.append((book_id, title_author, format_code, download_sources, statistics_to_run))
+        return remaining_books, cached_stats_map, format_keys_map
+
+    def store(self, book_stats_map, text_analysis_map, format_keys_map, page_count_mode):
+        '''
+        Store the statistics counted for each book against its format key
+        '''
+        if self._cache_map is None:
+            self._cache_map = self.db.get_all_custom_book_data(CACHE_NAME, default={})
+        result_cache_map = {}
+        for book_id, format_key in format_keys_map.items():
+            results = dict(book_stats_map.get(book_id, {}))
+            if page_count_mode == 'Download':
+                results.pop(cfg.STATISTIC_PAGE_COUNT, None)
+            text_analysis = text_analysis_map.get(book_id, None)
+            if not results and not text_analysis:
+                continue
+            book_data = self._cache_map.get(book_id, None)
+            if not book_data or tuple(book_data.get('format', ())) != format_key:
+                book_data = {'format': list(format_key), 'stats': {}}
+            for statistic, value in results.items():
+                if statistic in self.stat_keys and value:
+                    book_data['stats'][self.get_stat_key(statistic, format_key)] = value
+            if text_analysis:
+                book_data['stats'][self.get_stat_key(RESULT_TEXT_ANALYSIS, format_key)] = text_analysis
+            self._cache_map[book_id] = result_cache_map[book_id] = book_data
+        if result_cache_map:
+            self.db.add_multiple_custom_book_data(CACHE_NAME, result_cache_map)
+
+
+def get_cacheable_text_analysis(text_analysis, lang):
+    '''
+    Return the subset of the text analysis needed to compute the readability
+    statistics, along with the language used
+    '''
+    result = dict((k, text_analysis[k]) for k in TEXT_ANALYSIS_KEYS if k in text_analysis)
+    result['lang'] = lang
+    return result
+
+
+def get_readability_statistic(statistic, text_analysis):
+    if statistic == cfg.STATISTIC_FLESCH_READING:
+        return get_flesch_reading_ease(text_analysis, text_analysis.get('lang', None))
+    if statistic == cfg.STATISTIC_FLESCH_GRADE:
+        return get_flesch_kincaid_grade_level(text_analysis)
+    return get_gunning_fog_index(text_analysis)
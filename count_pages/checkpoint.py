@@ -0,0 +1,168 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import json, os, shutil, traceback, uuid
+
+from calibre.utils.config import config_dir
+from calibre.utils.filenames import atomic_rename
+
+RUNS_DIR = os.path.join(config_dir, 'plugins', 'Count Pages', 'runs')
+RUN_FILE_NAME = 'run.json'
+APPLIED_FILE_NAME = 'applied.json'
+BATCH_FILE_NAME = 'batch_%d.jsonl'
+
+# Run directories created in this calibre session, so still being counted
+_active_run_dirs = set()
+
+
+class CountRun(object):
+    '''
+    A run of counting statistics for a set of books, persisted to a folder
+    so that if calibre is closed or a job fails part way through, the run can
+    be resumed with only the books not yet counted.
+
+    The folder holds the settings and books to scan of the run, a results
+    file for each batch job which the job appends a line to as each book is
+    counted, and the ids of the books whose results have been applied.
+    '''
+    def __init__(self, run_dir):
+        self.run_dir = run_dir
+        self._applied_ids = None
+
+    @classmethod
+    def create(cls, library_id, settings, books_to_scan):
+        run_dir = os.path.join(RUNS_DIR, library_id, uuid.uuid4().hex)
+        os.makedirs(run_dir)
+        _active_run_dirs.add(run_dir)
+        run = cls(run_dir)
+        run._write_json(RUN_FILE_NAME, {'settings': settings, 'books': books_to_scan})
+        return run
+
+    def get_settings(self):
+        return self._read_json(RUN_FILE_NAME)['settings']
+
+    def get_batch_path(self, batch_num):
+        return os.path.join(self.run_dir, BATCH_FILE_NAME % batch_num)
+
+    def read_batch_results(self, batch_path, offset=0):
+        '''
+        Read the results appended to this batch file since the offset,
+        returning the maps of statistics and text analysis for each book id
+        and the offset to read the next results from. A partly written last
+        line is left to be read next time.
+        '''
+        book_stats_map = {}
+        text_analysis_map = {}
+        if not os.path.exists(batch_path):
+            return book_stats_map, text_analysis_map, offset
+        with open(batch_path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                try:
+                    book_id, results, text_analysis = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                book_stats_map[book_id] = results
+                if text_analysis:
+                    text_analysis_map[book_id] = text_analysis
+        return book_stats_map, text_analysis_map, offset
+
+    def get_applied_ids(self):
+        if self._applied_ids is None:
+            self._applied_ids = set(self._read_json(APPLIED_FILE_NAME, default=[]))
+        return self._applied_ids
+
+    def mark_applied(self, book_ids):
+        applied_ids = self.get_applied_ids()
+        applied_ids.update(book_ids)
+        # The run may have completed while its results awaited confirmation
+        if os.path.isdir(self.run_dir):
+            self._write_json(APPLIED_FILE_NAME, sorted(applied_ids))
+
+    def get_unapplied_results(self):
+        '''
+        Return the maps of statistics and text analysis counted by the jobs of
+        this run which were never applied to the library
+        '''
+        book_stats_map = {}
+        text_analysis_map = {}
+        applied_ids = self.get_applied_ids()
+        for name in os.listdir(self.run_dir):
+            if name.endswith('.jsonl'):
+                stats_map, analysis_map, _offset = self.read_batch_results(os.path.join(self.run_dir, name))
+                book_stats_map.update(stats_map)
+                text_analysis_map.update(analysis_map)
+        for book_id in applied_ids:
+            book_stats_map.pop(book_id, None)
+            text_analysis_map.pop(book_id, None)
+        return book_stats_map, text_analysis_map
+
+    def get_remaining_books(self):
+        '''
+        Return the books to scan of this run which have not been counted
+        '''
+        counted_ids = set(self.get_applied_ids())
+        counted_ids.update(self.get_unapplied_results()[0].keys())
+        return [book for book in self._read_json(RUN_FILE_NAME)['books'] if book[0] not in counted_ids]
+
+    def release(self):
+        '''
+        No longer treat the run as being counted in this session, so that its
+        remaining books are offered to resume when its library is next opened
+        '''
+        _active_run_dirs.discard(self.run_dir)
+
+    def remove(self):
+        _active_run_dirs.discard(self.run_dir)
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+
+    def _read_json(self, name, default=None):
+        try:
+            with open(os.path.join(self.run_dir, name), 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            if default is None:
+                raise
+            return default
+
+    def _write_json(self, name, data):
+        path = os.path.join(self.run_dir, name)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(json.dumps(data).encode('utf-8'))
+        atomic_rename(path + '.tmp', path)
+
+
+def get_interrupted_runs(library_id):
+    '''
+    Return the runs for this library from a previous calibre session which
+    were never completed
+    '''
+    library_runs_dir = os.path.join(RUNS_DIR, library_id)
+    if not os.path.isdir(library_runs_dir):
+        return []
+    runs = []
+    for name in sorted(os.listdir(library_runs_dir)):
+        run_dir = os.path.join(library_runs_dir, name)
+        if run_dir in _active_run_dirs:
+            continue
+        if not os.path.exists(os.path.join(run_dir, RUN_FILE_NAME)):
+            shutil.rmtree(run_dir, ignore_errors=True)
+            continue
+        runs.append(CountRun(run_dir))
+    return runs
+
+
+def append_batch_result(f, book_id, results, text_analysis):
+    '''
+    Append the results counted for a book to the open batch file of a run
+    '''
+    try:
+        f.write(json.dumps([book_id, results, text_analysis]) + '\n')
+        f.flush()
+    except:
+        traceback.print_exc()
@@ -52,6 +52,8 @@ KEY_DOWNLOAD_SOURCES = 'downloadSources'
 KEY_SHOW_TRY_ALL_SOURCES = 'showTryAllSources'
 KEY_USE_ICU_WORDCOUNT = 'useIcuWordcount'
 KEY_BATCH_SIZE = 'batchSize'
+KEY_BOOK_FILE_ACCESS = 'bookFileAccess'
+KEY_READABILITY_SAMPLES = 'readabilitySamples'
 
 STORE_NAME = 'Options'
 KEY_PAGES_ALGORITHM = 'algorithmPages'
@@ -137,6 +139,11 @@ BUTTON_DEFAULTS = {
                    'Estimate':  _('Estimate page/word counts'),
                    'Download':  DOWNLOAD_SOURCE_OPTION_STRING + _(' - all sources'),
                   }
+BOOK_FILE_ACCESS = {
+                    'Link':    _('Link or copy each book when counted'),
+                    'Library': _('Read books directly from the library'),
+                    'Copy':    _('Copy all books before counting'),
+                   }
 
 STATISTIC_PAGE_COUNT = 'PageCount'
 STATISTIC_WORD_COUNT = 'WordCount'
@@ -169,7 +176,9 @@ DEFAULT_STORE_VALUES = {
                         KEY_CHECK_ALL_SOURCES: True,
                         KEY_SHOW_TRY_ALL_SOURCES: True,
                         KEY_DOWNLOAD_SOURCES: DOWNLOAD_SOURCES_DEFAULTS,
-                        KEY_BATCH_SIZE: 50
+                        KEY_BATCH_SIZE: 50,
+                        KEY_BOOK_FILE_ACCESS: 'Link',
+                        KEY_READABILITY_SAMPLES: 0
                         }
 DEFAULT_LIBRARY_VALUES = {
                           KEY_PAGES_ALGORITHM: 0,
@@ -298,10 +307,15 @@ class ConfigWidget(QWidget):
         new_prefs[KEY_DOWNLOAD_SOURCES] = self.get_source_list()
         new_prefs[KEY_ASK_FOR_CONFIRMATION] = self.other_tab.ask_for_confirmation_checkbox.isChecked()
         new_prefs[KEY_USE_ICU_WORDCOUNT] = self.statistics_tab.icu_wordcount_checkbox.isChecked()
+        readability_samples = unicode(self.statistics_tab.readability_samples_ledit.text()).strip()
+        if not readability_samples:
+            readability_samples = '0'
+        new_prefs[KEY_READABILITY_SAMPLES] = int(readability_samples)
         batch_size = unicode(self.other_tab.batch_size_ledit.text()).strip()
         if not batch_size:
             batch_size = '50'
         new_prefs[KEY_BATCH_SIZE] = int(batch_size)
+        new_prefs[KEY_BOOK_FILE_ACCESS] = self.other_tab.book_file_access_combo.selected_key()
         plugin_prefs[STORE_NAME] = new_prefs
 
         db = self.plugin_action.gui.current_db
@@ -366,6 +380,7 @@ class OtherTab(QWidget):
                     download_sources.append(default_download_source)
         show_try_all_sources = c.get(KEY_SHOW_TRY_ALL_SOURCES, DEFAULT_STORE_VALUES[KEY_SHOW_TRY_ALL_SOURCES])
         batch_size = c.get(KEY_BATCH_SIZE, DEFAULT_STORE_VALUES[KEY_BATCH_SIZE])
+        book_file_access = c.get(KEY_BOOK_FILE_ACCESS, DEFAULT_STORE_VALUES[KEY_BOOK_FILE_ACCESS])
 
         # Fudge the button default to cater for the options no longer supported by plugin as of 1.5
         if button_default in ['Estimate', 'EstimatePage', 'EstimateWord']:
@@ -450,6 +465,20 @@ class OtherTab(QWidget):
         other_group_box_layout.addWidget(self.batch_size_label, 1, 0, 1, 1)
         other_group_box_layout.addWidget(self.batch_size_ledit, 1, 1, 1, 2)
 
+        book_file_access_label = QLabel(_('Book &files:'), self)
+        toolTip = _('Choose how the book files are made available to the jobs counting statistics:\n'
+                    '- Link or copy each book when counted: hard link (or clone) the book file where\n'
+                    '  the filesystem allows it, otherwise copy it, as each book is counted.\n'
+                    '- Read books directly from the library: count from the library files read only,\n'
+                    '  without any copies.\n'
+                    '- Copy all books before counting: copy every book in a batch before it is queued.')
+        book_file_access_label.setToolTip(toolTip)
+        self.book_file_access_combo = KeyValueComboBox(self, BOOK_FILE_ACCESS, book_file_access)
+        self.book_file_access_combo.setToolTip(toolTip)
+        book_file_access_label.setBuddy(self.book_file_access_combo)
+        other_group_box_layout.addWidget(book_file_access_label, 6, 0, 1, 1)
+        other_group_box_layout.addWidget(self.book_file_access_combo, 6, 1, 1, 2)
+
         self.overwrite_checkbox = QCheckBox(_('Always overwrite an existing word/page count'), self)
         self.overwrite_checkbox.setToolTip(_('Uncheck this option if you have manually populated values in\n'
                                              'either of your page/word custom columns, and never want the\n'
@@ -634,6 +663,7 @@ class StatisticsTab(QWidget):
         pages_algorithm = library_config.get(KEY_PAGES_ALGORITHM, DEFAULT_LIBRARY_VALUES[KEY_PAGES_ALGORITHM])
         custom_chars_per_page = library_config.get(KEY_CUSTOM_CHARS_PER_PAGE, DEFAULT_LIBRARY_VALUES[KEY_CUSTOM_CHARS_PER_PAGE])
         icu_wordcount = c.get(KEY_USE_ICU_WORDCOUNT, DEFAULT_STORE_VALUES[KEY_USE_ICU_WORDCOUNT])
+        readability_samples = c.get(KEY_READABILITY_SAMPLES, DEFAULT_STORE_VALUES[KEY_READABILITY_SAMPLES])
 
         # --- Pages ---
         page_group_box = QGroupBox(_('Page count options:'), self)
@@ -737,6 +767,18 @@ class StatisticsTab(QWidget):
         gunning_fog_column_label.setBuddy(self.gunning_fog_column_combo)
         readability_layout.addWidget(gunning_fog_column_label, 3, 0, 1, 1)
         readability_layout.addWidget(self.gunning_fog_column_combo, 3, 1, 1, 2)
+
+        readability_samples_label = QLabel(_('&Samples:'), self)
+        toolTip = _('Specify a number of samples to compute the readability statistics from that many\n'
+                    'evenly spaced extracts of the text, rather than analysing the whole book.\n'
+                    'The confidence of the statistics is shown in the job details.\n'
+                    'Leave this as 0 to analyse the whole book.')
+        readability_samples_label.setToolTip(toolTip)
+        self.readability_samples_ledit = QLineEdit(str(readability_samples), self)
+        self.readability_samples_ledit.setToolTip(toolTip)
+        readability_samples_label.setBuddy(self.readability_samples_ledit)
+        readability_layout.addWidget(readability_samples_label, 4, 0, 1, 1)
+        readability_layout.addWidget(self.readability_samples_ledit, 4, 1, 1, 2)
         
         layout.addStretch(1)
         self._page_algorithm_changed()
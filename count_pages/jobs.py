@@ -3,7 +3,7 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 __license__ = 'GPL v3'
 __copyright__ = '2011, Grant Drake'
 
-import os, traceback, time
+import os, shutil, traceback, time
 
 from calibre.customize.ui import quick_metadata
 from calibre.ebooks import DRMError
@@ -12,11 +12,17 @@ from calibre.utils.ipc.server import Server
 from calibre.utils.ipc.job import ParallelJob
 
 import calibre_plugins.count_pages.config as cfg
+from calibre_plugins.count_pages.cache import RESULT_TEXT_ANALYSIS, get_cacheable_text_analysis
+from calibre_plugins.count_pages.checkpoint import append_batch_result
 from calibre_plugins.count_pages.download import DownloadPagesWorker
 from calibre_plugins.count_pages.statistics import (get_page_count, get_pdf_page_count,
                                     get_word_count, get_text_analysis, get_gunning_fog_index,
                                     get_flesch_reading_ease, get_flesch_kincaid_grade_level,
-                                    get_cbr_page_count, get_cbz_page_count)
+                                    get_cbr_page_count, get_cbz_page_count,
+                                    print_readability_confidence)
+
+# Most books counted by each child job, so results are still checkpointed often
+MAX_BOOKS_PER_JOB = 10
 
 
 def call_plugin_callback(plugin_callback, parent, plugin_results=None):
@@ -58,32 +64,44 @@ def call_plugin_callback(plugin_callback, parent, plugin_results=None):
         print("call_plugin_callback: about to call callback - kwargs=", kwargs)
         callback_func(*args, **kwargs)
 
+def get_books_per_job(book_count, cpus):
+    '''
+    Return how many books each child job counts. Calibre starts a worker
+    process for each job, so giving each job several books means the Punkt
+    tokenizer and syllable counts loaded by a worker are reused across them,
+    while still sharing the books among the pool and checkpointing often.
+    '''
+    return max(1, min(MAX_BOOKS_PER_JOB, book_count // max(1, cpus * 2)))
+
+
 def do_count_statistics(books_to_scan, pages_algorithm,
-                        nltk_pickle, custom_chars_per_page, icu_wordcount,
-                        page_count_mode, download_sources, cpus, notification=lambda x, y:x):
+                        nltk_pickle_path, custom_chars_per_page, icu_wordcount,
+                        page_count_mode, download_sources, cpus, readability_samples=0,
+                        checkpoint_path=None, notification=lambda x, y:x):
     '''
     Master job, to launch child jobs to count pages in this list of books
+
+    If a checkpoint path is given, the results of each book are appended to
+    it as each child job completes, so they are not lost if the job does not complete.
     '''
     server = Server(pool_size=cpus)
 
-    # Queue all the jobs
-    for book_id, title, book_path, download_sources, statistics_to_run in books_to_scan:
-        args = ['calibre_plugins.count_pages.jobs', 'do_statistics_for_book',
-                (book_path, pages_algorithm, page_count_mode, download_sources, 
-                 statistics_to_run, nltk_pickle, custom_chars_per_page, icu_wordcount)]
-#         print("do_count_statistics - args=", args)
-        print("do_count_statistics - book_path=%s, pages_algorithm=%s, page_count_mode=%s, statistics_to_run=%s, custom_chars_per_page=%s, icu_wordcount=%s"
-              % (book_path, pages_algorithm, page_count_mode, 
-                 statistics_to_run, custom_chars_per_page, icu_wordcount))
-        job = ParallelJob('arbitrary', str(book_id), done=None, args=args)
-        job._book_id = book_id
-        job._title = title
-        job._pages_algorithm = pages_algorithm
-        job._download_sources = download_sources
-        job._page_count_mode = page_count_mode
-        job._statistics_to_run = statistics_to_run
+    # Queue all the jobs, each counting several books in a worker process
+    books_per_job = get_books_per_job(len(books_to_scan), cpus)
+    for i in range(0, len(books_to_scan), books_per_job):
+        job_books = books_to_scan[i:i + books_per_job]
+        args = ['calibre_plugins.count_pages.jobs', 'do_statistics_for_books',
+                ([(book_id, book_path, download_sources, statistics_to_run, source_path)
+                  for book_id, title, book_path, download_sources, statistics_to_run, source_path in job_books],
+                 pages_algorithm, page_count_mode, nltk_pickle_path, custom_chars_per_page, icu_wordcount,
+                 readability_samples)]
+        print("do_count_statistics - pages_algorithm=%s, page_count_mode=%s, custom_chars_per_page=%s, icu_wordcount=%s"
+              % (pages_algorithm, page_count_mode, custom_chars_per_page, icu_wordcount))
+        job_book_ids = ','.join(str(book[0]) for book in job_books)
+        job = ParallelJob('arbitrary', job_book_ids, done=None, args=args)
+        job._books = job_books
         server.add_job(job)
-        print("do_count_statistics - job started for file book_path=%s" % book_path)
+        print("do_count_statistics - job started for book ids %s" % job_book_ids)
 
     # This server is an arbitrary_n job, so there is a notifier available.
     # Set the % complete to a small number to avoid the 'unavailable' indicator
@@ -93,6 +111,8 @@ def do_count_statistics(books_to_scan, pages_algorithm,
     total = len(books_to_scan)
     count = 0
     book_stats_map = dict()
+    text_analysis_map = dict()
+    checkpoint_file = open(checkpoint_path, 'a') if checkpoint_path else None
     while True:
         job = server.changed_jobs_queue.get()
         # A job can 'change' when it is not finished, for example if it
@@ -101,43 +121,19 @@ def do_count_statistics(books_to_scan, pages_algorithm,
         if not job.is_finished:
             continue
         # A job really finished. Get the information.
-        results = job.result
-        book_id = job._book_id
-        book_stats_map[book_id] = results
-        count = count + 1
+        books_results = job.result or []
+        for (book_id, title, book_path, book_download_sources, statistics_to_run, source_path), results in \
+                zip(job._books, books_results):
+            if RESULT_TEXT_ANALYSIS in results:
+                text_analysis_map[book_id] = results.pop(RESULT_TEXT_ANALYSIS)
+            book_stats_map[book_id] = results
+            print_book_results(book_id, title, results, statistics_to_run, page_count_mode, book_download_sources)
+            if checkpoint_file:
+                append_batch_result(checkpoint_file, book_id, results, text_analysis_map.get(book_id, None))
+        count = count + len(job._books)
         notification(float(count) / total, 'Counting Statistics')
 
         # Add this job's output to the current log
-        print('-------------------------------')
-        print('Logfile for book ID %d (%s)' % (book_id, job._title))
-
-        for stat in job._statistics_to_run:
-            if stat == cfg.STATISTIC_PAGE_COUNT:
-                print('\tMethod of counting _page_count_mode=%s _download_sources=%s' % (job._page_count_mode, job._download_sources))
-                print('\tresults=' ,results)
-                if job._page_count_mode == 'Download':
-                    if job._download_sources is not None:
-                        if stat in results and results[stat]:
-                            print('\tDownloaded page count from %s: %d' % (cfg.PAGE_DOWNLOADS[results['download_source']]['name'], results[stat]))
-                            del book_stats_map[book_id]['download_source']
-                        else:
-                            print('\tFAILED TO GET PAGE COUNT FROM WEBSITE')
-                else:
-                    if stat in results and results[stat]:
-                        print('\tFound %d pages' % results[stat])
-            elif stat == cfg.STATISTIC_WORD_COUNT:
-                if stat in results and results[stat]:
-                    print('\tFound %d words' % results[stat])
-            elif stat == cfg.STATISTIC_FLESCH_READING:
-                if stat in results and results[stat]:
-                    print('\tComputed %.1f Flesch Reading' % results[stat])
-            elif stat == cfg.STATISTIC_FLESCH_GRADE:
-                if stat in results and results[stat]:
-                    print('\tComputed %.1f Flesch-Kincaid Grade' % results[stat])
-            elif stat == cfg.STATISTIC_GUNNING_FOG:
-                if stat in results and results[stat]:
-                    print('\tComputed %.1f Gunning Fog Index' % results[stat])
-
         print(job.details)
 
         if count >= total:
@@ -145,19 +141,109 @@ def do_count_statistics(books_to_scan, pages_algorithm,
             break
 
     server.close()
-    # return the map as the job result
-    return book_stats_map
+    if checkpoint_file:
+        checkpoint_file.close()
+    # return the maps as the job result, the text analysis aggregates being
+    # stored in the statistics cache
+    return book_stats_map, text_analysis_map
+
+
+def print_book_results(book_id, title, results, statistics_to_run, page_count_mode, download_sources):
+    print('-------------------------------')
+    print('Results for book ID %d (%s)' % (book_id, title))
+
+    for stat in statistics_to_run:
+        if stat == cfg.STATISTIC_PAGE_COUNT:
+            print('\tMethod of counting _page_count_mode=%s _download_sources=%s' % (page_count_mode, download_sources))
+            print('\tresults=' ,results)
+            if page_count_mode == 'Download':
+                if download_sources is not None:
+                    if stat in results and results[stat]:
+                        print('\tDownloaded page count from %s: %d' % (cfg.PAGE_DOWNLOADS[results['download_source']]['name'], results[stat]))
+                        del results['download_source']
+                    else:
+                        print('\tFAILED TO GET PAGE COUNT FROM WEBSITE')
+            else:
+                if stat in results and results[stat]:
+                    print('\tFound %d pages' % results[stat])
+        elif stat == cfg.STATISTIC_WORD_COUNT:
+            if stat in results and results[stat]:
+                print('\tFound %d words' % results[stat])
+        elif stat == cfg.STATISTIC_FLESCH_READING:
+            if stat in results and results[stat]:
+                print('\tComputed %.1f Flesch Reading' % results[stat])
+        elif stat == cfg.STATISTIC_FLESCH_GRADE:
+            if stat in results and results[stat]:
+                print('\tComputed %.1f Flesch-Kincaid Grade' % results[stat])
+        elif stat == cfg.STATISTIC_GUNNING_FOG:
+            if stat in results and results[stat]:
+                print('\tComputed %.1f Gunning Fog Index' % results[stat])
+
+
+def do_statistics_for_books(books, pages_algorithm, page_count_mode,
+                            nltk_pickle_path, custom_chars_per_page, icu_wordcount,
+                            readability_samples=0):
+    '''
+    Child job, to count statistics in each of these books in turn, so they
+    share what this worker process has loaded. Each book is a tuple of
+    (book_id, book_path, download_sources, statistics_to_run, source_path).
+    Returns a list of the results of each book, in the order of the books.
+    '''
+    books_results = []
+    for book_id, book_path, download_sources, statistics_to_run, source_path in books:
+        print('-------------------------------')
+        print('Logfile for book ID %d' % book_id)
+        books_results.append(do_statistics_for_book(book_path, pages_algorithm, page_count_mode,
+                                     download_sources, statistics_to_run,
+                                     nltk_pickle_path, custom_chars_per_page, icu_wordcount,
+                                     source_path, readability_samples))
+    return books_results
+
+
+def link_or_copy_book(source_path, book_path):
+    '''
+    Make the library file at source_path available at book_path, as a hard
+    link or a copy-on-write clone where the filesystem allows it, otherwise
+    as a copy. The statistics only ever read the book, so sharing the data
+    blocks of the library file is safe.
+    '''
+    try:
+        os.link(source_path, book_path)
+        return
+    except (OSError, AttributeError):
+        pass
+    with open(source_path, 'rb') as src, open(book_path, 'wb') as dest:
+        try:
+            import fcntl
+            # FICLONE ioctl, to reflink the file on btrfs/xfs
+            fcntl.ioctl(dest.fileno(), 0x40049409, src.fileno())
+            return
+        except Exception:
+            pass
+        shutil.copyfileobj(src, dest, 1024 * 1024)
 
 
 def do_statistics_for_book(book_path, pages_algorithm, page_count_mode, 
                            download_sources, statistics_to_run,
-                           nltk_pickle, custom_chars_per_page, icu_wordcount):
+                           nltk_pickle_path, custom_chars_per_page, icu_wordcount,
+                           source_path=None, readability_samples=0):
     '''
-    Child job, to count statistics in this specific book
+    Count statistics in this specific book, for the child job of its batch
+
+    The book is read from book_path, a copy which is deleted once counted.
+    If a source_path in the library is given, the copy is only made now in
+    this job, or if there is no book_path the library file is read directly.
+    If readability_samples is given, the readability statistics are computed
+    from that many samples of the text rather than the whole book.
     '''
     results = {}
     try:
         iterator = None
+        if source_path:
+            if book_path:
+                link_or_copy_book(source_path, book_path)
+            else:
+                book_path = source_path
         print("do_statistics_for_book: ", book_path, pages_algorithm, page_count_mode, 
                            download_sources, statistics_to_run,
                            custom_chars_per_page, icu_wordcount)
@@ -208,7 +294,7 @@ def do_statistics_for_book(book_path, pages_algorithm, page_count_mode,
                         # The remaining stats are all reading level based
                         # As an optimisation, we will run the text analysis once and
                         # then add the relevant results
-                        iterator, text_analysis = get_text_analysis(iterator, book_path, nltk_pickle)
+                        iterator, text_analysis = get_text_analysis(iterator, book_path, nltk_pickle_path, readability_samples)
                         if text_analysis['wordCount'] == 0:
                             # Something dodgy about the conversion - no point in calculating remaining stats
                             print('ERROR: No words found in this book (conversion error?) - readability statistics will not be calculated')
@@ -217,17 +303,19 @@ def do_statistics_for_book(book_path, pages_algorithm, page_count_mode,
                         lang = iterator.opf.language
                         lang = get_lang() if not lang else lang
                         print('For this book, using language=%s' % lang)
+                        results[RESULT_TEXT_ANALYSIS] = get_cacheable_text_analysis(text_analysis, lang)
                         if cfg.STATISTIC_FLESCH_READING in statistics_to_run:
                             results[cfg.STATISTIC_FLESCH_READING] = get_flesch_reading_ease(text_analysis, lang)
                         if cfg.STATISTIC_FLESCH_GRADE in statistics_to_run:
                             results[cfg.STATISTIC_FLESCH_GRADE] = get_flesch_kincaid_grade_level(text_analysis)
                         if cfg.STATISTIC_GUNNING_FOG in statistics_to_run:
                             results[cfg.STATISTIC_GUNNING_FOG] = get_gunning_fog_index(text_analysis)
+                        print_readability_confidence(text_analysis, lang)
             finally:
                 if iterator:
                     iterator.__exit__()
                     iterator = None
-                if book_path is not None:
+                if book_path is not None and book_path != source_path:
                     if os.path.exists(book_path):
                         time.sleep(0.1)
                         cleanup(book_path)
@@ -1192,7 +1192,18 @@ class PunktSentenceTokenizer(_PunktBaseClass,TokenizerI):
     def text_contains_sentbreak(self, text):
         """
         Returns True if the given text includes a sentence break.
-        """
+        The result only depends on the text and the parameters, and the
+        same period contexts recur throughout a book, so it is memoised.
+        """
+        cache = self.__dict__.get('_sentbreak_cache', None)
+        if cache is None or len(cache) > 100000:
+            cache = self._sentbreak_cache = {}
+        contains_sentbreak = cache.get(text, None)
+        if contains_sentbreak is None:
+            contains_sentbreak = cache[text] = self._text_contains_sentbreak(text)
+        return contains_sentbreak
+
+    def _text_contains_sentbreak(self, text):
         found = False # used to ignore last token
         for t in self._annotate_tokens(self._tokenize_words(text)):
             if found:
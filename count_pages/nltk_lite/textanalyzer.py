@@ -18,27 +18,35 @@ class TextAnalyzer(object):
     tokenizer = RegexpTokenizer(r'(?u)\W+|\$[\d\.]+|\S+')
     special_chars = ['.', ',', '!', '?']
 
-    def __init__(self, eng_tokenizer_pickle):
-        self.eng_tokenizer = pickle.loads(eng_tokenizer_pickle)
+    def __init__(self, eng_tokenizer_pickle_path):
+        self.eng_tokenizer = loadTokenizer(eng_tokenizer_pickle_path)
 
-    def analyzeText(self, text=''):
-        words = self.getWords(text)
-        charCount = self.getCharacterCount(words)
-        wordCount = len(words)
+    def analyzeText(self, text='', verbose=True):
+        # All the statistics are computed in a single pass over the words
         sentences = self.getSentences(text)
         sentenceCount = len(sentences)
-        syllableCount = self.countSyllables(words)
-        complexwordsCount = self.countComplexWords(text, sentences, words)
+        sentenceStarts = SentenceStarts(sentences)
+        charCount = 0
+        wordCount = 0
+        syllableCount = 0
+        complexwordsCount = 0
+        for word in self.iterWords(text):
+            charCount += len(word)
+            wordCount += 1
+            syllables = countWordSyllables(word)
+            syllableCount += syllables
+            if syllables >= 3 and isComplexWord(word, sentenceStarts):
+                complexwordsCount += 1
         averageWordsPerSentence = wordCount/sentenceCount
-        print('\tResults of NLTK text analysis:')
-        print('\t  Number of characters: ' + str(charCount))
-        print('\t  Number of words: ' + str(wordCount))
-        print('\t  Number of sentences: ' + str(sentenceCount))
-        print('\t  Number of syllables: ' + str(syllableCount))
-        print('\t  Number of complex words: ' + str(complexwordsCount))
-        print('\t  Average words per sentence: ' + str(averageWordsPerSentence))
+        if verbose:
+            print('\tResults of NLTK text analysis:')
+            print('\t  Number of characters: ' + str(charCount))
+            print('\t  Number of words: ' + str(wordCount))
+            print('\t  Number of sentences: ' + str(sentenceCount))
+            print('\t  Number of syllables: ' + str(syllableCount))
+            print('\t  Number of complex words: ' + str(complexwordsCount))
+            print('\t  Average words per sentence: ' + str(averageWordsPerSentence))
         analyzedVars = {}
-        analyzedVars['words'] = words
         analyzedVars['charCount'] = float(charCount)
         analyzedVars['wordCount'] = float(wordCount)
         analyzedVars['sentenceCount'] = float(sentenceCount)
@@ -58,17 +66,19 @@ class TextAnalyzer(object):
     def getWords(self, text=''):
         #Grant
         #text = self._setEncoding(text)
-        words = self.tokenizer.tokenize(text)
-        filtered_words = []
-        for word in words:
-            if word in self.special_chars or word == " ":
+        filtered_words = list(self.iterWords(text))
+        #print('Filtered words:', filtered_words)
+        return filtered_words
+
+    def iterWords(self, text=''):
+        special_chars = self.special_chars
+        for word in self.tokenizer.tokenize(text):
+            if word in special_chars or word == " ":
                 pass
             else:
                 new_word = word.replace(",","").replace(".","")
                 new_word = new_word.replace("!","").replace("?","")
-                filtered_words.append(new_word)
-        #print('Filtered words:', filtered_words)
-        return filtered_words
+                yield new_word
 
     def getSentences(self, text=''):
         sentences = self.eng_tokenizer.tokenize(text)
@@ -76,10 +86,8 @@ class TextAnalyzer(object):
 
     def countSyllables(self, words = []):
         syllableCount = 0
-        syllableCounter = {}
-        syllableCounter['eng'] = syllables_en.count
         for word in words:
-            syllableCount += syllableCounter['eng'](word)
+            syllableCount += countWordSyllables(word)
 
         return syllableCount
 
@@ -91,34 +99,11 @@ class TextAnalyzer(object):
             sentences = self.getSentences(text)
         if not words:
             words = self.getWords(text)
+        sentenceStarts = SentenceStarts(sentences)
         complexWords = 0
-        found = False;
-        #Just for manual checking and debugging.
-        #cWords = []
-        curWord = []
-
         for word in words:
-            curWord.append(word)
-            if self.countSyllables(curWord)>= 3:
-
-                #Checking proper nouns. If a word starts with a capital letter
-                #and is NOT at the beginning of a sentence we don't add it
-                #as a complex word.
-                if not(word[0].isupper()):
-                    complexWords += 1
-                    #cWords.append(word)
-                else:
-                    for sentence in sentences:
-                        if str(sentence).startswith(word):
-                            found = True
-                            break
-
-                    if found:
-                        complexWords+=1
-                        found = False
-
-            curWord.remove(word)
-        #print(cWords)
+            if countWordSyllables(word) >= 3 and isComplexWord(word, sentenceStarts):
+                complexWords += 1
         return complexWords
 
     def _setEncoding(self,text):
@@ -130,3 +115,55 @@ class TextAnalyzer(object):
             except UnicodeError:
                 text = unicode(text, "ascii", "replace").encode("utf8")
         return text
+
+
+# Tokenizers already loaded in this process, keyed by the pickle path, so the
+# books counted together by a child job only unpickle the tokenizer once
+tokenizers = {}
+
+def loadTokenizer(pickle_path):
+    tokenizer = tokenizers.get(pickle_path, None)
+    if tokenizer is None:
+        with open(pickle_path, 'rb') as f:
+            tokenizer = tokenizers[pickle_path] = pickle.load(f)
+    return tokenizer
+
+
+# Syllable count of each word seen, shared by the books counted together by a
+# child job as the vocabulary of books overlaps heavily
+syllable_counts = {}
+
+def countWordSyllables(word):
+    syllables = syllable_counts.get(word, None)
+    if syllables is None:
+        if len(syllable_counts) > 100000:
+            # Keep the memory used bounded when analysing many books
+            syllable_counts.clear()
+        syllables = syllable_counts[word] = syllables_en.count(word)
+    return syllables
+
+
+def isComplexWord(word, sentenceStarts):
+    #Checking proper nouns. If a word starts with a capital letter
+    #and is NOT at the beginning of a sentence we don't add it
+    #as a complex word.
+    return not(word[0].isupper()) or sentenceStarts.startswith(word)
+
+
+class SentenceStarts(object):
+    '''
+    Whether any sentence starts with a word, answered with a set lookup of
+    the sentence prefixes of the length of the word rather than by scanning
+    every sentence. The set for each word length is built when first needed,
+    and only capitalised complex words are ever looked up, so few are built.
+    '''
+    def __init__(self, sentences):
+        self.sentences = sentences
+        self.prefixes = {}
+
+    def startswith(self, word):
+        length = len(word)
+        prefixes = self.prefixes.get(length, None)
+        if prefixes is None:
+            prefixes = self.prefixes[length] = set(str(sentence)[:length] for sentence in self.sentences)
+        return word in prefixes
@@ -3,11 +3,15 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 __license__ = 'GPL v3'
 __copyright__ = '2011, Grant Drake'
 
-import re, os, shutil
+import re, os, posixpath, shutil
+from collections import namedtuple
 
+from lxml import etree
 from six import text_type as unicode
+from six.moves.urllib.parse import unquote, urldefrag
 
 from calibre import prints
+from calibre.ebooks import DRMError
 from calibre.ebooks.BeautifulSoup import BeautifulSoup
 from calibre.ebooks.chardet import xml_to_unicode
 from calibre.ebooks.oeb.iterator import EbookIterator
@@ -17,6 +21,21 @@ from calibre_plugins.count_pages.nltk_lite.textanalyzer import TextAnalyzer
 
 RE_HTML_BODY = re.compile(u'<body[^>]*>(.*)</body>', re.UNICODE | re.DOTALL | re.IGNORECASE)
 RE_STRIP_MARKUP = re.compile(u'<[^>]+>', re.UNICODE)
+# A '>' or a '<' with any slashes and the character following them
+RE_ACCURATE_TOKENS = re.compile(u'<(/*)(.?)|>', re.UNICODE | re.DOTALL)
+RE_SENTENCE_END = re.compile(u'[.!?][\'"\u2019\u201d)]*\\s+', re.UNICODE)
+
+# Characters of text in each window analysed when sampling readability
+READABILITY_SAMPLE_CHARS = 5000
+
+RECOVER_PARSER = etree.XMLParser(recover=True, no_network=True, resolve_entities=False)
+OCF_NS = 'urn:oasis:names:tc:opendocument:xmlns:container'
+OPF_NS = 'http://www.idpf.org/2007/opf'
+DC_NS = 'http://purl.org/dc/elements/1.1/'
+ENC_NS = 'http://www.w3.org/2001/04/xmlenc#'
+# Font obfuscation is the only encryption of an ePub we can still count
+FONT_OBFUSCATION = ['http://ns.adobe.com/pdf/enc#RC', 'http://www.idpf.org/2008/embedding']
+EPUB_EXTENSIONS = ['.epub', '.kepub']
 
 def get_pdf_page_count(book_path):
     '''
@@ -108,14 +127,88 @@ def get_word_count(iterator, book_path, icu_wordcount):
 
 def _open_epub_file(book_path, strip_html=False):
     '''
-    Given a path to an EPUB file, read the contents into a giant block of text
+    Given a path to a book, open it to read the documents in its spine.
+    ePubs are read directly from the zip, other formats (or ePubs we fail
+    to read the spine of) are converted with an EbookIterator.
     '''
+    if os.path.splitext(book_path)[1].lower() in EPUB_EXTENSIONS:
+        try:
+            return EpubSpineReader(book_path)
+        except DRMError:
+            raise
+        except Exception as e:
+            print('\tFailed to read the ePub spine, converting the book instead:', e)
     iterator = EbookIterator(book_path)
     iterator.__enter__(only_input_plugin=True, run_char_count=True,
             read_anchor_map=False)
     return iterator
 
 
+OPFMetadata = namedtuple('OPFMetadata', 'language')
+
+class EpubSpineReader(object):
+    '''
+    A lightweight alternative to an EbookIterator for ePub books. The spine
+    is resolved from the OPF in the zip and each spine document is read from
+    the zip when asked for, without extracting the book to disk or running
+    the input plugin. Provides the spine, opf.language and __exit__ of an
+    EbookIterator used when counting statistics.
+    '''
+    def __init__(self, book_path):
+        from calibre.utils.zipfile import ZipFile
+        self.zf = ZipFile(book_path, 'r')
+        try:
+            self._read_opf()
+        except:
+            self.zf.close()
+            raise
+
+    def _read_opf(self):
+        names = set(self.zf.namelist())
+        if 'META-INF/encryption.xml' in names:
+            encryption = etree.fromstring(self.zf.read('META-INF/encryption.xml'), parser=RECOVER_PARSER)
+            for algorithm in encryption.xpath('//enc:EncryptionMethod/@Algorithm', namespaces={'enc': ENC_NS}):
+                if algorithm not in FONT_OBFUSCATION:
+                    raise DRMError()
+
+        container = etree.fromstring(self.zf.read('META-INF/container.xml'), parser=RECOVER_PARSER)
+        rootfiles = container.xpath('//ocf:rootfile/@full-path', namespaces={'ocf': OCF_NS})
+        if not rootfiles:
+            raise ValueError('META-INF/container.xml contains no link to OPF file')
+        opf_name = rootfiles[0]
+        opf_dir = posixpath.dirname(opf_name)
+        opf = etree.fromstring(self.zf.read(opf_name), parser=RECOVER_PARSER)
+        namespaces = {'opf': OPF_NS, 'dc': DC_NS}
+
+        manifest = {}
+        for item in opf.xpath('//opf:manifest/opf:item[@id and @href]', namespaces=namespaces):
+            href = unquote(urldefrag(item.get('href'))[0])
+            manifest[item.get('id')] = posixpath.normpath(posixpath.join(opf_dir, href))
+        # As with an EbookIterator, the documents not in the linear reading
+        # order follow the others. Unlike the input plugin, the documents are
+        # read as they are in the book, so a cover or title page is included.
+        linear, non_linear = [], []
+        for itemref in opf.xpath('//opf:spine/opf:itemref[@idref]', namespaces=namespaces):
+            name = manifest.get(itemref.get('idref'), None)
+            if name in names:
+                if itemref.get('linear', 'yes').strip().lower() == 'no':
+                    non_linear.append(name)
+                else:
+                    linear.append(name)
+        self.spine = linear + non_linear
+        if not self.spine:
+            raise ValueError('OPF file has no spine documents in the book')
+
+        languages = opf.xpath('//dc:language/text()', namespaces=namespaces)
+        self.opf = OPFMetadata(languages[0].strip() if languages else None)
+
+    def read(self, name):
+        return self.zf.read(name)
+
+    def __exit__(self, *args):
+        self.zf.close()
+
+
 def _get_page_count_adobe(iterator, book_path):
     '''
     This algorithm uses the proper adobe count. We look at the compressed size in the
@@ -124,6 +217,12 @@ def _get_page_count_adobe(iterator, book_path):
     import math
     from calibre.utils.zipfile import ZipFile
 
+    if isinstance(iterator, EpubSpineReader):
+        pages = 0.0
+        for name in iterator.spine:
+            pages += math.ceil(iterator.zf.getinfo(name).compress_size / 1024.0)
+        return pages
+
     with ZipFile(book_path, 'r') as zf:
         pages = 0.0
         base = iterator.base
@@ -174,13 +273,80 @@ def _get_page_count_accurate(iterator):
     The accurate algorithm attempts to apply a similar algorithm
     used for mobi accurate in apnx.py
     '''
-    epub_html = _read_epub_contents(iterator)
+    book_text = get_book_text(iterator)
+    epub_html = book_text.html
 
     # Decide whether to split on <p> or <div> characters
-    num_divs = len(epub_html.split('<div'))
-    num_paras = len(epub_html.split('<p'))
+    num_divs = epub_html.count('<div') + 1
+    num_paras = epub_html.count('<p') + 1
     split_char = 'p' if num_paras > num_divs else 'd'
 
+    lines = _count_accurate_lines(epub_html, split_char)
+
+    # Using 31 lines instead of 32 used by APNX to get the numbers similar
+    count = int(lines / 31)
+    # We could still have a really weird document and massively understate
+    # As a backstop count the characters using the "fast count" algorithm
+    # and use that number instead
+    fast_count = int(len(epub_html) / 2400) + 1
+    if (fast_count > count) :
+        # Before we are use the backstop, we should strip out the html
+        # otherwise our count could be vastly over-stated.
+        fast_count = int(len(book_text.text) / 2400) + 1
+
+    print('\tEstimated accurate page count')
+    print('\t  Lines:', lines, ' Divs:', num_divs, ' Paras:', num_paras)
+    print('\t  Accurate count:', count, ' Fast count:', fast_count)
+    return max([count, fast_count])
+
+
+def _count_accurate_lines(epub_html, split_char):
+    '''
+    Count the lines in the html, where a line is either a paragraph starting
+    or every 70 characters of text within paragraphs.
+
+    Rather than stepping through the html a character at a time, it is split
+    into tokens of the tags and the text between them, so only the tags need
+    to be looked at. The character after each '<' (and any slashes) is taken
+    as the tag name character, whatever it is, exactly as the original
+    character by character state machine (see _count_accurate_lines_by_char)
+    did. The 70 character count carries across paragraphs, so the lines in
+    the text are the total paragraph text characters divided by 70.
+
+    We can can use .lower() here because we are not modifying the text. In
+    this case the case doesn't matter just the absolute character and the
+    position within the stream.
+    '''
+    pieces = RE_ACCURATE_TOKENS.split(epub_html.lower())
+    in_tag = False
+    in_p = False
+    para_lines = 0
+    para_chars = 0
+    # The pieces are the text before the first token, followed by the
+    # slashes and tag character of each token (None if it is a '>') and
+    # the text after it
+    for i in range(1, len(pieces), 3):
+        slashes = pieces[i]
+        if slashes is None:
+            in_tag = False
+        else:
+            in_tag = True
+            if pieces[i+1] == split_char:
+                if slashes:
+                    in_p = False
+                else:
+                    in_p = True
+                    para_lines += 1
+        if in_p and not in_tag:
+            para_chars += len(pieces[i+2])
+    return para_lines + para_chars // 70
+
+
+def _count_accurate_lines_by_char(epub_html, split_char):
+    '''
+    The original implementation of _count_accurate_lines, walking the html
+    one character at a time. Kept as the reference for the tests.
+    '''
     # States
     in_tag = False
     in_p = False
@@ -188,20 +354,8 @@ def _get_page_count_accurate(iterator):
     closing = False
     p_char_count = 0
 
-    # Get positions of every line
-    # A line is either a paragraph starting
-    # or every 70 characters in a paragraph.
     lines = []
     pos = -1
-    # We want this to be as fast as possible so we
-    # are going to do one pass across the text. re
-    # and string functions will parse the text each
-    # time they are called.
-    #
-    # We can can use .lower() here because we are
-    # not modifying the text. In this case the case
-    # doesn't matter just the absolute character and
-    # the position within the stream.
     for c in epub_html.lower():
         pos += 1
 
@@ -234,23 +388,7 @@ def _get_page_count_accurate(iterator):
             if p_char_count == 70:
                 lines.append(pos)
                 p_char_count = 0
-
-    # Using 31 lines instead of 32 used by APNX to get the numbers similar
-    count = int(len(lines) / 31)
-    # We could still have a really weird document and massively understate
-    # As a backstop count the characters using the "fast count" algorithm
-    # and use that number instead
-    fast_count = int(len(epub_html) / 2400) + 1
-    if (fast_count > count) :
-        # Before we are use the backstop, we should strip out the html
-        # otherwise our count could be vastly over-stated.
-        epub_html = _read_epub_contents(iterator, strip_html=True)
-        fast_count = int(len(epub_html) / 2400) + 1
-
-    print('\tEstimated accurate page count')
-    print('\t  Lines:', len(lines), ' Divs:', num_divs, ' Paras:', num_paras)
-    print('\t  Accurate count:', count, ' Fast count:', fast_count)
-    return max([count, fast_count])
+    return len(lines)
 
 
 def _get_page_count_custom(iterator, custom_chars_per_page):
@@ -259,11 +397,8 @@ def _get_page_count_custom(iterator, custom_chars_per_page):
     average page character count.
     '''
     count = 0
-    for path in iterator.spine:
-        with open(path, 'rb') as f:
-            raw = f.read().decode('utf-8', 'replace')
-            html = _get_body_text(raw)
-            count = count + int(len(html) / custom_chars_per_page) + 1
+    for length in get_book_text(iterator).document_lengths():
+        count = count + int(length / custom_chars_per_page) + 1
     return count
 
 
@@ -272,7 +407,7 @@ def _get_epub_standard_word_count(iterator, lang='en', icu_wordcount=False):
     This algorithm counts individual words instead of pages
     '''
 
-    book_text = _read_epub_contents(iterator, strip_html=True)
+    book_text = get_book_text(iterator).text
     
     wordcount = None
     
@@ -300,30 +435,75 @@ def _get_epub_standard_word_count(iterator, lang='en', icu_wordcount=False):
     return wordcount
 
 
-def _read_epub_contents(iterator, strip_html=False):
+class BookText(object):
     '''
-    Given an iterator for an ePub file, read the contents into a giant block of text
+    The contents of the spine of an ePub, read and decoded once and shared by
+    all the statistics counted for the book. Each spine document is only
+    parsed to strip its html the first time the text is asked for.
+
+    The text of the documents is held in a single buffer, separated by a
+    space, with the offset of each document in the buffer.
     '''
-    book_files = []
-    for path in iterator.spine:
-        with open(path, 'rb') as f:
-            raw = f.read().decode('utf-8', 'replace')
-            if strip_html:
-                html = _get_body_text(raw)
-                #print('FOUND HTML:', html)
+    def __init__(self, iterator):
+        self._raw_docs = []
+        for path in iterator.spine:
+            if isinstance(iterator, EpubSpineReader):
+                raw = iterator.read(path)
             else:
-                html = raw
-        book_files.append(html)
-    return ' '.join(book_files)
+                with open(path, 'rb') as f:
+                    raw = f.read()
+            self._raw_docs.append(raw.decode('utf-8', 'replace'))
+        self._text = None
+        self.offsets = None
+
+    @property
+    def html(self):
+        '''
+        The raw html of all the spine documents
+        '''
+        return ' '.join(self._raw_docs)
+
+    @property
+    def text(self):
+        '''
+        The text of the body of all the spine documents
+        '''
+        if self._text is None:
+            self.offsets = []
+            body_texts = []
+            offset = 0
+            for raw in self._raw_docs:
+                body_text = _get_body_text(raw)
+                self.offsets.append(offset)
+                offset += len(body_text) + 1
+                body_texts.append(body_text)
+            self._text = ' '.join(body_texts)
+        return self._text
+
+    def document_lengths(self):
+        '''
+        The length of the body text of each spine document
+        '''
+        text = self.text
+        ends = self.offsets[1:] + [len(text) + 1]
+        return [end - 1 - start for start, end in zip(self.offsets, ends)]
+
+
+def get_book_text(iterator):
+    '''
+    Return the BookText for this iterator, read when first asked for and then
+    shared by each statistic computed for the book
+    '''
+    book_text = getattr(iterator, 'count_pages_book_text', None)
+    if book_text is None:
+        book_text = iterator.count_pages_book_text = BookText(iterator)
+    return book_text
 
 
 def _get_body_text(raw):
     soup = BeautifulSoup(xml_to_unicode(raw, strip_encoding_pats=True, resolve_entities=True)[0])
     body_tag = soup.body
-    html = ''
-    for string in body_tag.strings:
-        html += string.strip() + ' '
-    return html.strip()
+    return ' '.join(string.strip() for string in body_tag.strings).strip()
 
 # ---------------------------------------------------------
 #    CBR/CBZ Page Count Functions
@@ -359,53 +539,215 @@ def get_cbz_page_count(book_path):
 #    Readability Statistics Functions
 # ---------------------------------------------------------
 
-def get_text_analysis(iterator, book_path, nltk_pickle):
+def get_text_analysis(iterator, book_path, nltk_pickle_path, sample_count=0):
     '''
     Given an iterator for the epub (if already opened/converted), perform text
     analysis using NLTK to produce a dictionary of analysed statistics for
     attribution like words, sentences, syllables etc that we can then perform
     various official readability computations with.
+
+    If a sample count is given, only that many evenly spaced windows of the
+    text are analysed, unless the book is too short for that to save time.
+    The analysis of each window is kept as 'samples' so that the confidence
+    of the statistics can be reported with print_readability_confidence.
     '''
     if iterator is None:
         iterator = _open_epub_file(book_path)
 
-    epub_html = _read_epub_contents(iterator, strip_html=True)
     # Lets ignore any html content files less than 500 characters to hopefully
     # stop any skewing of results caused by cover pages etc.
     #epub_html = [h for h in epub_html if len(h) > 500]
-    text = ''.join(epub_html).strip()
-    # TODO: Do not analyse the WHOLE book - just a portion should be sufficient???
-
-    t = TextAnalyzer(nltk_pickle)
-    text_analysis = t.analyzeText(text)
+    text = get_book_text(iterator).text.strip()
+
+    t = TextAnalyzer(nltk_pickle_path)
+    windows = _get_sample_windows(text, sample_count)
+    if not windows:
+        text_analysis = t.analyzeText(text)
+        return iterator, text_analysis
+
+    print('\tAnalysing %d samples of %d characters from %d characters of text'
+          % (len(windows), READABILITY_SAMPLE_CHARS, len(text)))
+    samples = [t.analyzeText(window, verbose=False) for window in windows]
+    text_analysis = {}
+    for key in ['charCount', 'wordCount', 'sentenceCount', 'syllableCount', 'complexwordCount']:
+        text_analysis[key] = sum(sample[key] for sample in samples)
+    text_analysis['averageWordsPerSentence'] = text_analysis['wordCount'] / text_analysis['sentenceCount']
+    print('\tResults of NLTK text analysis of samples:')
+    print('\t  Number of words: %d' % text_analysis['wordCount'])
+    print('\t  Number of sentences: %d' % text_analysis['sentenceCount'])
+    print('\t  Average words per sentence: %s' % text_analysis['averageWordsPerSentence'])
+    text_analysis['samples'] = [sample for sample in samples if sample['wordCount']]
+    text_analysis['sampledFraction'] = len(windows) * READABILITY_SAMPLE_CHARS / len(text)
     return iterator, text_analysis
 
-def get_flesch_reading_ease(text_analysis, lang=None):
+
+def _get_sample_windows(text, sample_count):
+    '''
+    Split the text into sample_count equal strata and take a window of text
+    from the middle of each, trimmed to whole sentences where possible.
+    Returns None if the whole text should be analysed instead.
+    '''
+    if not sample_count or len(text) < 2 * sample_count * READABILITY_SAMPLE_CHARS:
+        return None
+    stratum = len(text) / sample_count
+    windows = []
+    for i in range(sample_count):
+        start = int(i * stratum + (stratum - READABILITY_SAMPLE_CHARS) / 2)
+        window = text[start:start + READABILITY_SAMPLE_CHARS]
+        sentence_ends = [m.end() for m in RE_SENTENCE_END.finditer(window)]
+        if len(sentence_ends) > 1:
+            window = window[sentence_ends[0]:sentence_ends[-1]]
+        windows.append(window.strip())
+    return windows
+
+
+def print_readability_confidence(text_analysis, lang=None):
+    '''
+    For a text analysis of samples, print the 95% confidence interval of each
+    readability statistic, from the spread of the statistic across samples.
+    '''
+    import math
+    samples = text_analysis.get('samples', None)
+    if not samples or len(samples) < 2:
+        return
+    n = len(samples)
+    # Finite population correction, as the samples can be a large part of the book
+    fpc = math.sqrt(max(0.0, 1.0 - text_analysis['sampledFraction']))
+    for name, score_fn in [
+            ('Flesch Reading Ease', lambda ta: get_flesch_reading_ease(ta, lang, verbose=False)),
+            ('Flesch-Kincaid Grade Level', lambda ta: get_flesch_kincaid_grade_level(ta, verbose=False)),
+            ('Gunning Fog Index', lambda ta: get_gunning_fog_index(ta, verbose=False))]:
+        scores = [score_fn(sample) for sample in samples]
+        mean = sum(scores) / n
+        variance = sum((score - mean) ** 2 for score in scores) / (n - 1)
+        margin = 1.96 * math.sqrt(variance / n) * fpc
+        estimate = score_fn(text_analysis)
+        print('\t%s: %.1f, 95%% confidence %.1f to %.1f over %d samples'
+              % (name, estimate, estimate - margin, estimate + margin, n))
+
+def get_flesch_reading_ease(text_analysis, lang=None, verbose=True):
     if lang and lang == 'deu':
-        print('\tFlesch Reading Ease: language=%s' % lang)
+        if verbose:
+            print('\tFlesch Reading Ease: language=%s' % lang)
         score = 180 - text_analysis['averageWordsPerSentence'] - (58.5 * (text_analysis['syllableCount']/ text_analysis['wordCount'])) 
     else:
         score = 206.835 - (1.015 * (text_analysis['averageWordsPerSentence'])) - (84.6 * (text_analysis['syllableCount']/ text_analysis['wordCount']))
-    print('\tFlesch Reading Ease:', score)
+    if verbose:
+        print('\tFlesch Reading Ease:', score)
     return score
 
-def get_flesch_kincaid_grade_level(text_analysis):
+def get_flesch_kincaid_grade_level(text_analysis, verbose=True):
     score = 0.39 * (text_analysis['averageWordsPerSentence']) + 11.8 * (text_analysis['syllableCount']/ text_analysis['wordCount']) - 15.59
-    print('\tFlesch Kincade Grade:', score)
+    if verbose:
+        print('\tFlesch Kincade Grade:', score)
     return score
 
-def get_gunning_fog_index(text_analysis):
+def get_gunning_fog_index(text_analysis, verbose=True):
     score = 0.4 * ((text_analysis['averageWordsPerSentence']) + (100 * (text_analysis['complexwordCount']/text_analysis['wordCount'])))
-    print('\tGunning Fog:', score)
+    if verbose:
+        print('\tGunning Fog:', score)
     return score
 
 
+def do_accurate_page_count_tests(book_paths=(), fuzz_count=5000):
+    '''
+    Golden tests that _count_accurate_lines gives identical line counts to the
+    original character by character implementation, for html exercising the
+    edge cases of the state machine, random fuzzed html and the spine of
+    any ePub books given.
+    '''
+    import random
+
+    def _assert(test_name, epub_html, expected=None):
+        for split_char in ['p', 'd']:
+            original = _count_accurate_lines_by_char(epub_html, split_char)
+            actual = _count_accurate_lines(epub_html, split_char)
+            if expected is not None and split_char == 'p' and original != expected:
+                prints('Failed golden count: %s expected %d original %d' % (test_name, expected, original))
+                return False
+            if actual != original:
+                prints('Failed: %s split_char=%s original %d actual %d' % (test_name, split_char, original, actual))
+                return False
+        return True
+
+    text = 'x' * 140
+    cases = [
+        ('empty', '', 0),
+        ('one para', '<p>%s</p>' % text, 3),
+        ('para attributes', '<p class="a">%s</p>' % text, 3),
+        ('upper case', '<P>%s</P>' % text, 3),
+        ('chars carry over', '<p>%s</p><p>%s</p>' % ('x' * 35, 'x' * 35), 3),
+        ('text outside para', '%s<p>a</p>%s' % (text, text), 1),
+        ('text after close', '<p>a</p>%s<p>b</p>' % text, 2),
+        ('nested tags', '<p><b>%s</b><i>%s</i></p>' % ('x' * 35, 'x' * 35), 2),
+        ('multiple slashes', '<p>%s<//p>%s' % (text, text), 3),
+        ('empty tag keeps in tag', '<p><>%s>%s</p>' % (text, text), 3),
+        ('tag char is gt', '<p>a<>%s' % text, 1),
+        ('tag char is lt', '<p>a<<%s>%s' % (text, text), 3),
+        ('unclosed tag at end', '<p>%s<' % text, 3),
+        ('slashes at end', '<p>%s<//' % text, 3),
+        ('stray gt', '<p>a>%s' % text, 3),
+        ('pre and param tags', '<pre>%s</pre><param>%s' % (text, text), 6),
+        ('newlines', '<p\n>%s\n</p\n>' % text, 3),
+        ('unicode lower', '<p>%s</p>' % ('\u0130' * 70), 3),
+        ]
+    failures = 0
+    for test_name, epub_html, expected in cases:
+        if not _assert(test_name, epub_html, expected):
+            failures += 1
+    prints('Accurate page count golden tests: %d of %d passed' % (len(cases) - failures, len(cases)))
+
+    fragments = ['<', '>', '/', 'p', 'P', 'd', 'div', ' ', 'x', 'abc ', '<p>', '</p>',
+                 '<div>', '</div>', '<br/>', '\n', '\u0130']
+    failures = 0
+    for i in range(fuzz_count):
+        epub_html = ''.join(random.choice(fragments) for j in range(random.randint(0, 200)))
+        if not _assert('fuzz %d: %r' % (i, epub_html), epub_html):
+            failures += 1
+    prints('Accurate page count fuzz tests: %d of %d passed' % (fuzz_count - failures, fuzz_count))
+
+    for book_path in book_paths:
+        iterator = _open_epub_file(book_path)
+        try:
+            _assert(book_path, get_book_text(iterator).html)
+            prints('Tested:', book_path)
+        finally:
+            iterator.__exit__()
+
+
+def do_accurate_page_count_benchmark(book_paths=(), para_count=200000):
+    '''
+    Compare the time to count the accurate lines with the original character
+    by character implementation, for a synthetic omnibus of paragraphs and
+    the spine of any ePub books given.
+    '''
+    import time
+
+    def _benchmark(name, epub_html):
+        results = []
+        for fn in [_count_accurate_lines_by_char, _count_accurate_lines]:
+            start = time.time()
+            lines = fn(epub_html, 'p')
+            results.append((lines, time.time() - start))
+        prints('%s (%d chars)   original: %d lines %.2fs   tokenised: %d lines %.2fs' % (
+                    name, len(epub_html), results[0][0], results[0][1], results[1][0], results[1][1]))
+
+    para = '<p class="calibre1">It was the best of times, it was the <i>worst</i> of times, ' \
+           'it was the age of wisdom, it was the age of foolishness.</p>\n'
+    _benchmark('Synthetic omnibus', '<html><body>' + para * para_count + '</body></html>')
+    for book_path in book_paths:
+        iterator = _open_epub_file(book_path)
+        try:
+            _benchmark(book_path, get_book_text(iterator).html)
+        finally:
+            iterator.__exit__()
+
+
 # calibre-debug -e statistics.py
 if __name__ == '__main__':
     def test_ntlk(book_path):
         pickle_path = os.path.join(os.getcwd(), 'nltk_lite/english.pickle')
-        p = open(pickle_path,'rb').read()
-        it, ta = get_text_analysis(None, book_path, p)
+        it, ta = get_text_analysis(None, book_path, pickle_path)
         get_flesch_reading_ease(ta)
         get_flesch_kincaid_grade_level(ta)
         get_gunning_fog_index(ta)
@@ -414,3 +756,6 @@ if __name__ == '__main__':
     #test_ntlk('''C:\Dev\Tools\eclipse\workspace\_Misc\Test\TestDoc.rtf''')
     #get_cbz_page_count('''C:/Dev/Tools/eclipse/workspace/_Misc/misery-depot.zip''')
     #get_cbr_page_count('''C:/Dev/Tools/eclipse/workspace/_Misc/misery-depot.cbr''')
+    #import sys
+    #do_accurate_page_count_tests(sys.argv[1:])
+    #do_accurate_page_count_benchmark(sys.argv[1:])
@@ -70,8 +70,11 @@ class FindDuplicatesAction(InterfaceAction):
         self.gui.search_restriction.currentIndexChanged.connect(self.user_has_changed_restriction)
 
     def library_changed(self, db):
-        # We need to reset our duplicate finder after switching libraries
+        # We need to reset our duplicate finder after switching libraries,
+        # keeping any binary compare job still running so another is not started
+        binary_compare_job = self.duplicate_finder.binary_compare_job
         self.duplicate_finder = DuplicateFinder(self.gui)
+        self.duplicate_finder.binary_compare_job = binary_compare_job
         self.update_actions_enabled()
 
     def shutting_down(self):
@@ -182,7 +185,7 @@ class FindDuplicatesAction(InterfaceAction):
     def find_book_duplicates(self):
         d = FindBookDuplicatesDialog(self.gui)
         if d.exec_() == d.Accepted:
-            self.duplicate_finder.run_book_duplicates_check()
+            self.duplicate_finder.run_book_duplicates_check(completed_fn=self.update_actions_enabled)
             self.update_actions_enabled()
 
     def find_library_duplicates(self):
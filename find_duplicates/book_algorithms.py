@@ -13,9 +13,14 @@ except ImportError:
 
 from calibre import prints
 from calibre.constants import DEBUG
+from calibre.gui2 import Dispatcher
 
-from calibre_plugins.find_duplicates.matching import (authors_to_list, similar_title_match,
-                                get_author_algorithm_fn, get_title_algorithm_fn)
+from calibre_plugins.find_duplicates.jobs import get_partial_hash, find_files_to_fully_hash
+from calibre_plugins.find_duplicates.matching import (clean_dup_groups, partition_using_exemptions,
+                                similar_title_match,
+                                get_author_algorithm_fn, get_title_algorithm_fn,
+                                get_match_index_key, get_title_words, find_similar_titles)
+import calibre_plugins.find_duplicates.matching as matching
 
 try:
     load_translations()
@@ -38,6 +43,8 @@ class AlgorithmBase(object):
         self.db = db
         self.model = self.gui.library_view.model()
         self._exemptions_map = exemptions_map
+        self._exemption_graph = None
+        self._field_maps = {}
 
     def duplicate_search_mode(self):
         return DUPLICATE_SEARCH_FOR_BOOK
@@ -52,7 +59,13 @@ class AlgorithmBase(object):
         # Get our map of potential duplicate candidates
         self.gui.status_bar.showMessage(_('Analysing {0} books for duplicates').format(len(book_ids)))
         candidates_map = self.find_candidates(book_ids, include_languages)
+        return self.process_candidates_map(candidates_map, sort_groups_by_title, start)
 
+    def process_candidates_map(self, candidates_map, sort_groups_by_title, start):
+        '''
+        Convert the map of potential duplicate candidates into the tuple of
+        (books_for_group_map, groups_for_book_map) for the duplicate groups
+        '''
         # Perform a quick pass through removing all groups with < 2 members
         self.shrink_candidates_map(candidates_map)
 
@@ -79,9 +92,11 @@ class AlgorithmBase(object):
 
     def find_candidates(self, book_ids, include_languages=False):
         '''
-        Default implementation will iterate across the book ids to consider
-        and call find_candidate. Return a dictionary of candidates.
+        Default implementation will load the fields needed for the book ids
+        to consider, then iterate across them and call find_candidate.
+        Return a dictionary of candidates.
         '''
+        self.load_fields(book_ids, include_languages)
         candidates_map = defaultdict(set)
         for book_id in book_ids:
             self.find_candidate(book_id, candidates_map, include_languages)
@@ -93,6 +108,43 @@ class AlgorithmBase(object):
         '''
         pass
 
+    def load_fields(self, book_ids, include_languages=False):
+        '''
+        Load all the fields find_candidate requires for these books up front,
+        rather than it reading from the database one book at a time.
+        Derived classes should extend for any other fields they require.
+        '''
+        if include_languages:
+            self.load_field('languages', book_ids)
+
+    def load_field(self, field, book_ids):
+        self._field_maps[field] = self.db.new_api.all_field_for(field, book_ids)
+
+    def get_field(self, field, book_id):
+        '''
+        Return the value of this field for the book from those loaded in bulk,
+        falling back to the database if this book was not loaded.
+        '''
+        field_map = self._field_maps.get(field, None)
+        if field_map is not None and book_id in field_map:
+            return field_map[book_id]
+        return self.db.new_api.field_for(field, book_id)
+
+    def get_authors(self, book_id):
+        '''
+        Equivalent of authors_to_list() using the fields loaded in bulk
+        '''
+        return [a.strip() for a in self.get_field('authors', book_id) or ()]
+
+    def get_languages(self, book_id):
+        '''
+        Equivalent of db.languages() using the fields loaded in bulk
+        '''
+        languages = self.get_field('languages', book_id)
+        if languages:
+            return ','.join(languages)
+        return None
+
     def shrink_candidates_map(self, candidates_map):
         for key in list(candidates_map.keys()):
             if len(candidates_map[key]) < 2:
@@ -129,16 +181,7 @@ class AlgorithmBase(object):
         Given a dictionary of sets, convert into a list of sets removing any sets
         that are subsets of other sets.
         '''
-        res = [set(d) for d in list(candidates_map.values())]
-        res.sort(key=lambda x: len(x))
-        candidates_list = []
-        for i,a in enumerate(res):
-            for b in res[i+1:]:
-                if a.issubset(b):
-                    break
-            else:
-                candidates_list.append(a)
-        return candidates_list
+        return clean_dup_groups(candidates_map)
 
     def get_book_ids_for_candidate_group(self, candidate_group):
         '''
@@ -168,45 +211,11 @@ class AlgorithmBase(object):
         repartition into multiple groups. Returns a list where each item
         is a sublist containing the data items for that partitioned group.
         '''
-        data_items = sorted(data_items)
-        # Initial condition -- the group contains 1 set of all elements
-        results = [set(data_items)]
-        partitioning_ids = [None]
-        # Loop through the set of duplicates, checking to see if the entry is in a non-dup set
-        for one_dup in data_items:
-            if one_dup in self._exemptions_map:
-                ndm_entry = self._exemptions_map.merge_sets(one_dup)
-                # The entry is indeed in a non-dup set. We may need to partition
-                for i,res in enumerate(results):
-                    if one_dup in res:
-                        # This result group contains the item with a non-dup set. If the item
-                        # was the one that caused this result group to partition in the first place,
-                        # then we must not partition again or we will make subsets of the group
-                        # that split this partition off. Consider a group of (1,2,3,4) and
-                        # non-dups of [(1,2), (2,3)]. The first partition will give us (1,3,4)
-                        # and (2,3,4). Later when we discover (2,3), if we partition (2,3,4)
-                        # again, we will end up with (2,4) and (3,4), but (3,4) is a subset
-                        # of (1,3,4). All we need to do is remove 3 from the (2,3,4) partition.
-                        if one_dup == partitioning_ids[i]:
-                            results[i] = (res - ndm_entry) | set([one_dup])
-                            continue
-                        # Must partition. We already have one partition, the one in our hand.
-                        # Remove the dups from it, then create new partitions for each of the dups.
-                        results[i] = (res - ndm_entry) | set([one_dup])
-                        for nd in ndm_entry:
-                            # Only partition if the duplicate is larger than the one we are looking
-                            # at. This is necessary because the non-dup set map is complete,
-                            # map[2] == (2,3), and map[3] == (2,3). We know that when processing
-                            # the set for 3, we have already done the work for the element 2.
-                            if nd > one_dup and nd in res:
-                                results.append((res - ndm_entry - set([one_dup])) | set([nd]))
-                                partitioning_ids.append(nd)
-        sr = []
-        for r in results:
-            if len(r) > 1:
-                sr.append(sorted(list(r)))
-        sr.sort()
-        return sr
+        if self._exemption_graph is None:
+            self._exemption_graph = {}
+            if self._exemptions_map:
+                self._exemption_graph = self._exemptions_map.get_exemption_graph()
+        return partition_using_exemptions(data_items, self._exemption_graph)
 
 
 class IdentifierAlgorithm(AlgorithmBase):
@@ -224,8 +233,11 @@ class IdentifierAlgorithm(AlgorithmBase):
         '''
         return self.db.data.search_getting_ids('identifier:'+self.identifier_type+':True', self.db.data.search_restriction)
 
+    def load_fields(self, book_ids, include_languages=False):
+        self.load_field('identifiers', book_ids)
+
     def find_candidate(self, book_id, candidates_map, include_languages=False):
-        identifiers = self.db.get_identifiers(book_id, index_is_id=True)
+        identifiers = self.get_field('identifiers', book_id) or {}
         identifier = identifiers.get(self.identifier_type, '')
         if identifier:
             candidates_map[identifier].add(book_id)
@@ -235,10 +247,11 @@ class IdentifierAlgorithm(AlgorithmBase):
         Responsible for returning an ordered dict of how to order the groups
         Override to just do a fuzzy title sort to give a better sort than by identifier
         '''
+        first_book_ids = dict((key, next(iter(book_ids))) for key, book_ids in candidates_map.items())
+        titles = self.db.new_api.all_field_for('title', first_book_ids.values())
         title_map = {}
-        for key in list(candidates_map.keys()):
-            book_id = list(candidates_map[key])[0]
-            title_map[key] = similar_title_match(self.db.title(book_id, index_is_id=True))
+        for key, book_id in first_book_ids.items():
+            title_map[key] = similar_title_match(titles[book_id])
         if by_title:
             skeys = sorted(list(candidates_map.keys()), key=lambda identifier: title_map[identifier])
         else:
@@ -266,6 +279,149 @@ class BinaryCompareAlgorithm(IdentifierAlgorithm):
         efficient approach to finding binary duplicates.
         '''
         # Our first pass will be to find all books that have an identical file size
+        candidates_size_map = self._find_candidates_by_file_size(book_ids)
+        hash_map = self.db.get_all_custom_book_data('find_duplicates', default={})
+        size_groups = self._get_size_groups(candidates_size_map, hash_map)
+
+        # Our second pass hashes the start and end of each file, and our final
+        # pass fully hashes only those files whose partial hashes collide
+        candidates_map = defaultdict(set)
+        result_hash_map = {}
+        for size, files in size_groups:
+            self.add_partial_hashes(files)
+            self.add_full_hashes(find_files_to_fully_hash(files))
+            self._find_candidates_by_hash(files, candidates_map, result_hash_map)
+        self.db.add_multiple_custom_book_data('find_duplicates', result_hash_map)
+        return candidates_map
+
+    def run_duplicate_check_job(self, sort_groups_by_title, callback):
+        '''
+        An alternative entry point for running the algorithm, which hashes any
+        format files not hashed by a previous run as a background job using a
+        pool of worker processes. When complete the callback is invoked with
+        the same tuple run_duplicate_check() returns, or None if the job failed,
+        was stopped by the user or the library was switched while it ran.
+        Returns the job, or None if no files needed hashing.
+        '''
+        book_ids = self.get_book_ids_to_consider()
+        start = time.time()
+        self.gui.status_bar.showMessage(_('Analysing {0} books for duplicates').format(len(book_ids)))
+        candidates_size_map = self._find_candidates_by_file_size(book_ids)
+        hash_map = self.db.get_all_custom_book_data('find_duplicates', default={})
+
+        # Use the hashes from a previous run where possible, only sending the
+        # size groups containing files that need hashing to the job
+        candidates_map = defaultdict(set)
+        result_hash_map = {}
+        job_size_groups = []
+        files_count = 0
+        for size, files in self._get_size_groups(candidates_size_map, hash_map):
+            files_to_hash = [f for f in files if not f['partial']]
+            files_to_hash.extend(find_files_to_fully_hash(files))
+            if not files_to_hash:
+                self._find_candidates_by_hash(files, candidates_map, result_hash_map)
+                continue
+            for f in files:
+                f['path'] = self.db.format_abspath(f['book_id'], f['fmt'], index_is_id=True)
+            job_size_groups.append((size, files))
+            files_count += len(files_to_hash)
+
+        if not job_size_groups:
+            self.db.add_multiple_custom_book_data('find_duplicates', result_hash_map)
+            callback(self.process_candidates_map(candidates_map, sort_groups_by_title, start))
+            return None
+
+        cpus = self.gui.job_manager.server.pool_size
+        args = ['calibre_plugins.find_duplicates.jobs', 'do_hash_formats', (job_size_groups, cpus)]
+        job = self.gui.job_manager.run_job(Dispatcher(self._hash_job_completed), 'arbitrary_n',
+                        args=args, description=_('Find binary duplicates'))
+        job.candidates_map = candidates_map
+        job.result_hash_map = result_hash_map
+        job.sort_groups_by_title = sort_groups_by_title
+        job.start = start
+        job.duplicate_check_callback = callback
+        self.gui.status_bar.showMessage(_('Hashing {0} book files for binary duplicates').format(files_count))
+        return job
+
+    def _hash_job_completed(self, job):
+        if job.failed:
+            if getattr(job, 'killed', False):
+                self.gui.status_bar.showMessage(_('Binary compare cancelled'), 3000)
+            else:
+                self.gui.job_exception(job, dialog_title=_('Failed to find binary duplicates'))
+            job.duplicate_check_callback(None)
+            return
+        if self.gui.current_db.library_id != self.db.library_id:
+            # The user has switched libraries while the job was running, so
+            # our db is no longer open and the hashes are not for this library
+            job.duplicate_check_callback(None)
+            return
+        candidates_map = job.candidates_map
+        result_hash_map = job.result_hash_map
+        for _size, files in job.result:
+            self._find_candidates_by_hash(files, candidates_map, result_hash_map)
+        self.db.add_multiple_custom_book_data('find_duplicates', result_hash_map)
+        job.duplicate_check_callback(self.process_candidates_map(candidates_map,
+                                            job.sort_groups_by_title, job.start))
+
+    def _get_size_groups(self, candidates_size_map, hash_map):
+        '''
+        Return a list of (size, files) tuples for each group of formats with
+        an identical size, where files is a list of dictionaries for each
+        format including any partial/full hashes stored from a previous run
+        '''
+        size_groups = []
+        for size, size_group in list(candidates_size_map.items()):
+            files = []
+            for book_id, fmt, mtime in size_group:
+                f = {'book_id': book_id, 'fmt': fmt, 'mtime': mtime, 'size': size,
+                     'path': None, 'partial': None, 'sha': None}
+                book_data = hash_map.get(book_id, {}).get(fmt, {})
+                if book_data.get('mtime', None) == mtime and book_data.get('size', None) == size:
+                    f['partial'] = book_data.get('partial', None)
+                    f['sha'] = book_data.get('sha', None)
+                files.append(f)
+            size_groups.append((size, files))
+        return size_groups
+
+    def add_partial_hashes(self, files):
+        '''
+        Hash the start and end of each of these files without a partial hash
+        '''
+        for f in files:
+            if not f['partial']:
+                try:
+                    path = self.db.format_abspath(f['book_id'], f['fmt'], index_is_id=True)
+                    if path:
+                        f['partial'] = get_partial_hash(path, f['size'])
+                except:
+                    traceback.print_exc()
+
+    def add_full_hashes(self, files):
+        for f in files:
+            try:
+                f['sha'] = self.db.format_hash(f['book_id'], f['fmt'])
+            except:
+                traceback.print_exc()
+
+    def _find_candidates_by_hash(self, files, candidates_map, result_hash_map):
+        '''
+        Add the files that have been fully hashed to our candidates, storing the
+        hashes of all the files as plugin book data for future repeat scanning
+        '''
+        for f in files:
+            if not f['partial'] and not f['sha']:
+                # This file could not be read
+                continue
+            book_data = {'mtime': f['mtime'], 'size': f['size']}
+            if f['partial']:
+                book_data['partial'] = f['partial']
+            if f['sha']:
+                book_data['sha'] = f['sha']
+                candidates_map[(f['sha'], f['size'])].add(f['book_id'])
+            self._add_to_hash_map(result_hash_map, f['book_id'], f['fmt'], book_data)
+
+    def _find_candidates_by_file_size(self, book_ids):
         candidates_size_map = defaultdict(set)
         formats_count = 0
         for book_id in book_ids:
@@ -275,16 +431,7 @@ class BinaryCompareAlgorithm(IdentifierAlgorithm):
         self.shrink_candidates_map(candidates_size_map)
         if DEBUG:
             prints('Pass 1: %d formats created %d size collisions' % (formats_count, len(candidates_size_map)))
-
-        # Our final pass is to build our result set for this function
-        candidates_map = defaultdict(set)
-        hash_map = self.db.get_all_custom_book_data('find_duplicates', default={})
-        result_hash_map = {}
-        for size, size_group in list(candidates_size_map.items()):
-            for book_id, fmt, mtime in size_group:
-                self._find_candidate_by_hash(book_id, fmt, mtime, size, candidates_map, hash_map, result_hash_map)
-        self.db.add_multiple_custom_book_data('find_duplicates', result_hash_map)
-        return candidates_map
+        return candidates_size_map
 
     def _find_candidate_by_file_size(self, book_id, candidates_map):
         formats = self.db.formats(book_id, index_is_id=True, verify_formats=False)
@@ -306,57 +453,177 @@ class BinaryCompareAlgorithm(IdentifierAlgorithm):
             hash_map[book_id] = {}
         hash_map[book_id][fmt] = book_data
 
-    def _find_candidate_by_hash(self, book_id, fmt, mtime, size, candidates_map, hash_map, result_hash_map):
-        # Work out whether we need to calculate a hash for this file from
-        # book plugin data from a previous run
-        book_data = hash_map.get(book_id, {}).get(fmt, {})
-        if book_data.get('mtime', None) == mtime:
-            sha = book_data.get('sha', None)
-            size = book_data.get('size', None)
-            if sha and size:
-                candidates_map[(sha, size)].add(book_id)
-                self._add_to_hash_map(result_hash_map, book_id, fmt, book_data)
-                return
-        try:
-            format_hash = self.db.format_hash(book_id, fmt)
-            hash_key = (format_hash, size)
-            candidates_map[hash_key].add(book_id)
-            # Store our plugin book data for future repeat scanning
-            book_data['mtime'] = mtime
-            book_data['sha'] = format_hash
-            book_data['size'] = size
-            self._add_to_hash_map(result_hash_map, book_id, fmt, book_data)
-        except:
-            traceback.print_exc()
-
 
 class TitleAuthorAlgorithm(AlgorithmBase):
     '''
     This algorithm is used for all the permutations requiring
-    some evaluation of book titles and an optional author evaluation
+    some evaluation of book titles and an optional author evaluation.
+    The title/author hashes computed for each book are persisted as custom
+    book data so that repeat runs only need to rehash modified books.
     '''
-    def __init__(self, gui, db, book_exemptions_map, title_eval, author_eval):
+    INDEX_NAME = 'find_duplicates_index'
+
+    def __init__(self, gui, db, book_exemptions_map, title_eval, author_eval, index_key=None):
         AlgorithmBase.__init__(self, gui, db, exemptions_map=book_exemptions_map)
         self._title_eval = title_eval
         self._author_eval = author_eval
+        self._index_key = index_key
+
+    def find_candidates(self, book_ids, include_languages=False):
+        '''
+        Override the default implementation so we can reuse the hashes from
+        our index for any book that has not been modified since last hashed.
+        '''
+        if not self._index_key:
+            return AlgorithmBase.find_candidates(self, book_ids, include_languages)
+        last_modified_map = self.db.new_api.all_field_for('last_modified', book_ids, default_value=None)
+        index_map = self.db.get_all_custom_book_data(self.INDEX_NAME, default={})
+
+        # Find the books modified since they were last hashed, which are
+        # the only books we need to load the title and authors for.
+        modified_map = {}
+        for book_id in book_ids:
+            last_modified = last_modified_map.get(book_id, None)
+            last_modified = last_modified.isoformat() if last_modified else None
+            book_data = index_map.get(book_id, {}).get(self._index_key, {})
+            if not last_modified or book_data.get('modified', None) != last_modified:
+                modified_map[book_id] = last_modified
+        self.load_fields(list(modified_map.keys()))
+        if include_languages:
+            self.load_field('languages', book_ids)
+
+        result_index_map = {}
+        candidates_map = defaultdict(set)
+        for book_id in book_ids:
+            book_index = index_map.get(book_id, {})
+            if book_id in modified_map:
+                title_hash, author_hashes = self._get_book_hashes(book_id)
+                book_data = { 'modified': modified_map[book_id], 'title': title_hash, 'authors': author_hashes }
+                book_index[self._index_key] = book_data
+                result_index_map[book_id] = book_index
+            else:
+                book_data = book_index[self._index_key]
+            lang = None
+            if include_languages:
+                lang = self.get_languages(book_id)
+            self._add_book_hashes(book_id, book_data['title'], book_data['authors'], lang, candidates_map)
+        if result_index_map:
+            self.db.add_multiple_custom_book_data(self.INDEX_NAME, result_index_map)
+        if DEBUG:
+            prints('Index: reused hashes for %d books, rehashed %d books' % (
+                        len(book_ids) - len(result_index_map), len(result_index_map)))
+        return candidates_map
+
+    def load_fields(self, book_ids, include_languages=False):
+        AlgorithmBase.load_fields(self, book_ids, include_languages)
+        self.load_field('title', book_ids)
+        if self._author_eval:
+            self.load_field('authors', book_ids)
 
     def find_candidate(self, book_id, candidates_map, include_languages=False):
         lang = None
         if include_languages:
-            lang = self.db.languages(book_id, index_is_id=True)
-        title_hash = self._title_eval(self.db.title(book_id, index_is_id=True), lang)
+            lang = self.get_languages(book_id)
+        title_hash, author_hashes = self._get_book_hashes(book_id)
+        self._add_book_hashes(book_id, title_hash, author_hashes, lang, candidates_map)
+
+    def _get_book_hashes(self, book_id):
+        '''
+        Return the title hash (excluding any language) and a list of the
+        [author_hash, rev_author_hash] pairs for each author of this book
+        '''
+        title_hash = self._title_eval(self.get_field('title', book_id))
+        author_hashes = []
         if self._author_eval:
-            authors = authors_to_list(self.db, book_id)
-            if authors:
-                for author in authors:
-                    author_hash, rev_author_hash = self._author_eval(author)
-                    candidates_map[title_hash+author_hash].add(book_id)
-                    if rev_author_hash and rev_author_hash != author_hash:
-                        candidates_map[title_hash+rev_author_hash].add(book_id)
-                return
+            for author in self.get_authors(book_id):
+                author_hash, rev_author_hash = self._author_eval(author)
+                author_hashes.append([author_hash, rev_author_hash])
+        return title_hash, author_hashes
+
+    def _add_book_hashes(self, book_id, title_hash, author_hashes, lang, candidates_map):
+        if lang:
+            title_hash = lang + title_hash
+        if author_hashes:
+            for author_hash, rev_author_hash in author_hashes:
+                candidates_map[title_hash+author_hash].add(book_id)
+                if rev_author_hash and rev_author_hash != author_hash:
+                    candidates_map[title_hash+rev_author_hash].add(book_id)
+            return
         candidates_map[title_hash].add(book_id)
 
 
+class TitleOverlapAlgorithm(TitleAuthorAlgorithm):
+    '''
+    This algorithm finds books whose titles share most of their words
+    regardless of their order, with an optional author evaluation.
+    Locality sensitive hashing of MinHash signatures gives the candidate
+    pairs of titles, so that only those are compared for their similarity.
+    '''
+    def __init__(self, gui, db, book_exemptions_map, author_eval, threshold):
+        TitleAuthorAlgorithm.__init__(self, gui, db, book_exemptions_map, None, author_eval)
+        self._threshold = threshold
+
+    def find_candidates(self, book_ids, include_languages=False):
+        '''
+        Override the default implementation as books cannot be hashed
+        individually into their groups. Returns a candidates map keyed by
+        the similar title of each book with the books found similar to it.
+        '''
+        self.load_fields(book_ids, include_languages)
+        items = self._get_title_items(book_ids, include_languages)
+
+        similar_map = find_similar_titles([key for key, _book_ids in items], self._threshold)
+        if DEBUG:
+            prints('Overlap: %d distinct titles, %d similar' % (len(items), len(similar_map)))
+
+        candidates_map = defaultdict(set)
+        for idx, (key, item_book_ids) in enumerate(items):
+            group = set(item_book_ids)
+            for similar_idx in similar_map.get(idx, ()):
+                group |= items[similar_idx][1]
+            first_book_id = min(item_book_ids)
+            title_hash = similar_title_match(self.get_field('title', first_book_id))
+            candidates_map['%s%s%d' % (title_hash, key[0], idx)] = group
+        return candidates_map
+
+    def find_candidate(self, book_id, candidates_map, include_languages=False):
+        '''
+        Overlap matching compares the titles of all the books together in
+        find_candidates, so a single book cannot be matched on its own
+        '''
+        raise NotImplementedError('Title overlap matching only works over the whole set of titles')
+
+    def _get_title_items(self, book_ids, include_languages=False):
+        '''
+        Return a list of ((prefix, title_words), book_ids) for these books.
+        Books with the same title words, author and language are identical
+        for our purposes, so each is only compared once.
+        '''
+        items_map = defaultdict(set)
+        for book_id in book_ids:
+            words = get_title_words(self.get_field('title', book_id))
+            if not words:
+                continue
+            prefixes = ['']
+            if self._author_eval:
+                prefixes = self._get_author_prefixes(book_id)
+            if include_languages:
+                lang = self.get_languages(book_id) or ''
+                prefixes = [lang + '|' + prefix for prefix in prefixes]
+            for prefix in prefixes:
+                items_map[(prefix, words)].add(book_id)
+        return list(items_map.items())
+
+    def _get_author_prefixes(self, book_id):
+        prefixes = set()
+        for author in self.get_authors(book_id):
+            author_hash, rev_author_hash = self._author_eval(author)
+            prefixes.add(author_hash)
+            if rev_author_hash:
+                prefixes.add(rev_author_hash)
+        return prefixes or set([''])
+
+
 class AuthorOnlyAlgorithm(AlgorithmBase):
     '''
     This algorithm is used for all the permutations requiring
@@ -370,13 +637,16 @@ class AuthorOnlyAlgorithm(AlgorithmBase):
     def duplicate_search_mode(self):
         return DUPLICATE_SEARCH_FOR_AUTHOR
 
+    def load_fields(self, book_ids, include_languages=False):
+        self.load_field('authors', book_ids)
+
     def find_candidate(self, book_id, candidates_map, include_languages=False):
         '''
         Override the base implementation because it differs in several ways:
         - Our candidates map contains authors per key, not book ids
         - Our exclusions are per author rather than per book
         '''
-        authors = authors_to_list(self.db, book_id)
+        authors = self.get_authors(book_id)
         if not authors:
             # A book with no authors will not be considered
             return
@@ -411,10 +681,13 @@ class AuthorOnlyAlgorithm(AlgorithmBase):
 # --------------------------------------------------------------
 
 
-def create_algorithm(gui, db, search_type, identifier_type, title_match, author_match, bex_map, aex_map):
+def create_algorithm(gui, db, search_type, identifier_type, title_match, author_match, bex_map, aex_map,
+                     use_index=True):
     '''
     Our factory responsible for returning the appropriate algorithm
     based on the permutation of title/author matching desired.
+    Set use_index to False for a database that must not be written to,
+    such as the target of a library comparison.
     Returns a tuple of the algorithm and a summary description
     '''
     if search_type == 'identifier':
@@ -429,9 +702,16 @@ def create_algorithm(gui, db, search_type, identifier_type, title_match, author_
         if title_match == 'ignore':
             return AuthorOnlyAlgorithm(gui, db, aex_map, author_fn), \
                    _('ignore title, {0} author').format(author_match)
+        elif title_match == 'overlap':
+            threshold = matching.title_similarity_threshold
+            return TitleOverlapAlgorithm(gui, db, bex_map, author_fn, threshold), \
+                   _('{0}% overlap title, {1} author').format(threshold, author_match)
         else:
             title_fn = get_title_algorithm_fn(title_match)
-            return TitleAuthorAlgorithm(gui, db, bex_map, title_fn, author_fn), \
+            index_key = None
+            if use_index:
+                index_key = get_match_index_key(title_match, author_match)
+            return TitleAuthorAlgorithm(gui, db, bex_map, title_fn, author_fn, index_key), \
                    _('{0} title, {1} author').format(title_match, author_match)
 
 
@@ -39,6 +39,7 @@ KEY_SORT_GROUPS_TITLE = 'sortGroupsByTitle'
 KEY_SHOW_TAG_AUTHOR = 'showTagAuthor'
 KEY_TITLE_SOUNDEX = 'titleSoundexLength'
 KEY_AUTHOR_SOUNDEX = 'authorSoundexLength'
+KEY_TITLE_THRESHOLD = 'titleOverlapThreshold'
 KEY_PUBLISHER_SOUNDEX = 'publisherSoundexLength'
 KEY_SERIES_SOUNDEX = 'seriesSoundexLength'
 KEY_TAGS_SOUNDEX = 'tagsSoundexLength'
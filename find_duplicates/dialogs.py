@@ -86,6 +86,13 @@ TITLE_DESCS = OrderedDict([
                              'and any words after \'and\', \'or\' or \'aka\' in the title.<br/>'
                              '- Marking a group as exempt will prevent those specific books '
                              'from appearing together in future duplicate book searches.')),
+               ('overlap',  _('<b>Title duplicate search</b><br/>'
+                             '- Find groups of books with an <b>overlapping title</b> and {0}<br/>'
+                             '- Overlapping title matches compare the fragments of the words in each '
+                             'title regardless of their order, punctuation or subtitles, finding '
+                             'titles where at least the threshold percentage of them are shared.<br/>'
+                             '- Marking a group as exempt will prevent those specific books '
+                             'from appearing together in future duplicate book searches.')),
                ('ignore',   _('<b>Author duplicate search</b><br/>'
                              '- Find groups of books <b>ignoring title</b> with {0}<br/>'
                              '- Ignore title searches are best to find variations of author '
@@ -220,6 +227,16 @@ class FindBookDuplicatesDialog(SizePersistedDialog):
         self.title_soundex_spin = QSpinBox()
         self.title_soundex_spin.setRange(1, 99)
         title_match_group_box_layout.addWidget(self.title_soundex_spin, 2, 2, 1, 1, Qt.AlignLeft)
+        self.title_threshold_label = QLabel(_('Threshold:'), self)
+        self.title_threshold_label.setToolTip(_('The lower the threshold, the greater likelihood '
+                                         'of false positives.\n'
+                                         'High threshold values reduce your chances of matches'))
+        overlap_row = list(TITLE_DESCS.keys()).index('overlap')
+        title_match_group_box_layout.addWidget(self.title_threshold_label, overlap_row, 1, 1, 1, Qt.AlignRight)
+        self.title_threshold_spin = QSpinBox()
+        self.title_threshold_spin.setRange(10, 100)
+        self.title_threshold_spin.setSuffix('%')
+        title_match_group_box_layout.addWidget(self.title_threshold_spin, overlap_row, 2, 1, 1, Qt.AlignLeft)
 
         self.author_match_group_box = QGroupBox(_('Author Matching'), self)
         match_layout.addWidget(self.author_match_group_box)
@@ -300,6 +317,7 @@ class FindBookDuplicatesDialog(SizePersistedDialog):
 
         self.title_soundex_spin.setValue(cfg.plugin_prefs.get(cfg.KEY_TITLE_SOUNDEX, 6))
         self.author_soundex_spin.setValue(cfg.plugin_prefs.get(cfg.KEY_AUTHOR_SOUNDEX, 8))
+        self.title_threshold_spin.setValue(cfg.plugin_prefs.get(cfg.KEY_TITLE_THRESHOLD, 60))
 
         show_all_groups = cfg.plugin_prefs.get(cfg.KEY_SHOW_ALL_GROUPS, True)
         self.show_all_button.setChecked(show_all_groups)
@@ -354,8 +372,11 @@ class FindBookDuplicatesDialog(SizePersistedDialog):
         self.title_soundex_spin.setEnabled(enabled)
         self.author_soundex_label.setEnabled(enabled)
         self.author_soundex_spin.setEnabled(enabled)
+        self.title_threshold_label.setEnabled(enabled)
+        self.title_threshold_spin.setEnabled(enabled)
         if enabled:
-            self.title_button_group.button(4).setEnabled(self.author_match != 'ignore')
+            ignore_title_idx = list(TITLE_DESCS.keys()).index('ignore')
+            self.title_button_group.button(ignore_title_idx).setEnabled(self.author_match != 'ignore')
             self.author_button_group.button(4).setEnabled(self.title_match != 'ignore')
             # Do not allow a combination of Ignore Title, Identical Author
             ident_auth_btn = self.author_button_group.button(0)
@@ -381,6 +402,7 @@ class FindBookDuplicatesDialog(SizePersistedDialog):
         cfg.plugin_prefs[cfg.KEY_SHOW_TAG_AUTHOR] = show_tag_author
         cfg.plugin_prefs[cfg.KEY_TITLE_SOUNDEX] = int(str(self.title_soundex_spin.value()))
         cfg.plugin_prefs[cfg.KEY_AUTHOR_SOUNDEX] = int(str(self.author_soundex_spin.value()))
+        cfg.plugin_prefs[cfg.KEY_TITLE_THRESHOLD] = int(str(self.title_threshold_spin.value()))
         cfg.plugin_prefs[cfg.KEY_INCLUDE_LANGUAGES] = self.include_languages_checkbox.isChecked()
         cfg.plugin_prefs[cfg.KEY_AUTO_DELETE_BINARY_DUPS] = self.auto_delete_binary_dups_checkbox.isChecked()
         self.accept()
@@ -1186,6 +1208,9 @@ class FindLibraryDuplicatesDialog(SizePersistedDialog):
         self.identifier_type = cfg.plugin_prefs.get(cfg.KEY_IDENTIFIER_TYPE, 'isbn')
         self.identifier_combo.populate_combo(self.identifier_type)
         self.title_match = cfg.plugin_prefs.get(cfg.KEY_TITLE_MATCH, 'identical')
+        if self.title_match not in LIBRARY_TITLE_DESCS:
+            # Overlapping titles can only be found within a library
+            self.title_match = 'identical'
         self.author_match  = cfg.plugin_prefs.get(cfg.KEY_AUTHOR_MATCH, 'identical')
         search_type_idx = SEARCH_TYPES.index(self.search_type)
         self.search_type_button_group.button(search_type_idx).setChecked(True)
@@ -4,6 +4,7 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake'
 
 from collections import defaultdict, deque, OrderedDict
+from functools import partial
 
 try:
     from qt.core import QApplication, Qt
@@ -22,8 +23,11 @@ import calibre_plugins.find_duplicates.config as cfg
 from calibre_plugins.find_duplicates.book_algorithms import (create_algorithm,
                     DUPLICATE_SEARCH_FOR_BOOK, DUPLICATE_SEARCH_FOR_AUTHOR)
 from calibre_plugins.find_duplicates.dialogs import SummaryMessageBox
-from calibre_plugins.find_duplicates.matching import (authors_to_list, get_field_pairs,
-                            set_title_soundex_length, set_author_soundex_length)
+from calibre_plugins.find_duplicates.jobs import find_files_to_fully_hash
+from calibre_plugins.find_duplicates.matching import (authors_to_list, build_exemption_graph, get_field_pairs,
+                            get_match_index_key, set_title_soundex_length, set_author_soundex_length,
+                            set_title_similarity_threshold)
+from calibre_plugins.find_duplicates.signatures import LibrarySignatures
 
 
 try:
@@ -48,14 +52,19 @@ class ExemptionMap(defaultdict):
                 self[member].append(group_set)
         # Retain our original list or lists for persistence purposes
         self.exemptions_list = exemptions_list
+        self._exemption_graph = None
+
+    def get_exemption_graph(self):
+        '''
+        Return a dictionary of each member to the exemption groups containing it,
+        built only once rather than for every lookup
+        '''
+        if self._exemption_graph is None:
+            self._exemption_graph = build_exemption_graph(self.exemptions_list)
+        return self._exemption_graph
 
     def merge_sets(self, key):
-        list_of_sets = self.get(key, [])
-        if len(list_of_sets) == 0:
-            return set()
-        if len(list_of_sets) == 1:
-            return list_of_sets[0] - set([key])
-        return set().union(*list_of_sets) - set([key])
+        return set().union(*self.get_exemption_graph().get(key, ())) - set([key])
 
 class FinderBase(object):
 
@@ -138,6 +147,7 @@ class DuplicateFinder(FinderBase):
         self._book_exemptions_map = ExemptionMap(book_exemptions)
         self._author_exemptions_map = ExemptionMap(author_exemptions)
         self._is_showing_duplicate_exemptions = False
+        self.binary_compare_job = None
         self._books_for_group_map = None
         self._groups_for_book_map = None
         self.clear_duplicates_mode()
@@ -165,10 +175,18 @@ class DuplicateFinder(FinderBase):
         self._current_group_id = None
         self.clear_gui_duplicates_mode(clear_search, reapply_restriction, restore_sort)
 
-    def run_book_duplicates_check(self):
+    def run_book_duplicates_check(self, completed_fn=None):
         '''
         Execute a duplicates search using the specified algorithm and display results
+        For binary compare searches the results are displayed when the background
+        job has hashed the files, so completed_fn is called once that is done.
         '''
+        if self.is_binary_compare_running():
+            info_dialog(self.gui, _('Find Duplicates'),
+                _('A binary compare is already running in the background. '
+                  'Please wait for it to complete or stop the job.'),
+                show=True, show_copy_button=False)
+            return
         if not self.is_showing_duplicate_exemptions() and not self.has_results():
             # We are in a safe state to preserve the users current restriction/highlighting
             self.persist_gui_state()
@@ -183,6 +201,7 @@ class DuplicateFinder(FinderBase):
         author_soundex_length = cfg.plugin_prefs.get(cfg.KEY_AUTHOR_SOUNDEX, 8)
         set_title_soundex_length(title_soundex_length)
         set_author_soundex_length(author_soundex_length)
+        set_title_similarity_threshold(cfg.plugin_prefs.get(cfg.KEY_TITLE_THRESHOLD, 60))
         include_languages = cfg.plugin_prefs.get(cfg.KEY_INCLUDE_LANGUAGES, False)
         self._is_show_all_duplicates_mode = cfg.plugin_prefs.get(cfg.KEY_SHOW_ALL_GROUPS, True)
         auto_delete_binary_dups = cfg.plugin_prefs.get(cfg.KEY_AUTO_DELETE_BINARY_DUPS, False)
@@ -192,13 +211,37 @@ class DuplicateFinder(FinderBase):
                         self._book_exemptions_map, self._author_exemptions_map)
         self._duplicate_search_mode = algorithm.duplicate_search_mode()
 
+        if search_type == 'binary':
+            # Hashing the files is done as a background job, with the results
+            # displayed when it completes
+            self.binary_compare_job = algorithm.run_duplicate_check_job(sort_groups_by_title,
+                    partial(self._binary_compare_completed, auto_delete_binary_dups, completed_fn))
+            return
 
         bfg_map, gfb_map = algorithm.run_duplicate_check(sort_groups_by_title, include_languages)
-        
-        if search_type == 'binary' and auto_delete_binary_dups:
+        self._display_run_duplicate_results(bfg_map, gfb_map)
+        if completed_fn:
+            completed_fn()
+
+    def is_binary_compare_running(self):
+        job = self.binary_compare_job
+        return job is not None and not job.is_finished
+
+    def _binary_compare_completed(self, auto_delete_binary_dups, completed_fn, results):
+        '''
+        Invoked when the background job for a binary compare search has completed
+        '''
+        self.binary_compare_job = None
+        if results is None:
+            # The job failed, was stopped by the user or the library was switched
+            return
+        bfg_map, gfb_map = results
+        if auto_delete_binary_dups:
             self._delete_binary_duplicate_formats(bfg_map)
 
         self._display_run_duplicate_results(bfg_map, gfb_map)
+        if completed_fn:
+            completed_fn()
 
     def _display_run_duplicate_results(self, books_for_group_map, groups_for_book_map):
         '''
@@ -609,18 +652,17 @@ class DuplicateFinder(FinderBase):
 
     def _get_authors_for_books(self, book_ids):
         authors = set()
-        for book_id in book_ids:
-            coauthors = authors_to_list(self.db, book_id)
+        for coauthors in self.db.new_api.all_field_for('authors', book_ids).values():
             for author in coauthors:
-                authors.add(author)
+                authors.add(author.strip())
         return authors
 
     def _create_books_for_author_map(self):
         books_for_author_map = defaultdict(set)
-        for book_id in self.db.all_ids():
-            coauthors = authors_to_list(self.db, book_id)
+        all_authors = self.db.new_api.all_field_for('authors', self.db.new_api.all_book_ids())
+        for book_id, coauthors in all_authors.items():
             for author in coauthors:
-                books_for_author_map[author].add(book_id)
+                books_for_author_map[author.strip()].add(book_id)
         # Use this opportunity to purge any author exemptions that we do not have books for
         deleted_authors = []
         for author in list(self._author_exemptions_map.keys()):
@@ -782,7 +824,7 @@ class DuplicateFinder(FinderBase):
                     if fmt not in other_book_map:
                         continue
                     other_info = other_book_map[fmt]
-                    if info['size'] == other_info['size'] and info['sha'] == other_info['sha']:
+                    if info.get('sha', None) and info['size'] == other_info['size'] and info['sha'] == other_info.get('sha', None):
                         if DEBUG:
                             prints('Removing duplicate format: %s from book: %d'%(fmt, other_book_id))
                         self.db.remove_format(other_book_id, fmt, index_is_id=True, notify=False)
@@ -925,9 +967,10 @@ class CrossLibraryDuplicateFinder(FinderBase):
         # We will just look at an author by author basis, rather than by book id
         # However in order to display the books affected afterwards, we need to keep track of them.
         book_ids = algorithm.get_book_ids_to_consider()
+        algorithm.load_fields(book_ids)
         author_books_map = defaultdict(set)
         for book_id in book_ids:
-            book_authors = authors_to_list(self.db, book_id)
+            book_authors = algorithm.get_authors(book_id)
             for author in book_authors:
                 author_books_map[author].add(book_id)
 
@@ -966,7 +1009,7 @@ class CrossLibraryDuplicateFinder(FinderBase):
         def get_format(results_hash_map, book_id):
             book_format = ''
             for fmt, book_data in list(results_hash_map[book_id].items()):
-                if book_data['sha'] == k[0] and book_data['size'] == k[1]:
+                if book_data.get('sha', None) == k[0] and book_data['size'] == k[1]:
                     book_format = fmt
                     break
             return book_format
@@ -992,22 +1035,30 @@ class CrossLibraryDuplicateFinder(FinderBase):
         target_candidates_size_map = shrink_map(target_candidates_size_map, local_candidates_size_map)
         local_candidates_size_map = shrink_map(local_candidates_size_map, target_candidates_size_map)
 
-        # Next compute file hashes for the target database candidates
+        # Next hash the start and end of the files of each size in both databases,
+        # then fully hash only those whose partial hash is also in the other database
         target_hash_map = self.target_db.get_all_custom_book_data('find_duplicates', default={})
+        local_hash_map = self.db.get_all_custom_book_data('find_duplicates', default={})
+        target_size_groups = dict(target_algorithm._get_size_groups(target_candidates_size_map, target_hash_map))
+        local_size_groups = dict(algorithm._get_size_groups(local_candidates_size_map, local_hash_map))
         target_result_hash_map = {}
         target_candidates_map = defaultdict(set)
-        for size, size_group in list(target_candidates_size_map.items()):
-            for book_id, fmt, mtime in size_group:
-                target_algorithm._find_candidate_by_hash(book_id, fmt, mtime, size, target_candidates_map, target_hash_map, target_result_hash_map)
-        self.target_db.add_multiple_custom_book_data('find_duplicates', target_result_hash_map)
-
-        # Now compute file hashes the current database candidates (just to get the hashes)
-        local_hash_map = self.db.get_all_custom_book_data('find_duplicates', default={})
         local_result_hash_map = {}
         local_candidates_map = defaultdict(set)
-        for size, size_group in list(local_candidates_size_map.items()):
-            for book_id, fmt, mtime in size_group:
-                algorithm._find_candidate_by_hash(book_id, fmt, mtime, size, local_candidates_map, local_hash_map, local_result_hash_map)
+        for size, target_files in list(target_size_groups.items()):
+            local_files = local_size_groups[size]
+            target_algorithm.add_partial_hashes(target_files)
+            algorithm.add_partial_hashes(local_files)
+            partials = set(f['partial'] for f in target_files) & set(f['partial'] for f in local_files)
+            partials.discard(None)
+            target_files_to_hash = [f for f in target_files if f['partial'] in partials]
+            local_files_to_hash = [f for f in local_files if f['partial'] in partials]
+            file_ids_to_hash = set(id(f) for f in find_files_to_fully_hash(target_files_to_hash + local_files_to_hash))
+            target_algorithm.add_full_hashes([f for f in target_files_to_hash if id(f) in file_ids_to_hash])
+            algorithm.add_full_hashes([f for f in local_files_to_hash if id(f) in file_ids_to_hash])
+            target_algorithm._find_candidates_by_hash(target_files, target_candidates_map, target_result_hash_map)
+            algorithm._find_candidates_by_hash(local_files, local_candidates_map, local_result_hash_map)
+        self.target_db.add_multiple_custom_book_data('find_duplicates', target_result_hash_map)
         self.db.add_multiple_custom_book_data('find_duplicates', local_result_hash_map)
 
         # Now we have all the raw data we need. The local_candidates_map contains
@@ -1043,41 +1094,58 @@ class CrossLibraryDuplicateFinder(FinderBase):
 
     def _do_title_author_identifier_comparison(self, algorithm):
         self.gui.status_bar.showMessage(_('Analysing duplicates in target database')+'...', 0)
-        target_candidates_map, author_bookids_map_unused = self._analyse_target_database()
+        target_signatures = self._analyse_target_signatures()
 
         # Use the standard approach to get current library book ids for consideration
         book_ids = algorithm.get_book_ids_to_consider()
         include_identifier = self.search_type == 'identifier'
-        duplicate_book_ids = []
 
-        marked_ids = {}
         self.gui.status_bar.showMessage(_('Analysing duplicates in current database')+'...', 0)
-        # Iterate through these books getting our hashes
-        for book_id in book_ids:
-            # We will create a temporary candidates map for each book, since we are
-            # not interested in hashing the current library's books together. And we
-            # can't give it the map from the target database, because we won't know
-            # which database each group's ids belong to!
-            book_candidates_map = defaultdict(set)
-            algorithm.find_candidate(book_id, book_candidates_map, self.include_languages)
-            # We now have any hash(s) for the current book in our candidates map.
-            # See if we have them in our target library map too to indicate a duplicate
-            duplicate_books = set()
-            for book_hash in book_candidates_map:
-                if book_hash in target_candidates_map:
-                    duplicate_books |= target_candidates_map[book_hash]
-            if len(duplicate_books) > 0:
-                duplicate_book_ids.append(book_id)
-                self.log('Book in this library: %s'%self._get_book_display_info(self.db, book_id, include_identifier=include_identifier))
-                dups = [self._get_book_display_info(self.target_db, dup_book_id)
-                        for dup_book_id in duplicate_books]
-                for dup_text in sorted(dups):
-                    self.log('   Target library: %s'%dup_text)
-                self.log('')
+        # We are not interested in the current library's books being grouped
+        # together, so each candidate key is simply probed against the target
+        # library signatures to find the duplicates of the books sharing it.
+        candidates_map = algorithm.find_candidates(book_ids, self.include_languages)
+        duplicates_map = defaultdict(set)
+        for book_hash, local_book_ids in candidates_map.items():
+            target_book_ids = target_signatures.get_book_ids(book_hash)
+            if target_book_ids:
+                for book_id in local_book_ids:
+                    duplicates_map[book_id] |= target_book_ids
+
+        # Report in the same order as the books are displayed
+        duplicate_book_ids = [book_id for book_id in book_ids if book_id in duplicates_map]
+        for book_id in duplicate_book_ids:
+            self.log('Book in this library: %s'%self._get_book_display_info(self.db, book_id, include_identifier=include_identifier))
+            dups = [self._get_book_display_info(self.target_db, dup_book_id)
+                    for dup_book_id in duplicates_map[book_id]]
+            for dup_text in sorted(dups):
+                self.log('   Target library: %s'%dup_text)
+            self.log('')
 
         msg = _('Found <b>{0} books</b> with potential duplicates using <b>{1}</b> against the library at: {2}').format(len(duplicate_book_ids), self.algorithm_text, self.library_path)
         return len(duplicate_book_ids), duplicate_book_ids, msg
 
+    def _analyse_target_signatures(self):
+        '''
+        Get the candidate keys of every book in the target database from the
+        signatures file stored in the target library, rehashing only those
+        books modified since the signatures were last updated.
+        '''
+        # The target database is opened read only, so no index can be stored in it
+        algorithm, self.algorithm_text = create_algorithm(self.gui, self.target_db,
+                        self.search_type, self.identifier_type,
+                        self.title_match, self.author_match, None, None, use_index=False)
+        if self.search_type == 'identifier':
+            signature_key = 'identifier_%s' % self.identifier_type
+        else:
+            signature_key = get_match_index_key(self.title_match, self.author_match)
+        if self.include_languages:
+            signature_key += '_lang'
+        target_signatures = LibrarySignatures(self.library_path, signature_key)
+        book_ids = self._get_target_db_book_ids(self.search_type)
+        target_signatures.update(self.target_db, algorithm, book_ids, self.include_languages)
+        return target_signatures
+
     def _analyse_target_database(self):
         '''
         Get the candidates using algorithm against the target database.
@@ -1087,9 +1155,10 @@ class CrossLibraryDuplicateFinder(FinderBase):
         (c) we do *not* want to shrink the candidates map as we must use it to
             "add" candidates from *this* database too.
         '''
+        # The target database is opened read only, so no index can be stored in it
         algorithm, self.algorithm_text = create_algorithm(self.gui, self.target_db,
                         self.search_type, self.identifier_type,
-                        self.title_match, self.author_match, None, None)
+                        self.title_match, self.author_match, None, None, use_index=False)
 
         book_ids = self._get_target_db_book_ids(self.search_type)
         target_candidates_map = algorithm.find_candidates(book_ids, self.include_languages)
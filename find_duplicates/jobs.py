@@ -0,0 +1,184 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import hashlib, os, traceback
+from collections import defaultdict
+
+from calibre.utils.ipc.server import Server
+from calibre.utils.ipc.job import ParallelJob
+
+# Number of bytes to read at a time when hashing a book format file
+HASH_CHUNK_SIZE = 1024 * 1024
+# Number of bytes from the start and end of a file included in its partial hash
+PARTIAL_HASH_SIZE = 64 * 1024
+# Upper limit on the number of files hashed by a single child job
+MAX_FILES_PER_JOB = 100
+
+
+def get_partial_hash(path, size):
+    '''
+    Return the sha256 hash of the first and last PARTIAL_HASH_SIZE bytes of
+    the file. For files small enough to be read entirely this is identical
+    to the hash of the whole file.
+    '''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if size <= PARTIAL_HASH_SIZE * 2:
+            sha.update(f.read())
+        else:
+            sha.update(f.read(PARTIAL_HASH_SIZE))
+            f.seek(-PARTIAL_HASH_SIZE, os.SEEK_END)
+            sha.update(f.read(PARTIAL_HASH_SIZE))
+    return sha.hexdigest()
+
+
+def get_file_hash(path):
+    '''
+    Return the sha256 hash of the whole file, identical to db.format_hash()
+    '''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            raw = f.read(HASH_CHUNK_SIZE)
+            if not raw:
+                break
+            sha.update(raw)
+    return sha.hexdigest()
+
+
+def find_files_to_fully_hash(files):
+    '''
+    Given the files for a size collision group, return those sharing their
+    partial hash with another file which do not yet have a full hash. Files
+    small enough for their partial hash to cover the whole file are given it
+    as their full hash instead.
+    '''
+    partial_map = defaultdict(list)
+    for f in files:
+        if f['partial']:
+            partial_map[f['partial']].append(f)
+    files_to_hash = []
+    for partial_group in partial_map.values():
+        if len(partial_group) < 2:
+            continue
+        for f in partial_group:
+            if f['sha']:
+                continue
+            if f['size'] <= PARTIAL_HASH_SIZE * 2:
+                f['sha'] = f['partial']
+            else:
+                files_to_hash.append(f)
+    return files_to_hash
+
+
+def do_hash_formats(size_groups, cpus, notification=lambda x, y:x):
+    '''
+    Master job, to launch child jobs to hash the format files of books
+    which share an identical file size with another book format.
+      size_groups - list of (size, files) tuples where files is a list of
+                    dictionaries for each book format, containing any partial
+                    or full hash from a previous run
+    Returns the size_groups with the partial and full hashes populated.
+    '''
+    server = Server(pool_size=cpus)
+    try:
+        # Our first pass hashes just the start and end of every file that
+        # does not have a partial hash from a previous run
+        files = [f for _size, size_files in size_groups for f in size_files
+                 if not f['partial'] and f['path']]
+        results = _run_hash_jobs(server, files, 'do_partial_hash_files', cpus,
+                                 notification, 'Partial hashing book files')
+        for f in files:
+            f['partial'] = results.get((f['book_id'], f['fmt']), None)
+
+        # Our second pass fully hashes only those files with a partial hash collision
+        files = []
+        for _size, size_files in size_groups:
+            files.extend(f for f in find_files_to_fully_hash(size_files) if f['path'])
+        results = _run_hash_jobs(server, files, 'do_hash_files', cpus,
+                                 notification, 'Hashing book files')
+        for f in files:
+            f['sha'] = results.get((f['book_id'], f['fmt']), None)
+    finally:
+        server.close()
+    return size_groups
+
+
+def _run_hash_jobs(server, files, func_name, cpus, notification, message):
+    '''
+    Queue child jobs to hash these files and wait for them all to complete,
+    returning a dictionary of the hash for each (book_id, fmt) key.
+    '''
+    results = {}
+    if not files:
+        return results
+    batches = _split_files(files, cpus)
+    for i, batch in enumerate(batches):
+        args = ['calibre_plugins.find_duplicates.jobs', func_name,
+                ([(f['book_id'], f['fmt'], f['path'], f['size']) for f in batch],)]
+        job = ParallelJob('arbitrary', str(i), done=None, args=args)
+        job._file_count = len(batch)
+        server.add_job(job)
+
+    # This server is an arbitrary_n job, so there is a notifier available.
+    # Set the % complete to a small number to avoid the 'unavailable' indicator
+    notification(0.01, message)
+
+    # dequeue the job results as they arrive, saving the results
+    total = len(files)
+    count = 0
+    jobs_remaining = len(batches)
+    while jobs_remaining > 0:
+        job = server.changed_jobs_queue.get()
+        # A job can 'change' when it is not finished, for example if it
+        # produces a notification. Ignore these.
+        job.update()
+        if not job.is_finished:
+            continue
+        jobs_remaining -= 1
+        count += job._file_count
+        if job.result:
+            for book_id, fmt, file_hash in job.result:
+                results[(book_id, fmt)] = file_hash
+        print(job.details)
+        notification(float(count) / total, '%s: %d of %d' % (message, count, total))
+    return results
+
+
+def do_partial_hash_files(files):
+    '''
+    Child job, to compute the partial hash of each of these format files
+    '''
+    results = []
+    for book_id, fmt, path, size in files:
+        try:
+            results.append((book_id, fmt, get_partial_hash(path, size)))
+        except:
+            print('Failed to hash format %s for book %d: %s' % (fmt, book_id, path))
+            traceback.print_exc()
+    return results
+
+
+def do_hash_files(files):
+    '''
+    Child job, to compute the full hash of each of these format files
+    '''
+    results = []
+    for book_id, fmt, path, _size in files:
+        try:
+            results.append((book_id, fmt, get_file_hash(path)))
+        except:
+            print('Failed to hash format %s for book %d: %s' % (fmt, book_id, path))
+            traceback.print_exc()
+    return results
+
+
+def _split_files(files, cpus):
+    '''
+    Split the files into batches for each child job, small enough that
+    the work is spread across all the worker processes.
+    '''
+    batch_size = max(1, min(MAX_FILES_PER_JOB, len(files) // (max(cpus, 1) * 4)))
+    return [files[i:i+batch_size] for i in range(0, len(files), batch_size)]
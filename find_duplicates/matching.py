@@ -3,7 +3,9 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake'
 
-import re
+import re, zlib
+from bisect import bisect_right
+from collections import defaultdict
 from calibre import prints
 from calibre.utils.config import tweaks
 from calibre.utils.localization import get_udc
@@ -13,11 +15,52 @@ author_soundex_length = 8
 publisher_soundex_length = 6
 series_soundex_length = 6
 tags_soundex_length = 4
+title_similarity_threshold = 60
 
 ignore_author_words = ['von', 'van', 'jr', 'sr', 'i', 'ii', 'iii', 'second', 'third',
                        'md', 'phd']
 IGNORE_AUTHOR_WORDS_MAP = dict((k,True) for k in ignore_author_words)
 
+IGNORE_SERIES_WORDS = frozenset(['the', 'a', 'and'])
+IGNORE_PUBLISHER_WORDS = frozenset(['the', 'inc', 'ltd', 'limited', 'llc', 'co', 'pty',
+                                    'usa', 'uk'])
+IGNORE_TAG_WORDS = frozenset(['the', 'and', 'a'])
+
+# Patterns are compiled once here rather than on every call, since the
+# matching functions are invoked for every book/item being analysed.
+SUBTITLE_PAT = re.compile(r'([\(\[\{].*?[\)\]\}]|[/:\\].*$)')
+TITLE_PATTERNS = [(re.compile(pat, re.IGNORECASE), repl) for pat, repl in
+    [
+        # Remove things like: (2010) (Omnibus) etc.
+        (r'(?i)[({\[](\d{4}|omnibus|anthology|hardcover|paperback|mass\s*market|edition|ed\.)[\])}]', ''),
+        # Remove any strings that contain the substring edition inside
+        # parentheses
+        (r'(?i)[({\[].*?(edition|ed.).*?[\]})]', ''),
+        # Remove commas used a separators in numbers
+        (r'(\d+),(\d+)', r'\1\2'),
+        # Remove hyphens only if they have whitespace before them
+        (r'(\s-)', ' '),
+        # Remove single quotes not followed by 's'
+        (r"'(?!s)", ''),
+        # Replace other special chars with a space
+        (r'''[:,;+!@#$%^&*(){}.`~"\s\[\]/]''', ' ')
+    ]]
+COMMA_NO_SPACE_PAT = re.compile(r',([^\s])')
+
+# Translation tables applied to whole values or individual tokens in a single
+# pass, replacing the equivalent character class regular expressions.
+SEPARATOR_CHARS_TABLE = dict((ord(c), ' ') for c in '-+.:;')
+AUTHOR_REMOVE_CHARS_TABLE = dict((ord(c), None) for c in ',!@#$%^&*(){}`~"[]/')
+REMOVE_CHARS_TABLE = dict((ord(c), None) for c in ',!@#$%^&*(){}`~\'"[]/')
+
+# Cache of fuzzy title patterns, keyed by the title_sort_articles tweak they were built with
+_fuzzy_title_patterns_cache = {}
+
+# Memoised results of decoding non-ascii text, which is relatively expensive
+# and called repeatedly for the same author/series/publisher/tag names.
+MAX_DECODE_CACHE_SIZE = 100000
+_decode_cache = {}
+
 def ids_for_field(db, ids_of_books, field_name):
 	# First get all the names for the desired books.
 	# Use a set to make them unique
@@ -71,6 +114,26 @@ def set_tags_soundex_length(tags_len):
     global tags_soundex_length
     tags_soundex_length = tags_len
 
+def set_title_similarity_threshold(threshold):
+    global title_similarity_threshold
+    title_similarity_threshold = threshold
+
+def get_match_index_key(title_match, author_match):
+    '''
+    Return a key identifying the hashes produced by this title/author match
+    combination, taking into account the soundex lengths and articles tweak,
+    so that hashes persisted from a previous run are only reused when valid.
+    '''
+    key = '%s_%s' % (title_match, author_match)
+    if title_match == 'soundex':
+        key += '_t%d' % title_soundex_length
+    if author_match == 'soundex':
+        key += '_a%d' % author_soundex_length
+    if title_match in ['similar', 'soundex']:
+        articles = tweaks.get('title_sort_articles', '')
+        key += '_%08x' % (zlib.crc32(articles.encode('utf-8')) & 0xffffffff)
+    return key
+
 
 def authors_to_list(db, book_id):
     authors = db.authors(book_id, index_is_id=True)
@@ -78,16 +141,48 @@ def authors_to_list(db, book_id):
         return [a.strip().replace('|',',') for a in authors.split(',')]
     return []
 
-def fuzzy_it(text, patterns=None):
-    fuzzy_title_patterns = [(re.compile(pat, re.IGNORECASE), repl) for pat, repl in
+def reset_match_caches():
+    '''
+    Discard all cached patterns and decoded text, such as when the
+    title_sort_articles tweak may have been changed.
+    '''
+    _fuzzy_title_patterns_cache.clear()
+    _decode_cache.clear()
+
+def decode_text(text):
+    '''
+    Memoised equivalent of get_udc().decode(text)
+    '''
+    try:
+        return _decode_cache[text]
+    except KeyError:
+        pass
+    if len(_decode_cache) >= MAX_DECODE_CACHE_SIZE:
+        _decode_cache.clear()
+    result = _decode_cache[text] = get_udc().decode(text)
+    return result
+
+def get_fuzzy_title_patterns():
+    '''
+    Return the compiled patterns used by fuzzy_it, built only once
+    for the current title_sort_articles tweak value.
+    '''
+    articles = tweaks.get('title_sort_articles', r'^(a|the|an)\s+')
+    patterns = _fuzzy_title_patterns_cache.get(articles, None)
+    if patterns is None:
+        patterns = [(re.compile(pat, re.IGNORECASE), repl) for pat, repl in
                 [
                     (r'[\[\](){}<>\'";,:#]', ''),
-                    (tweaks.get('title_sort_articles', r'^(a|the|an)\s+'), ''),
+                    (articles, ''),
                     (r'[-._]', ' '),
                     (r'\s+', ' ')
                 ]]
+        _fuzzy_title_patterns_cache[articles] = patterns
+    return patterns
+
+def fuzzy_it(text, patterns=None):
     if not patterns:
-        patterns = fuzzy_title_patterns
+        patterns = get_fuzzy_title_patterns()
     text = text.strip().lower()
     for pat, repl in patterns:
         text = pat.sub(repl, text)
@@ -140,32 +235,15 @@ def get_title_tokens(title, strip_subtitle=True, decode_non_ascii=True):
     if title:
         # strip sub-titles
         if strip_subtitle:
-            subtitle = re.compile(r'([\(\[\{].*?[\)\]\}]|[/:\\].*$)')
-            if len(subtitle.sub('', title)) > 1:
-                title = subtitle.sub('', title)
-
-        title_patterns = [(re.compile(pat, re.IGNORECASE), repl) for pat, repl in
-        [
-            # Remove things like: (2010) (Omnibus) etc.
-            (r'(?i)[({\[](\d{4}|omnibus|anthology|hardcover|paperback|mass\s*market|edition|ed\.)[\])}]', ''),
-            # Remove any strings that contain the substring edition inside
-            # parentheses
-            (r'(?i)[({\[].*?(edition|ed.).*?[\]})]', ''),
-            # Remove commas used a separators in numbers
-            (r'(\d+),(\d+)', r'\1\2'),
-            # Remove hyphens only if they have whitespace before them
-            (r'(\s-)', ' '),
-            # Remove single quotes not followed by 's'
-            (r"'(?!s)", ''),
-            # Replace other special chars with a space
-            (r'''[:,;+!@#$%^&*(){}.`~"\s\[\]/]''', ' ')
-        ]]
-
-        for pat, repl in title_patterns:
+            stripped_title = SUBTITLE_PAT.sub('', title)
+            if len(stripped_title) > 1:
+                title = stripped_title
+
+        for pat, repl in TITLE_PATTERNS:
             title = pat.sub(repl, title)
 
         if decode_non_ascii:
-            title = get_udc().decode(title)
+            title = decode_text(title)
         tokens = title.split()
         for token in tokens:
             token = token.strip()
@@ -178,7 +256,7 @@ def identical_title_match(title, lang=None):
     return title.lower()
 
 def similar_title_match(title, lang=None):
-    title = get_udc().decode(title)
+    title = decode_text(title)
     result = fuzzy_it(title)
     if lang:
         return lang + result
@@ -205,6 +283,134 @@ def fuzzy_title_match(title, lang=None):
     return result
 
 
+# --------------------------------------------------------------
+#           Title Similarity Functions
+#
+#  Used by the "overlap" title match, which compares the shingles
+#  (three letter fragments of each word) of titles to find those
+#  with a Jaccard similarity above a threshold. MinHash signatures
+#  are banded for locality sensitive hashing, so that only titles
+#  likely to be similar are ever compared with each other.
+# --------------------------------------------------------------
+
+# Number of hash functions in each MinHash signature
+MINHASH_PERMUTATIONS = 48
+MINHASH_PRIME = 1073741789
+_minhash_coefficients = None
+# Cache of the shingles and MinHash signature of each word, since far
+# fewer distinct words exist than there are occurrences of them in titles
+_word_shingles_cache = {}
+MAX_WORD_CACHE_SIZE = 200000
+
+def get_title_words(title):
+    '''
+    Return the set of words in a title to compare. Word order, punctuation
+    and the articles 'a' and 'the' are ignored, including within subtitles.
+    '''
+    return frozenset(get_title_tokens(title, strip_subtitle=False))
+
+def get_word_shingles(word):
+    '''
+    Return a tuple of the set of shingles for the word, and the MinHash
+    signature of those shingles for the MINHASH_PERMUTATIONS hash functions.
+    '''
+    try:
+        return _word_shingles_cache[word]
+    except KeyError:
+        pass
+    global _minhash_coefficients
+    if _minhash_coefficients is None:
+        import random
+        rnd = random.Random(1)
+        _minhash_coefficients = [(rnd.randrange(1, MINHASH_PRIME), rnd.randrange(0, MINHASH_PRIME))
+                                 for i in range(MINHASH_PERMUTATIONS)]
+    if len(_word_shingles_cache) >= MAX_WORD_CACHE_SIZE:
+        _word_shingles_cache.clear()
+    padded = ' %s ' % word
+    shingles = frozenset(padded[i:i+3] for i in range(len(padded) - 2))
+    hashes = [zlib.crc32(shingle.encode('utf-8')) for shingle in shingles]
+    signature = tuple(min((a * h + b) % MINHASH_PRIME for h in hashes)
+                      for a, b in _minhash_coefficients)
+    result = _word_shingles_cache[word] = (shingles, signature)
+    return result
+
+def get_words_shingles(words):
+    return frozenset().union(*[get_word_shingles(word)[0] for word in words])
+
+def get_words_signature(words):
+    '''
+    Return the MinHash signature of the shingles of all these words, being
+    the minimum of the signatures of each word for every hash function.
+    '''
+    if not words:
+        return None
+    return tuple(map(min, zip(*[get_word_shingles(word)[1] for word in words])))
+
+def get_lsh_bands(threshold):
+    '''
+    Return the (bands, rows) dividing a MinHash signature such that titles
+    with a Jaccard similarity around the threshold percentage are as
+    likely to share a band as not, being (1/bands)^(1/rows).
+    '''
+    threshold = threshold / 100.0
+    best = None
+    for rows in range(1, MINHASH_PERMUTATIONS + 1):
+        bands = MINHASH_PERMUTATIONS // rows
+        error = abs((1.0 / bands) ** (1.0 / rows) - threshold)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+def get_lsh_band_keys(signature, bands, rows):
+    '''
+    Return the key of each band of the signature
+    '''
+    return [(i,) + signature[i*rows:(i+1)*rows] for i in range(bands)]
+
+def jaccard_similarity(shingles1, shingles2):
+    if not shingles1 or not shingles2:
+        return 0.0
+    return len(shingles1 & shingles2) / len(shingles1 | shingles2)
+
+def find_similar_titles(items, threshold):
+    '''
+    Given a list of (prefix, words) tuples, return a dictionary of the
+    index of each item to the set of indexes of the items with the same
+    prefix whose shingles have a Jaccard similarity of at least the
+    threshold percentage. Only items sharing a band of their MinHash
+    signatures are compared, rather than every item with every other.
+    '''
+    bands, rows = get_lsh_bands(threshold)
+    buckets = defaultdict(list)
+    for idx, (prefix, words) in enumerate(items):
+        signature = get_words_signature(words)
+        if signature is None:
+            continue
+        for band_key in get_lsh_band_keys(signature, bands, rows):
+            buckets[(prefix,) + band_key].append(idx)
+
+    threshold = threshold / 100.0
+    shingles_map = {}
+    def get_shingles(idx):
+        shingles = shingles_map.get(idx, None)
+        if shingles is None:
+            shingles = shingles_map[idx] = get_words_shingles(items[idx][1])
+        return shingles
+
+    similar_map = defaultdict(set)
+    compared = set()
+    for bucket in buckets.values():
+        for i, idx1 in enumerate(bucket):
+            for idx2 in bucket[i+1:]:
+                if (idx1, idx2) in compared:
+                    continue
+                compared.add((idx1, idx2))
+                if jaccard_similarity(get_shingles(idx1), get_shingles(idx2)) >= threshold:
+                    similar_map[idx1].add(idx2)
+                    similar_map[idx2].add(idx1)
+    return similar_map
+
+
 # --------------------------------------------------------------
 #           Author Matching Algorithm Functions
 #
@@ -223,22 +429,19 @@ def get_author_tokens(author, decode_non_ascii=True, strip_initials=False):
 
     if author:
         # Ensure Last,First is treated same as Last, First adding back space after comma.
-        comma_no_space_pat = re.compile(r',([^\s])')
-        author = comma_no_space_pat.sub(', \\1', author)
-        replace_pat = re.compile(r'[-+.:;]')
-        au = replace_pat.sub(' ', author)
+        author = COMMA_NO_SPACE_PAT.sub(', \\1', author)
+        au = author.translate(SEPARATOR_CHARS_TABLE)
         if decode_non_ascii:
-            au = get_udc().decode(au)
+            au = decode_text(au)
         parts = au.split()
         if ',' in au:
             # au probably in ln, fn form
             parts = parts[1:] + parts[:1]
         # Leave ' in there for Irish names
-        remove_pat = re.compile(r'[,!@#$%^&*(){}`~"\s\[\]/]')
         # We will ignore author initials of only one character.
         min_length = 1 if strip_initials else 0
         for tok in parts:
-            tok = remove_pat.sub('', tok).strip()
+            tok = tok.translate(AUTHOR_REMOVE_CHARS_TABLE).strip()
             if len(tok) > min_length and tok.lower() not in IGNORE_AUTHOR_WORDS_MAP:
                 yield tok.lower()
 
@@ -292,17 +495,14 @@ def get_series_tokens(series, decode_non_ascii=True):
     hash comparisons.
     '''
 
-    ignore_words = ['the', 'a', 'and',]
     if series:
-        remove_pat = re.compile(r'[,!@#$%^&*(){}`~\'"\s\[\]/]')
-        replace_pat = re.compile(r'[-+.:;]')
-        s = replace_pat.sub(' ', series)
+        s = series.translate(SEPARATOR_CHARS_TABLE)
         if decode_non_ascii:
-            s = get_udc().decode(s)
+            s = decode_text(s)
         parts = s.split()
         for tok in parts:
-            tok = remove_pat.sub('', tok).strip()
-            if len(tok) > 0 and tok.lower() not in ignore_words:
+            tok = tok.translate(REMOVE_CHARS_TABLE).strip()
+            if len(tok) > 0 and tok.lower() not in IGNORE_SERIES_WORDS:
                 yield tok.lower()
 
 def similar_series_match(series):
@@ -334,18 +534,14 @@ def get_publisher_tokens(publisher, decode_non_ascii=True):
     hash comparisons.
     '''
 
-    ignore_words = ['the', 'inc', 'ltd', 'limited', 'llc', 'co', 'pty',
-                    'usa', 'uk']
     if publisher:
-        remove_pat = re.compile(r'[,!@#$%^&*(){}`~\'"\s\[\]/]')
-        replace_pat = re.compile(r'[-+.:;]')
-        p = replace_pat.sub(' ', publisher)
+        p = publisher.translate(SEPARATOR_CHARS_TABLE)
         if decode_non_ascii:
-            p = get_udc().decode(p)
+            p = decode_text(p)
         parts = p.split()
         for tok in parts:
-            tok = remove_pat.sub('', tok).strip()
-            if len(tok) > 0 and tok.lower() not in ignore_words:
+            tok = tok.translate(REMOVE_CHARS_TABLE).strip()
+            if len(tok) > 0 and tok.lower() not in IGNORE_PUBLISHER_WORDS:
                 yield tok.lower()
 
 def similar_publisher_match(publisher):
@@ -381,17 +577,14 @@ def get_tag_tokens(tag, decode_non_ascii=True):
     hash comparisons.
     '''
 
-    ignore_words = ['the', 'and', 'a']
     if tag:
-        remove_pat = re.compile(r'[,!@#$%^&*(){}`~\'"\s\[\]/]')
-        replace_pat = re.compile(r'[-+.:;]')
-        t = replace_pat.sub(' ', tag)
+        t = tag.translate(SEPARATOR_CHARS_TABLE)
         if decode_non_ascii:
-            t = get_udc().decode(t)
+            t = decode_text(t)
         parts = t.split()
         for tok in parts:
-            tok = remove_pat.sub('', tok).strip()
-            if len(tok) > 0 and tok.lower() not in ignore_words:
+            tok = tok.translate(REMOVE_CHARS_TABLE).strip()
+            if len(tok) > 0 and tok.lower() not in IGNORE_TAG_WORDS:
                 yield tok.lower()
 
 def similar_tags_match(tag):
@@ -413,6 +606,127 @@ def fuzzy_tags_match(tag):
     return tag_tokens[0]
 
 
+# --------------------------------------------------------------
+#           Candidate Group Functions
+# --------------------------------------------------------------
+
+def clean_dup_groups(candidates_map):
+    '''
+    Given a dictionary of sets, convert into a list of sets removing any sets
+    that are subsets of other sets. Rather than comparing every set with every
+    larger set, an index of the sets containing each member is used so only
+    sets sharing a member are compared.
+    '''
+    res = [set(d) for d in list(candidates_map.values())]
+    res.sort(key=lambda x: len(x))
+    groups_for_member = defaultdict(list)
+    for i, group in enumerate(res):
+        for member in group:
+            groups_for_member[member].append(i)
+    candidates_list = []
+    for i, a in enumerate(res):
+        if not a:
+            # An empty set is a subset of any set that follows it
+            if i == len(res) - 1:
+                candidates_list.append(a)
+            continue
+        # Any superset must contain every member of this set, so we need only
+        # check the sets after this one containing its least common member
+        member_groups = min((groups_for_member[member] for member in a), key=len)
+        for j in member_groups[bisect_right(member_groups, i):]:
+            if a.issubset(res[j]):
+                break
+        else:
+            candidates_list.append(a)
+    return candidates_list
+
+
+def build_exemption_graph(exemptions_list):
+    '''
+    Given a list of exemption groups (each a list of members that are not
+    duplicates of each other), return a dictionary of each member to a tuple
+    of the frozensets of the exemption groups it belongs to. The frozensets
+    are shared between their members rather than copied for each.
+    '''
+    member_groups = defaultdict(list)
+    for group_list in exemptions_list:
+        group_set = frozenset(group_list)
+        for member in group_set:
+            member_groups[member].append(group_set)
+    return dict((member, tuple(groups)) for member, groups in member_groups.items())
+
+def partition_using_exemptions(data_items, exemption_graph):
+    '''
+    Given a set of data items, see if any of these combinations should
+    be excluded due to being marked as not duplicates of each other
+    If we find items that should not appear together, then we will
+    repartition into multiple groups. Returns a sorted list where each item
+    is a sorted sublist containing the data items for that partitioned group.
+    '''
+    data_items = sorted(data_items)
+    group = set(data_items)
+    # Only the exemptions between members of this group affect it, so each
+    # exemption group is intersected with this group just once
+    group_graph = []
+    intersections = {}
+    for one_dup in data_items:
+        exemption_groups = exemption_graph.get(one_dup, None)
+        if not exemption_groups:
+            continue
+        exempt = set()
+        for exemption_group in exemption_groups:
+            intersection = intersections.get(id(exemption_group), None)
+            if intersection is None:
+                intersection = intersections[id(exemption_group)] = exemption_group & group
+            exempt |= intersection
+        exempt.discard(one_dup)
+        if exempt:
+            group_graph.append((one_dup, exempt))
+    if not group_graph:
+        return [data_items] if len(data_items) > 1 else []
+
+    # Initial condition -- the group contains 1 set of all elements
+    results = [group]
+    partitioning_ids = [None]
+    # Loop through the set of duplicates that are exempt from another in this group
+    for one_dup, exempt in group_graph:
+        for i in range(len(results)):
+            res = results[i]
+            if one_dup not in res:
+                continue
+            # Remove the members exempt from this item from the result group.
+            remaining = res - exempt
+            if one_dup == partitioning_ids[i]:
+                # This item caused this result group to partition in the first
+                # place, so we must not partition again or we will make subsets
+                # of the group that split this partition off. Consider a group
+                # of (1,2,3,4) and non-dups of [(1,2), (2,3)]. The first partition
+                # will give us (1,3,4) and (2,3,4). Later when we discover (2,3),
+                # if we partition (2,3,4) again, we will end up with (2,4) and
+                # (3,4), but (3,4) is a subset of (1,3,4). All we need to do is
+                # remove 3 from the (2,3,4) partition.
+                results[i] = remaining
+                continue
+            # Must partition. We keep this item in the partition in our hand,
+            # then create new partitions for each of the exempt members. We only
+            # partition for members larger than this item, since the work for
+            # the smaller members was done when processing them.
+            results[i] = remaining
+            remaining = remaining - set([one_dup])
+            for nd in exempt:
+                if nd > one_dup and nd in res:
+                    partition = set(remaining)
+                    partition.add(nd)
+                    results.append(partition)
+                    partitioning_ids.append(nd)
+    sr = []
+    for r in results:
+        if len(r) > 1:
+            sr.append(sorted(r))
+    sr.sort()
+    return sr
+
+
 # --------------------------------------------------------------
 #           Find Duplicates Algorithm Factories
 # --------------------------------------------------------------
@@ -628,8 +942,245 @@ def do_assert_tests():
     prints('Tests completed')
 
 
+def do_benchmark_tests(book_count=100000):
+    '''
+    Measure the per-book hashing throughput of each title/author algorithm,
+    comparing clearing our cached patterns and decoded text before every book
+    (approximating the behaviour prior to v1.11) with reusing them.
+    '''
+    import random, time
+    random.seed(0)
+    words = ['The', 'Martian', 'Way', 'Foundation', 'and', 'Earth', 'Fellowship', 'of',
+             'Ring', 'Lord', 'Rings', 'Miéville', 'Omnibus', '(2010)', 'Edition', 'Book',
+             'Night', 'Dragon', "Assassin's", 'Apprentice', 'Dune', 'Children', 'Time']
+    names = ['Kevin', 'J.', 'Anderson', 'China', 'Miéville', 'Isaac', 'Asimov', 'Robin',
+             'Hobb', 'Frank', 'Herbert', 'Adrian', 'Tchaikovsky', 'Brontë', 'Jr']
+    books = []
+    for i in range(book_count):
+        title = ' '.join(random.choice(words) for _ in range(random.randint(1, 6)))
+        author = ' '.join(random.choice(names) for _ in range(random.randint(1, 3)))
+        if i % 3 == 0:
+            author = author.replace(' ', ', ', 1)
+        books.append((title, author))
+
+    for match_type in ['identical', 'similar', 'soundex', 'fuzzy']:
+        title_fn = get_title_algorithm_fn(match_type)
+        author_fn = get_author_algorithm_fn(match_type)
+        results = []
+        for clear_caches in [True, False]:
+            reset_match_caches()
+            start = time.time()
+            for title, author in books:
+                if clear_caches:
+                    reset_match_caches()
+                title_fn(title)
+                author_fn(author)
+            elapsed = max(time.time() - start, 0.000001)
+            results.append(book_count / elapsed)
+        prints('%-10s uncached: %9.0f books/sec   cached: %9.0f books/sec' % (
+                            match_type, results[0], results[1]))
+
+
+def do_clean_dup_groups_tests(group_count=20000):
+    '''
+    Verify clean_dup_groups gives the same results as the original pairwise
+    comparison and compare their timings, for several synthetic distributions
+    of candidate groups.
+    '''
+    import random, time
+
+    def pairwise_clean_dup_groups(candidates_map):
+        res = [set(d) for d in list(candidates_map.values())]
+        res.sort(key=lambda x: len(x))
+        candidates_list = []
+        for i,a in enumerate(res):
+            for b in res[i+1:]:
+                if a.issubset(b):
+                    break
+            else:
+                candidates_list.append(a)
+        return candidates_list
+
+    def disjoint_pairs(count):
+        # Typical of identical/similar searches: small groups with little overlap
+        return dict((i, set([i*2, i*2+1])) for i in range(count))
+
+    def coauthor_overlap(count):
+        # Books with multiple authors appearing in several overlapping groups
+        return dict((i, set(random.sample(range(count), random.randint(2, 4))))
+                    for i in range(count))
+
+    def soundex_ignore_author(count):
+        # Soundex title with author ignored: a few very large groups plus many
+        # small groups, some of which are subsets of the larger ones
+        groups = {}
+        for i in range(count):
+            if i % 1000 == 0:
+                groups[i] = set(range(i, i + 500))
+            else:
+                base = random.randrange(count)
+                groups[i] = set([base, base + random.randint(1, 3)])
+        return groups
+
+    random.seed(0)
+    for name, fn in [('disjoint pairs', disjoint_pairs),
+                     ('co-author overlap', coauthor_overlap),
+                     ('soundex ignore author', soundex_ignore_author)]:
+        candidates_map = fn(group_count)
+        start = time.time()
+        expected = pairwise_clean_dup_groups(candidates_map)
+        pairwise_elapsed = time.time() - start
+        start = time.time()
+        actual = clean_dup_groups(candidates_map)
+        indexed_elapsed = time.time() - start
+        if actual != expected:
+            prints('Failed: clean_dup_groups results differ for %s' % name)
+        prints('%-22s %d groups -> %d   pairwise: %.2fs   indexed: %.2fs' % (
+                    name, len(candidates_map), len(actual), pairwise_elapsed, indexed_elapsed))
+
+
+def do_title_overlap_benchmark(title_count=200000, threshold=60):
+    '''
+    Compare finding duplicates in a synthetic corpus of titles using the
+    fuzzy title match with the overlap title match. Every tenth title is
+    given a variation of another title in the corpus (reordered words,
+    an added subtitle, a dropped word), so we can report how many of these
+    known duplicates each algorithm finds and how long it takes.
+    '''
+    import random, time
+    random.seed(0)
+    words = [''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(random.randint(3, 9)))
+             for _ in range(5000)]
+
+    def vary(title):
+        tokens = title.split()
+        variation = random.randint(0, 2)
+        if variation == 0:
+            return '%s, The' % ' '.join(tokens[1:] + tokens[:1])
+        if variation == 1:
+            return '%s: %s' % (title, random.choice(words).title())
+        if len(tokens) > 3:
+            del tokens[random.randrange(len(tokens))]
+        return ' '.join(tokens)
+
+    titles = []
+    expected = []
+    for i in range(title_count):
+        if i % 10 == 9:
+            original = random.randrange(i)
+            titles.append(vary(titles[original]))
+            expected.append((original, i))
+        else:
+            titles.append('The ' + ' '.join(random.choice(words).title()
+                                            for _ in range(random.randint(2, 6))))
+
+    def count_found(groups_for_title):
+        return sum(1 for original, i in expected if groups_for_title[original] & groups_for_title[i])
+
+    start = time.time()
+    fuzzy_map = defaultdict(set)
+    for i, title in enumerate(titles):
+        fuzzy_map[fuzzy_title_match(title)].add(i)
+    fuzzy_groups = defaultdict(set)
+    for group_id, group in enumerate(g for g in fuzzy_map.values() if len(g) > 1):
+        for i in group:
+            fuzzy_groups[i].add(group_id)
+    prints('fuzzy:   %.2fs   found %d of %d variations   %d groups' % (
+                time.time() - start, count_found(fuzzy_groups), len(expected),
+                len([g for g in fuzzy_map.values() if len(g) > 1])))
+
+    start = time.time()
+    items = [('', get_title_words(title)) for title in titles]
+    similar_map = find_similar_titles(items, threshold)
+    overlap_groups = defaultdict(set)
+    for i, similar in similar_map.items():
+        overlap_groups[i].add(i)
+        for j in similar:
+            overlap_groups[j].add(i)
+    prints('overlap: %.2fs   found %d of %d variations   %d titles with matches (%d%% threshold)' % (
+                time.time() - start, count_found(overlap_groups), len(expected),
+                len(similar_map), threshold))
+
+
+def do_partition_tests(test_count=2000):
+    '''
+    Property test that partition_using_exemptions gives identical groups to
+    the original implementation, which merged the exemption sets for every
+    lookup, for random groups and exemptions. Also compares their timings
+    for a large anthology style group with many exemptions.
+    '''
+    import random, time
+
+    def original_partition_using_exemptions(data_items, exemptions_list):
+        exemptions_map = defaultdict(list)
+        for group_list in exemptions_list:
+            group_set = set(group_list)
+            for member in group_list:
+                exemptions_map[member].append(group_set)
+        data_items = sorted(data_items)
+        results = [set(data_items)]
+        partitioning_ids = [None]
+        for one_dup in data_items:
+            if one_dup in exemptions_map:
+                ndm_entry = set().union(*exemptions_map[one_dup]) - set([one_dup])
+                for i,res in enumerate(results):
+                    if one_dup in res:
+                        if one_dup == partitioning_ids[i]:
+                            results[i] = (res - ndm_entry) | set([one_dup])
+                            continue
+                        results[i] = (res - ndm_entry) | set([one_dup])
+                        for nd in ndm_entry:
+                            if nd > one_dup and nd in res:
+                                results.append((res - ndm_entry - set([one_dup])) | set([nd]))
+                                partitioning_ids.append(nd)
+        sr = []
+        for r in results:
+            if len(r) > 1:
+                sr.append(sorted(list(r)))
+        sr.sort()
+        return sr
+
+    random.seed(0)
+    failures = 0
+    for test in range(test_count):
+        member_count = random.randint(1, 30)
+        data_items = random.sample(range(100), member_count)
+        exemptions_list = []
+        for i in range(random.randint(0, 8)):
+            # Exemptions may include members outside of this group
+            exemptions_list.append(random.sample(range(100), random.randint(2, 6)))
+        expected = original_partition_using_exemptions(data_items, exemptions_list)
+        actual = partition_using_exemptions(data_items, build_exemption_graph(exemptions_list))
+        if actual != expected:
+            failures += 1
+            prints('Failed: partition of', sorted(data_items), 'with', exemptions_list)
+            prints('   expected:', expected)
+            prints('     actual:', actual)
+    prints('Partition tests: %d of %d passed' % (test_count - failures, test_count))
+
+    # An anthology title with hundreds of books, where groups of these were
+    # previously exempted together along with many books outside the group
+    data_items = list(range(600))
+    exemptions_list = [list(range(i, i + 8)) + random.sample(range(1000, 20000), 2000)
+                       for i in range(0, 32, 8)]
+    start = time.time()
+    expected = original_partition_using_exemptions(data_items, exemptions_list)
+    original_elapsed = time.time() - start
+    start = time.time()
+    actual = partition_using_exemptions(data_items, build_exemption_graph(exemptions_list))
+    graph_elapsed = time.time() - start
+    if actual != expected:
+        prints('Failed: anthology partition results differ')
+    prints('Anthology %d members -> %d groups   original: %.2fs   graph: %.2fs' % (
+                len(data_items), len(actual), original_elapsed, graph_elapsed))
+
+
 # For testing, run from command line with this:
 # calibre-debug -e matching.py
 if __name__ == '__main__':
     do_assert_tests()
+    #do_benchmark_tests()
+    #do_clean_dup_groups_tests()
+    #do_title_overlap_benchmark()
+    #do_partition_tests()
 
@@ -0,0 +1,135 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import json, os, traceback
+from collections import defaultdict
+
+from calibre import prints
+from calibre.constants import DEBUG
+
+# Name of the file holding the candidate signatures of a library, stored
+# alongside the metadata.db of the target library for a cross library compare
+SIGNATURES_FILE_NAME = 'find_duplicates_signatures.json'
+SIGNATURES_VERSION = 1
+
+# Signatures already read from disk this session, keyed by file path and
+# holding a tuple of (file mtime, signatures data, candidate key index map)
+_signatures_cache = {}
+
+
+class LibrarySignatures(object):
+    '''
+    The candidate keys computed by an algorithm for every book in a library,
+    persisted to a file in that library folder. The target library of a cross
+    library comparison is opened read only, so unlike the current library we
+    cannot store these as custom book data.
+
+    Each signature key (identifying the algorithm and its settings) maps
+    book ids to the last_modified of the book when hashed and its candidate
+    keys, so that repeat comparisons only need to rehash modified books.
+    An index of each candidate key to its book ids is kept for probing.
+    '''
+    def __init__(self, library_path, signature_key):
+        self.path = os.path.join(library_path, SIGNATURES_FILE_NAME)
+        self.signature_key = signature_key
+        self._data = None
+        self._index = None
+
+    def update(self, db, algorithm, book_ids, include_languages=False):
+        '''
+        Bring the signatures up to date for these book ids in the database,
+        rehashing only those books modified since they were last hashed and
+        dropping any books no longer present.
+        '''
+        data = self._load()
+        books = data['signatures'].get(self.signature_key, {})
+        last_modified_map = db.new_api.all_field_for('last_modified', book_ids, default_value=None)
+        modified_map = {}
+        for book_id in book_ids:
+            last_modified = last_modified_map.get(book_id, None)
+            last_modified = last_modified.isoformat() if last_modified else None
+            book_data = books.get(str(book_id), None)
+            if not last_modified or not book_data or book_data[0] != last_modified:
+                modified_map[book_id] = last_modified
+        book_id_keys = set(str(book_id) for book_id in book_ids)
+        removed_book_ids = [k for k in books if k not in book_id_keys]
+        if not modified_map and not removed_book_ids and self.signature_key in data['signatures']:
+            if DEBUG:
+                prints('Signatures: reused candidate keys for all %d books' % len(book_ids))
+            return
+
+        # Invert the candidates map for the modified books into their keys
+        book_keys_map = defaultdict(list)
+        if modified_map:
+            candidates_map = algorithm.find_candidates(list(modified_map.keys()), include_languages)
+            for candidate_key, candidate_book_ids in candidates_map.items():
+                for book_id in candidate_book_ids:
+                    book_keys_map[book_id].append(candidate_key)
+        for k in removed_book_ids:
+            del books[k]
+        for book_id, last_modified in modified_map.items():
+            books[str(book_id)] = [last_modified, book_keys_map.get(book_id, [])]
+        data['signatures'][self.signature_key] = books
+        self._index = None
+        self._save()
+        if DEBUG:
+            prints('Signatures: reused candidate keys for %d books, rehashed %d books, removed %d books' % (
+                        len(book_ids) - len(modified_map), len(modified_map), len(removed_book_ids)))
+
+    def get_book_ids(self, candidate_key):
+        '''
+        Return the set of book ids sharing this candidate key
+        '''
+        if self._index is None:
+            self._index = self._build_index()
+            _signatures_cache[self.path][2][self.signature_key] = self._index
+        return self._index.get(candidate_key, set())
+
+    def _build_index(self):
+        index = defaultdict(set)
+        books = self._load()['signatures'].get(self.signature_key, {})
+        for book_id, (_last_modified, candidate_keys) in books.items():
+            book_id = int(book_id)
+            for candidate_key in candidate_keys:
+                index[candidate_key].add(book_id)
+        return index
+
+    def _load(self):
+        if self._data is not None:
+            return self._data
+        mtime = None
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            pass
+        cached = _signatures_cache.get(self.path, None)
+        if mtime is not None and cached and cached[0] == mtime:
+            self._data = cached[1]
+            self._index = cached[2].get(self.signature_key, None)
+            return self._data
+        data = None
+        if mtime is not None:
+            try:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+            except:
+                traceback.print_exc()
+        if not data or data.get('version', None) != SIGNATURES_VERSION:
+            data = {'version': SIGNATURES_VERSION, 'signatures': {}}
+        self._data = data
+        _signatures_cache[self.path] = (mtime, data, {})
+        return self._data
+
+    def _save(self):
+        try:
+            with open(self.path, 'w') as f:
+                json.dump(self._data, f)
+            mtime = os.path.getmtime(self.path)
+        except:
+            # The target library may be on read-only storage, so carry on
+            # with the signatures we have built in memory for this session
+            traceback.print_exc()
+            mtime = None
+        _signatures_cache[self.path] = (mtime, self._data, {})
@@ -9,7 +9,7 @@ from collections import OrderedDict, defaultdict
 from calibre import prints
 from calibre.constants import DEBUG
 
-from calibre_plugins.find_duplicates.matching import get_variation_algorithm_fn, get_field_pairs
+from calibre_plugins.find_duplicates.matching import clean_dup_groups, get_variation_algorithm_fn, get_field_pairs
 
 # --------------------------------------------------------------
 #              Variation Algorithm Class
@@ -117,16 +117,7 @@ class VariationAlgorithm(object):
         Given a dictionary of sets, convert into a list of sets removing any sets
         that are subsets of other sets.
         '''
-        res = [set(d) for d in list(candidates_map.values())]
-        res.sort(key=lambda x: len(x))
-        candidates_list = []
-        for i,a in enumerate(res):
-            for b in res[i+1:]:
-                if a.issubset(b):
-                    break
-            else:
-                candidates_list.append(a)
-        return candidates_list
+        return clean_dup_groups(candidates_map)
 
     def _get_counts_for_candidates(self, matches_for_item_map, item_type):
         all_counts = self.db.get_usage_count_by_id(item_type)
@@ -0,0 +1,102 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import hashlib, json
+
+# Name of the custom book data storing the results of the file checks of each book
+CACHE_NAME = 'quality_check_cache'
+# Increment when a check changes which books it matches, so previous results are discarded
+CACHE_VERSION = 1
+
+
+def get_options_key(options):
+    '''
+    Return a key identifying the options a check is run with, such as the
+    expression of an ePub search, so results for other options are not reused.
+    '''
+    data = json.dumps([CACHE_VERSION, options], sort_keys=True)
+    return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+
+def has_error_entries(log_entries):
+    return any(level == 'error' for level, args in log_entries)
+
+
+class CheckResultsCache(object):
+    '''
+    The result of a file check for each book is stored as custom book data,
+    along with what it logged, keyed by the check, the options it was run with
+    and the path, size and modification time of each format it reads. When a
+    check is run again, only books whose formats have changed are read.
+    '''
+    def __init__(self, db, menu_key, formats, options):
+        self.db = db
+        self.menu_key = menu_key
+        self.formats = formats
+        self.options_key = get_options_key(options)
+        self._cache_map = None
+
+    def get_format_key(self, book_id):
+        '''
+        Return a list of [format, path, size, mtime] for the formats of this
+        book read by the check, or None if they cannot be determined.
+        '''
+        format_key = []
+        for fmt in self.formats:
+            try:
+                stat_metadata = self.db.new_api.format_metadata(book_id, fmt)
+            except:
+                return None
+            if not stat_metadata:
+                # The book does not have this format
+                continue
+            if 'mtime' not in stat_metadata:
+                return None
+            format_key.append([fmt, stat_metadata['path'], stat_metadata['size'],
+                               stat_metadata['mtime'].isoformat()])
+        return format_key
+
+    def apply(self, book_ids):
+        '''
+        Return a tuple of the (matched, log_entries) cached for each book id
+        whose formats are unchanged, and the format key of every book id so the
+        results of checking the others can be stored once known.
+        '''
+        if self._cache_map is None:
+            self._cache_map = self.db.get_all_custom_book_data(CACHE_NAME, default={})
+        book_results = {}
+        format_keys_map = {}
+        for book_id in book_ids:
+            format_key = self.get_format_key(book_id)
+            if format_key is None:
+                continue
+            format_keys_map[book_id] = format_key
+            book_data = self._cache_map.get(book_id, None) or {}
+            cached = book_data.get(self.menu_key, None)
+            if cached and cached['format'] == format_key and cached['options'] == self.options_key:
+                book_results[book_id] = (cached['matched'], cached['log'])
+        return book_results, format_keys_map
+
+    def store(self, book_results, format_keys_map):
+        '''
+        Store the (matched, log_entries) of each book checked against its format
+        key. Only what was logged for the books matched is kept, so the data
+        stored for the many books a check does not match stays small. Books
+        whose check logged an error (such as the file not being readable) are
+        not stored, so they are checked again next time.
+        '''
+        if self._cache_map is None:
+            self._cache_map = self.db.get_all_custom_book_data(CACHE_NAME, default={})
+        result_cache_map = {}
+        for book_id, (matched, log_entries) in book_results.items():
+            format_key = format_keys_map.get(book_id, None)
+            if format_key is None or has_error_entries(log_entries):
+                continue
+            book_data = dict(self._cache_map.get(book_id, None) or {})
+            book_data[self.menu_key] = {'format': format_key, 'options': self.options_key,
+                                        'matched': matched, 'log': log_entries if matched else []}
+            self._cache_map[book_id] = result_cache_map[book_id] = book_data
+        if result_cache_map:
+            self.db.add_multiple_custom_book_data(CACHE_NAME, result_cache_map)
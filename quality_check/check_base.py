@@ -11,12 +11,24 @@ except NameError:
     pass # load_translations() added in calibre 1.9
 
 import calibre_plugins.quality_check.config as cfg
-from calibre_plugins.quality_check.dialogs import QualityProgressDialog, ResultsSummaryDialog
+from calibre_plugins.quality_check.dialogs import (QualityProgressDialog, QualityJobProgressDialog,
+                                                   ResultsSummaryDialog)
+from calibre_plugins.quality_check.cache import CheckResultsCache
+from calibre_plugins.quality_check.jobs import MIN_BATCH_SIZE, BookLog
 
 class BaseCheck(object):
     '''
     Base class for all quality check implementations
     '''
+    # Checks which read book files set the category used to recreate them in a
+    # worker process and the formats they read, so check_all_files runs them
+    # on a pool of workers rather than one book at a time on the GUI thread
+    worker_cat = None
+    worker_formats = []
+    # Whether the results of the file checks are cached for each book, which
+    # checks run with options that differ every time (such as a search) clear
+    cache_results = True
+
     def __init__(self, gui, initial_search=''):
         self.gui = gui
         self.log = GUILog()
@@ -24,6 +36,12 @@ class BaseCheck(object):
         self.book_ids = []
         self.initial_search = initial_search
         self.show_matches_override = None
+        # Choices made by the user for a check before it is run (such as in a
+        # dialog), so a worker can rerun the check without asking again
+        self.options = {}
+        # When collecting the checks to run together, a list of (menu_key, evaluate_book)
+        self._visitors = None
+        self._visitor_key = None
 
     def perform_check(self, menu_key):
         '''
@@ -38,10 +56,34 @@ class BaseCheck(object):
     def set_show_matches_override(self, show_matches_override):
         self.show_matches_override = show_matches_override
 
-    def check_all_files(self, callback_fn, status_msg_type='books',
-                        no_match_msg=None, show_matches=True, marked_text='true'):
+    def get_check_visitors(self, menu_keys):
         '''
-        Performs the quality check in a threaded fashion with progress dialog
+        Return a list of (menu_key, evaluate_book) for the checks of these menu
+        keys, where evaluate_book(book_id, db) is the function the check would
+        call for each book from check_all_files.
+        '''
+        previous_visitors = self._visitors, self._visitor_key
+        self._visitors = []
+        try:
+            for menu_key in menu_keys:
+                self._visitor_key = menu_key
+                self.perform_check(menu_key)
+            return self._visitors
+        finally:
+            self._visitors, self._visitor_key = previous_visitors
+
+    def evaluate_checks(self, visitors, book_id, db, excluded_map={}):
+        '''
+        Visit this book with each check, returning the menu keys of the checks
+        it matched. The book is skipped by any checks it is excluded from.
+        '''
+        return [menu_key for menu_key, evaluate_book in visitors
+                if book_id not in excluded_map.get(menu_key, ()) and evaluate_book(book_id, db)]
+
+    def get_book_ids_to_check(self):
+        '''
+        Return the ids of the books in the scope of the check, less any books
+        excluded from it
         '''
         # If scope is limited to selected book ids this set will have been set.
         if not self.book_ids:
@@ -53,30 +95,98 @@ class BaseCheck(object):
             if excluded_ids:
                 excluded_map = dict((i, True) for i in excluded_ids)
                 self.book_ids = [i for i in self.book_ids if i not in excluded_map]
+        return self.book_ids
+
+    def check_all_files(self, callback_fn, status_msg_type='books',
+                        no_match_msg=None, show_matches=True, marked_text='true'):
+        '''
+        Performs the quality check in a threaded fashion with progress dialog
+        '''
+        if self._visitors is not None:
+            # Collecting this check to run with others rather than running it now
+            self._visitors.append((self._visitor_key, callback_fn))
+            return
+        self.get_book_ids_to_check()
         # Override the show matches behavior if so
         if self.show_matches_override is not None:
             show_matches = self.show_matches_override
 
-        d = QualityProgressDialog(self.gui, self.book_ids, callback_fn, self.gui.current_db,
-                                  status_msg_type)
+        if self.worker_cat and self.menu_key:
+            total_count, result_ids, was_canceled = self.check_book_files(callback_fn, status_msg_type)
+        else:
+            d = QualityProgressDialog(self.gui, self.book_ids, callback_fn, self.gui.current_db,
+                                      status_msg_type)
+            total_count, result_ids, was_canceled = d.total_count, d.result_ids, d.wasCanceled()
         cancelled_msg = ''
-        if d.wasCanceled():
+        if was_canceled:
             cancelled_msg = _(' (cancelled)')
         if show_matches:
-            if len(d.result_ids) > 0:
-                self.show_invalid_rows(d.result_ids, marked_text)
+            if len(result_ids) > 0:
+                self.show_invalid_rows(result_ids, marked_text)
                 if self.log.plain_text:
                     sd = ResultsSummaryDialog(self.gui, _('Quality Check'),
-                                             _('%d matches found%s, see log for details')%(len(d.result_ids), cancelled_msg),
+                                             _('%d matches found%s, see log for details')%(len(result_ids), cancelled_msg),
                                              self.log)
                     sd.exec_()
             if no_match_msg:
-                msg = _('Checked %d books, found %d matches%s') %(d.total_count, len(d.result_ids), cancelled_msg)
+                msg = _('Checked %d books, found %d matches%s') %(total_count, len(result_ids), cancelled_msg)
                 self.gui.status_bar.showMessage(msg)
-                if len(d.result_ids) == 0:
+                if len(result_ids) == 0:
                     sd = ResultsSummaryDialog(self.gui, _('No Matches'), no_match_msg, self.log)
                     sd.exec_()
-        return d.total_count, d.result_ids, cancelled_msg
+        return total_count, result_ids, cancelled_msg
+
+    def check_book_files(self, callback_fn, status_msg_type):
+        '''
+        Check the files of the books, reusing any results cached for books whose
+        files are unchanged since they were last checked with the same options.
+        The other books are checked on a pool of workers, or here if only a few.
+        Returns a tuple of (total_count, result_ids, was_canceled)
+        '''
+        db = self.gui.current_db
+        cache = None
+        book_results, format_keys_map = {}, {}
+        if self.cache_results:
+            cache = CheckResultsCache(db, self.menu_key, self.worker_formats, self.options)
+            book_results, format_keys_map = cache.apply(self.book_ids)
+        remaining_ids = [book_id for book_id in self.book_ids if book_id not in book_results]
+        checked_results, error_entries, was_canceled = {}, [], False
+        # Starting the workers would take longer than checking a few books here
+        if len(remaining_ids) >= MIN_BATCH_SIZE:
+            d = QualityJobProgressDialog(self.gui, remaining_ids, self.worker_cat, self.worker_formats,
+                                         self.menu_key, self.options, db, status_msg_type)
+            checked_results, error_entries = d.book_results, d.error_entries
+            was_canceled = d.wasCanceled()
+        elif remaining_ids:
+
+            def evaluate_book(book_id, db):
+                log, self.log = self.log, BookLog()
+                try:
+                    matched = bool(callback_fn(book_id, db))
+                    checked_results[book_id] = (matched, self.log.entries)
+                finally:
+                    self.log = log
+                return matched
+
+            d = QualityProgressDialog(self.gui, remaining_ids, evaluate_book, db, status_msg_type)
+            was_canceled = d.wasCanceled()
+        if cache is not None:
+            cache.store(checked_results, format_keys_map)
+        book_results.update(checked_results)
+
+        # Write what the check logged for each book, in the order of the books
+        result_ids = []
+        for book_id in self.book_ids:
+            if book_id not in book_results:
+                continue
+            matched, entries = book_results[book_id]
+            if matched:
+                result_ids.append(book_id)
+            for level, args in entries:
+                getattr(self.log, level)(*args)
+        for level, args in error_entries:
+            getattr(self.log, level)(*args)
+        return len(self.book_ids), result_ids, was_canceled
 
     def show_invalid_rows(self, result_ids, marked_text='true'):
         marked_ids = dict.fromkeys(result_ids, marked_text)
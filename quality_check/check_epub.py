@@ -20,7 +20,7 @@ except:
 from lxml import etree
 
 from calibre import guess_type
-from calibre.gui2 import error_dialog
+from calibre.gui2 import error_dialog, Dispatcher
 from calibre.ebooks.chardet import xml_to_unicode
 from calibre.ebooks.conversion.preprocess import HTMLPreProcessor
 from calibre.ebooks.metadata.epub import Encryption
@@ -28,9 +28,12 @@ from calibre.ebooks.oeb.base import XPath
 from calibre.ebooks.oeb.parse_utils import NotHTML, parse_html
 from calibre.utils.zipfile import ZipFile, BadZipfile
 
+import calibre_plugins.quality_check.config as cfg
 from calibre_plugins.quality_check.check_base import BaseCheck
-from calibre_plugins.quality_check.dialogs import SearchEpubDialog
+from calibre_plugins.quality_check.dialogs import SearchEpubDialog, SelectEpubChecksDialog
 from calibre_plugins.quality_check.helpers import get_title_authors_text
+from calibre_plugins.quality_check.search_index import (SearchIndex, NAMES_KEY, get_search_index_path,
+                                                        get_required_trigram_hashes)
 
 RECOVER_PARSER = etree.XMLParser(recover=True, no_network=True, resolve_entities=False)
 
@@ -69,17 +72,93 @@ RE_WHITESPACE = re.compile(r'\s+', re.UNICODE | re.DOTALL)
 OCF_NS = 'urn:oasis:names:tc:opendocument:xmlns:container'
 OPF_NS = 'http://www.idpf.org/2007/opf'
 
+# Search indexes being updated by a background job in this calibre session
+_updating_index_paths = set()
+
+
+def get_search_scope(resource_name):
+    '''
+    Return the Search ePubs scope of this ePub member (html, css, opf or ncx),
+    or None if it is never searched, such as images and fonts
+    '''
+    extension = resource_name[resource_name.rfind('.'):].lower()
+    if extension not in NON_HTML_FILES:
+        return 'html'
+    if extension in CSS_FILES:
+        return 'css'
+    if extension in OPF_FILES:
+        return 'opf'
+    if extension in NCX_FILES:
+        return 'ncx'
+    return None
+
+
 class InvalidEpub(ValueError):
     pass
 
+class EpubScan(object):
+    '''
+    An ePub zip opened once for all the checks run against a book. Member names
+    and data are read at most once, and the helper functions cache what they
+    parse (such as the opf) in parsed, so every check visiting the book shares
+    that work. Offers the subset of the ZipFile api used by the checks.
+    '''
+    def __init__(self, path_to_book):
+        self.path_to_book = path_to_book
+        self.zf = ZipFile(path_to_book, 'r')
+        # Set while a multi-check pass shares this scan, so checks do not close it
+        self.keep_open = False
+        self.parsed = {}
+        self._names = None
+        self._infos = None
+        self._data = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if not self.keep_open:
+            self.close()
+
+    def namelist(self):
+        if self._names is None:
+            self._names = self.zf.namelist()
+        return self._names
+
+    def infolist(self):
+        if self._infos is None:
+            self._infos = self.zf.infolist()
+        return self._infos
+
+    def read(self, name):
+        name = getattr(name, 'filename', name)
+        data = self._data.get(name, None)
+        if data is None:
+            data = self._data[name] = self.zf.read(name)
+        return data
+
+    def cached(self, key, parse_fn):
+        if key not in self.parsed:
+            self.parsed[key] = parse_fn()
+        return self.parsed[key]
+
+    def close(self):
+        self.zf.close()
+        self._data.clear()
+        self.parsed.clear()
+
 class EpubCheck(BaseCheck):
     '''
     All checks related to working with ePub formats.
     '''
+    worker_cat = 'epub'
+    worker_formats = ['EPUB']
+
     def __init__(self, gui):
         BaseCheck.__init__(self, gui, 'formats:epub')
         self.html_preprocessor = HTMLPreProcessor()
         self.input_encoding = 'utf-8'
+        self._shared_epub = None
 
     def perform_check(self, menu_key):
         if menu_key == 'check_epub_jacket':
@@ -182,6 +261,8 @@ class EpubCheck(BaseCheck):
 
         elif menu_key == 'search_epub':
             self.search_epub()
+        elif menu_key == 'check_epub_multiple':
+            self.check_epub_multiple()
 
         else:
             return error_dialog(self.gui, _('Quality Check failed'),
@@ -189,32 +270,124 @@ class EpubCheck(BaseCheck):
                                 show=True, show_copy_button=False)
 
     def zf_read(self, zf, name):
-        data = zf.read(name)
-        if is_py3:
-            return data.decode('utf-8', errors='replace')
-        return data
+        def decode():
+            data = zf.read(name)
+            if is_py3:
+                return data.decode('utf-8', errors='replace')
+            return data
+        return zf.cached(('text', name), decode)
+
+    def _open_epub(self, path_to_book):
+        if self._shared_epub is not None and self._shared_epub.path_to_book == path_to_book:
+            return self._shared_epub
+        return EpubScan(path_to_book)
+
+    def check_epub_multiple(self):
+        '''
+        Run the ePub checks chosen by the user in a single pass over the books
+        '''
+        if 'menu_keys' not in self.options:
+            d = SelectEpubChecksDialog(self.gui)
+            d.exec_()
+            if d.result() != d.Accepted:
+                return
+            self.options['menu_keys'] = d.menu_keys
+        self.perform_checks(self.options['menu_keys'])
 
-    def search_epub(self):
+    def perform_checks(self, menu_keys):
         '''
-        Search epubs for text matching the user's criteria
+        Run the checks for these menu keys together, opening each ePub once and
+        visiting it with every check, rather than reading every book per check.
+        Matching books are marked and logged with the names of their checks.
         '''
-        d = SearchEpubDialog(self.gui)
-        d.exec_()
-        if d.result() != d.Accepted:
+        visitors = self.get_check_visitors(menu_keys)
+        if not visitors:
             return
+        if 'excluded_ids' not in self.options:
+            db = self.gui.current_db
+            self.options['excluded_ids'] = dict((menu_key, cfg.get_valid_excluded_books(db, menu_key))
+                                                for menu_key, evaluate_book in visitors)
+        excluded_map = dict((menu_key, set(book_ids))
+                            for menu_key, book_ids in self.options['excluded_ids'].items())
+
+        def evaluate_book(book_id, db):
+            matched_keys = self.evaluate_checks(visitors, book_id, db, excluded_map)
+            if matched_keys:
+                names = [cfg.PLUGIN_MENUS[menu_key]['name'] for menu_key in matched_keys]
+                self.log(_('<b>%s</b> matches: %s')%(get_title_authors_text(db, book_id), ', '.join(names)))
+            return bool(matched_keys)
 
-        self.search_opts = d.search_options
+        self.check_all_files(evaluate_book,
+                             no_match_msg=_('No searched ePub books match any of the checks'),
+                             marked_text='epub_multiple_checks',
+                             status_msg_type=_('ePub books for %d checks')%len(visitors))
+
+    def evaluate_checks(self, visitors, book_id, db, excluded_map={}):
+        '''
+        Visit the ePub of this book with each check, sharing one opened scan
+        of it between them. Returns the menu keys of the checks matched.
+        '''
+        if self._shared_epub is not None:
+            # Already visiting this book for an enclosing set of checks
+            return BaseCheck.evaluate_checks(self, visitors, book_id, db, excluded_map)
+        path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
+        if path_to_book:
+            try:
+                self._shared_epub = EpubScan(path_to_book)
+                self._shared_epub.keep_open = True
+            except:
+                # Leave each check to open the book and report the error itself
+                self._shared_epub = None
+        try:
+            return BaseCheck.evaluate_checks(self, visitors, book_id, db, excluded_map)
+        finally:
+            if self._shared_epub is not None:
+                self._shared_epub.close()
+                self._shared_epub = None
+
+    def search_epub(self):
+        '''
+        Search epubs for text matching the user's criteria
+        '''
+        # Each search is for a different expression, so its results are not cached
+        self.cache_results = False
+        if 'search_opts' not in self.options:
+            d = SearchEpubDialog(self.gui)
+            d.exec_()
+            if d.result() != d.Accepted:
+                return
+            # Only the expression searched for, not the history, affects the results
+            search_opts = dict(d.search_options)
+            search_opts['previous_finds'] = search_opts['previous_finds'][:1]
+            self.options['search_opts'] = search_opts
+            if cfg.plugin_prefs[cfg.STORE_OPTIONS].get(cfg.KEY_USE_SEARCH_INDEX, False):
+                self.options['search_index_path'] = get_search_index_path(self.gui.current_db.library_id)
+
+        self.search_opts = self.options['search_opts']
         re_options = re.UNICODE + re.DOTALL
         if self.search_opts['ignore_case']:
             re_options |= re.IGNORECASE
         self.log('*** Searching for expression: <span style="color:blue"><b>%s</b></span> ***' % esc(self.search_opts['previous_finds'][0]))
         self.search_expression = re.compile(self.search_opts['previous_finds'][0], re_options)
+        # The index narrows the members searched to those with the literal text
+        # the expression requires, before the expression is applied to them
+        search_index = None
+        trigram_hashes = get_required_trigram_hashes(self.search_expression)
+        if self.options.get('search_index_path', None) and trigram_hashes:
+            search_index = SearchIndex(self.options['search_index_path'])
 
         def evaluate_book(book_id, db):
             path_to_book = db.format_abspath(book_id, 'EPUB', index_is_id=True)
             if not path_to_book:
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
+            candidate_names = None
+            if search_index is not None:
+                candidate_names = search_index.get_candidate_names(book_id, path_to_book, trigram_hashes)
+                if candidate_names is not None and not self.search_opts['scope_zip']:
+                    candidate_names.discard(NAMES_KEY)
+                if candidate_names is not None and not candidate_names:
+                    return False
 
             def search_for_match(text, show_all_matches):
                 matches = []
@@ -245,21 +418,19 @@ class EpubCheck(BaseCheck):
 
             try:
                 show_all_matches = self.search_opts['show_all_matches']
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     log_lines = []
                     for resource_name in contents:
-                        extension = resource_name[resource_name.rfind('.'):].lower()
+                        scope = get_search_scope(resource_name)
                         check_file = extract_body_text = False
-                        if extension not in NON_HTML_FILES:
+                        if scope == 'html':
                             extract_body_text = self.search_opts['scope_plaintext']
                             check_file = self.search_opts['scope_html'] or extract_body_text
-                        elif extension in CSS_FILES:
-                            check_file = self.search_opts['scope_css']
-                        elif extension in OPF_FILES:
-                            check_file = self.search_opts['scope_opf']
-                        elif extension in NCX_FILES:
-                            check_file = self.search_opts['scope_ncx']
+                        elif scope is not None:
+                            check_file = self.search_opts['scope_' + scope]
+                        if candidate_names is not None and resource_name not in candidate_names:
+                            check_file = False
                         if check_file:
                             content = zf.read(resource_name).decode('utf-8',errors='replace')
                             if extract_body_text:
@@ -267,7 +438,7 @@ class EpubCheck(BaseCheck):
                             if search_for_match(content, show_all_matches):
                                 if not show_all_matches:
                                     break
-                        if self.search_opts['scope_zip']:
+                        if self.search_opts['scope_zip'] and (candidate_names is None or NAMES_KEY in candidate_names):
                             filename = os.path.basename(resource_name)
                             if search_for_match(filename, show_all_matches):
                                 if not show_all_matches:
@@ -294,6 +465,55 @@ class EpubCheck(BaseCheck):
                              no_match_msg=_('No searched ePub books have your search text'),
                              marked_text='epub_search_text',
                              status_msg_type=_('ePub books for search text'))
+        if search_index is not None:
+            search_index.close()
+        if self.gui is not None and self._visitors is None and self.options.get('search_index_path', None):
+            self.update_search_index(self.options['search_index_path'])
+
+    def get_search_texts(self, path_to_book):
+        '''
+        Return a list of (name, texts) of the text Search ePubs could match
+        in each member of this ePub, with the member file names under NAMES_KEY
+        '''
+        search_texts = []
+        with self._open_epub(path_to_book) as zf:
+            contents = zf.namelist()
+            for resource_name in contents:
+                scope = get_search_scope(resource_name)
+                if scope is None:
+                    continue
+                content = zf.read(resource_name).decode('utf-8', errors='replace')
+                texts = [content]
+                if scope == 'html':
+                    texts.append(self._extract_body_text(content))
+                search_texts.append((resource_name, [text.replace('&nbsp;', ' ') for text in texts]))
+            search_texts.append((NAMES_KEY, [os.path.basename(resource_name) for resource_name in contents]))
+        return search_texts
+
+    def update_search_index(self, index_path):
+        '''
+        Start a background job to bring the ePub search index of this library
+        up to date, so the next searches can use it for any changed books.
+        '''
+        if index_path in _updating_index_paths:
+            return
+        api = self.gui.current_db.new_api
+        books = []
+        for book_id in api.search('formats:=epub'):
+            path_to_book = api.format_abspath(book_id, 'EPUB')
+            if path_to_book:
+                books.append((book_id, path_to_book))
+        _updating_index_paths.add(index_path)
+        args = ['calibre_plugins.quality_check.jobs', 'do_update_search_index', (index_path, books)]
+        job = self.gui.job_manager.run_job(Dispatcher(self._search_index_updated), 'arbitrary_n',
+                                           args=args, description=_('Update Quality Check ePub search index'))
+        job.index_path = index_path
+
+    def _search_index_updated(self, job):
+        _updating_index_paths.discard(job.index_path)
+        if job.failed:
+            return self.gui.job_exception(job, dialog_title=_('Failed to update ePub search index'))
+        self.gui.status_bar.showMessage(_('Quality Check ePub search index updated for %d books')%job.result, 3000)
 
 
     def check_epub_jacket(self, check_has_jacket, check_legacy_only=False):
@@ -304,7 +524,7 @@ class EpubCheck(BaseCheck):
                 self.log.error(_('ERROR: EPUB format is missing: '), get_title_authors_text(db, book_id))
                 return not check_has_jacket
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         if 'jacket' in resource_name and resource_name.endswith('.xhtml'):
                             html = zf.read(resource_name).decode('utf-8')
@@ -345,7 +565,7 @@ class EpubCheck(BaseCheck):
                 return False
             try:
                 jacket_count = 0
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         if 'jacket' in resource_name and resource_name.endswith('.xhtml'):
                             html = self.zf_read(zf, resource_name)
@@ -393,7 +613,7 @@ class EpubCheck(BaseCheck):
                 return False
             try:
                 displayed_path = False
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     opf_name = self._get_opf_xml(path_to_book, zf)
                     if opf_name:
                         for mt in TEMPLATE_MIME_TYPES:
@@ -447,7 +667,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     for resource_name in contents:
                         extension = resource_name[resource_name.rfind('.'):].lower()
@@ -491,7 +711,7 @@ class EpubCheck(BaseCheck):
                 return False
             try:
                 displayed_path = False
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     opf_name = self._get_opf_xml(path_to_book, zf)
                     if opf_name:
                         manifest_items_map = self._get_opf_items_map(zf, opf_name)
@@ -543,7 +763,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     if self._is_drm_encrypted(zf, contents):
                         self.log.error(_('SKIPPING BOOK (DRM Encrypted): '), get_title_authors_text(db, book_id))
@@ -669,7 +889,7 @@ class EpubCheck(BaseCheck):
                 self.log.error(_('ERROR: EPUB format is missing: '), get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     if self._is_drm_encrypted(zf, contents):
                         self.log.error(_('SKIPPING BOOK (DRM Encrypted): '), get_title_authors_text(db, book_id))
@@ -743,7 +963,7 @@ class EpubCheck(BaseCheck):
                 self.log.error(_('ERROR: EPUB format is missing: '), get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     if self._is_drm_encrypted(zf, contents):
                         self.log.error(_('SKIPPING BOOK (DRM Encrypted): '), get_title_authors_text(db, book_id))
@@ -813,7 +1033,7 @@ class EpubCheck(BaseCheck):
             try:
                 match = False
                 displayed_path = False
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     for resource_name in contents:
                         found = False
@@ -873,7 +1093,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return not check_has_cover
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     opf_name = self._get_opf_xml(path_to_book, zf)
                     if not opf_name:
                         self.log.error(_('No OPF file in:'), get_title_authors_text(db, book_id))
@@ -922,7 +1142,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return not check_has_svg_cover
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     opf_name = self._get_opf_xml(path_to_book, zf)
                     if opf_name:
                         cover_name = self._get_opf_item(zf, opf_name,
@@ -969,7 +1189,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return not check_has_cover
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     opf_name = self._get_opf_xml(path_to_book, zf)
                     if opf_name:
                         cover_name = self._get_opf_item(zf, opf_name,
@@ -1009,7 +1229,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return not check_converted
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     opf_name = self._get_opf_xml(path_to_book, zf)
                     if opf_name:
                         opf_xml = self.zf_read(zf, opf_name)
@@ -1045,7 +1265,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for e in zf.infolist():
                         if e.filename.endswith('/'): #file represent a folder
                             continue
@@ -1075,7 +1295,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     opf_name = self._get_opf_xml(path_to_book, zf)
                     if opf_name:
                         return False
@@ -1102,7 +1322,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     if 'META-INF/container.xml' not in contents:
                         # We have no container xml so file is completely knackered
@@ -1142,7 +1362,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     opf_name = self._get_opf_xml(path_to_book, zf)
                     if opf_name:
                         opf = self._get_opf_tree(zf, opf_name)
@@ -1187,7 +1407,7 @@ class EpubCheck(BaseCheck):
             try:
                 displayed_path = False
                 missing = False
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     opf_name = self._get_opf_xml(path_to_book, zf)
                     if opf_name:
                         manifest_items_map = self._get_opf_items_map(zf, opf_name)
@@ -1223,7 +1443,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     if self._is_drm_encrypted(zf, contents):
                         self.log.error('SKIPPING BOOK (DRM Encrypted): ', get_title_authors_text(db, book_id))
@@ -1264,7 +1484,7 @@ class EpubCheck(BaseCheck):
                 return False
             try:
                 count = None
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     if self._is_drm_encrypted(zf, contents):
                         self.log.error('SKIPPING BOOK (DRM Encrypted): ', get_title_authors_text(db, book_id))
@@ -1310,7 +1530,7 @@ class EpubCheck(BaseCheck):
                 return False
             try:
                 broken_links = []
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     if self._is_drm_encrypted(zf, contents):
                         self.log.error('SKIPPING BOOK (DRM Encrypted): ', get_title_authors_text(db, book_id))
@@ -1367,7 +1587,7 @@ class EpubCheck(BaseCheck):
                 return False
             try:
                 broken_links = []
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     opf_name = self._get_opf_xml(path_to_book, zf)
                     if opf_name:
                         manifest_items_map = self._get_opf_items_map(zf, opf_name, rebase_href=False)
@@ -1412,7 +1632,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.infolist()
                     for resource in contents:
                         if resource.file_size > MAX_SIZE:
@@ -1447,7 +1667,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     return self._is_drm_encrypted(zf, contents)
                 return False
@@ -1475,7 +1695,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         extension = resource_name[resource_name.rfind('.'):].lower()
                         if extension in NON_HTML_FILES:
@@ -1509,7 +1729,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         extension = resource_name[resource_name.rfind('.'):].lower()
                         if extension in NON_HTML_FILES:
@@ -1544,7 +1764,7 @@ class EpubCheck(BaseCheck):
             try:
                 found = False
                 displayed_path = False
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         extension = resource_name[resource_name.rfind('.'):].lower()
                         if extension in FONT_FILES:
@@ -1578,7 +1798,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         extension = resource_name[resource_name.rfind('.'):].lower()
                         if extension in CSS_FILES:
@@ -1618,7 +1838,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         if resource_name.lower().endswith('css'):
                             css = self.zf_read(zf, resource_name).lower()
@@ -1644,7 +1864,7 @@ class EpubCheck(BaseCheck):
         RE_BOOK_MGNS = re.compile(r'(#\w+\s+)?(?P<selector>(?<!\.)\bbody|@page)\b\s*{(?P<styles>[^}]*margin[^}]+);?\s*\}', re.UNICODE)
 
         def match_margins(data, allow_less=False):
-            self.user_margins = get_user_margins()
+            self.user_margins = self.options['user_margins']
             doc_defined_margins = {}
 
             for match in RE_BOOK_MGNS.finditer(data):
@@ -1720,7 +1940,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(self.path_to_book, 'r') as zf:
+                with self._open_epub(self.path_to_book) as zf:
                     self.log(_('\tAnalyzing margins in ')+self.path_to_book)
                     contents = list(self._manifest_worthy_names(zf))
                     # Check the CSS files for @page and body declarations
@@ -1750,6 +1970,8 @@ class EpubCheck(BaseCheck):
                 self.log(traceback.format_exc())
                 return False
 
+        if 'user_margins' not in self.options:
+            self.options['user_margins'] = get_user_margins()
         self.check_all_files(evaluate_book,
                              no_match_msg=_('All searched ePub books match the calibre page setup preferences'),
                              marked_text='epub_css_margins',
@@ -1765,7 +1987,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = list(self._manifest_worthy_names(zf))
                     for resource_name in contents:
                         if resource_name.lower().endswith('css'):
@@ -1805,7 +2027,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         extension = resource_name[resource_name.rfind('.'):].lower()
                         if extension in NON_HTML_FILES:
@@ -1843,7 +2065,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     if self._is_drm_encrypted(zf, contents):
                         self.log.error('SKIPPING BOOK (DRM Encrypted): ', get_title_authors_text(db, book_id))
@@ -1888,7 +2110,7 @@ class EpubCheck(BaseCheck):
                 self.log.error('ERROR: EPUB format is missing: ', get_title_authors_text(db, book_id))
                 return False
             try:
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     contents = zf.namelist()
                     if self._is_drm_encrypted(zf, contents):
                         self.log.error('SKIPPING BOOK (DRM Encrypted): ', get_title_authors_text(db, book_id))
@@ -1931,6 +2153,9 @@ class EpubCheck(BaseCheck):
     # -----------------------------------------------------------
 
     def _get_opf_xml(self, path_to_book, zf):
+        return zf.cached('opf_name', lambda: self._find_opf_name(path_to_book, zf))
+
+    def _find_opf_name(self, path_to_book, zf):
         contents = zf.namelist()
         if 'META-INF/container.xml' not in contents:
             raise InvalidEpub('Missing container.xml from:%s'%path_to_book)
@@ -1946,7 +2171,7 @@ class EpubCheck(BaseCheck):
         return opf_name
 
     def _get_opf_item(self, zf, opf_name, xpath, opf_xml=None):
-        if not opf_xml:
+        if opf_xml is None:
             opf_xml = self._get_opf_tree(zf, opf_name)
         items = opf_xml.xpath(xpath, namespaces={'opf':OPF_NS})
         if len(items):
@@ -1956,8 +2181,10 @@ class EpubCheck(BaseCheck):
                 return item_name
 
     def _get_opf_items_map(self, zf, opf_name, opf_xml=None, rebase_href=True, spine_only=False):
-        if not opf_xml:
-            opf_xml = self._get_opf_tree(zf, opf_name)
+        if opf_xml is None:
+            return zf.cached(('opf_items_map', opf_name, rebase_href, spine_only),
+                             lambda: self._get_opf_items_map(zf, opf_name, self._get_opf_tree(zf, opf_name),
+                                                             rebase_href, spine_only))
         items = opf_xml.xpath(r'child::opf:manifest/opf:item[@href]',
                               namespaces={'opf':OPF_NS})
         spine_items = []
@@ -1980,6 +2207,9 @@ class EpubCheck(BaseCheck):
         return items_map
 
     def _get_opf_tree(self, zf, opf_name):
+        return zf.cached(('opf_tree', opf_name), lambda: self._parse_opf_tree(zf, opf_name))
+
+    def _parse_opf_tree(self, zf, opf_name):
         data = zf.read(opf_name)
         data = data.decode('utf-8')
         data = re.sub(r'http://openebook.org/namespaces/oeb-package/1.0/',
@@ -1999,6 +2229,10 @@ class EpubCheck(BaseCheck):
         return name
 
     def _manifest_worthy_names(self, zf, suppress_apple_fonts=True):
+        return iter(zf.cached(('manifest_worthy_names', suppress_apple_fonts),
+                              lambda: list(self._iter_manifest_worthy_names(zf, suppress_apple_fonts))))
+
+    def _iter_manifest_worthy_names(self, zf, suppress_apple_fonts):
         for name in zf.namelist():
             if name == 'mimetype': continue
             if name.endswith('/'): continue
@@ -2102,7 +2336,7 @@ class EpubCheck(BaseCheck):
             try:
                 found = False
                 displayed_path = False
-                with ZipFile(path_to_book, 'r') as zf:
+                with self._open_epub(path_to_book) as zf:
                     for resource_name in self._manifest_worthy_names(zf):
                         extension = resource_name[resource_name.rfind('.'):].lower()
                         if extension in EPUB_FILES:
@@ -2125,3 +2359,106 @@ class EpubCheck(BaseCheck):
                              no_match_msg='No searched ePub books have a ePub inside',
                              marked_text='epub_inside_epub',
                              status_msg_type='ePub books with a ePub inside')
+
+
+BENCHMARK_CHECKS = ['check_epub_jacket', 'check_epub_unman_files', 'check_epub_font_faces',
+                    'check_epub_css_justify', 'check_epub_javascript']
+
+def create_benchmark_epub(path, book_num, chapter_count=20, chapter_size=8000):
+    '''
+    Write a synthetic ePub, with every few books having a jacket, @font-face,
+    javascript or an unmanifested file for the benchmark checks to find
+    '''
+    from zipfile import ZipFile as WriteZipFile, ZIP_STORED, ZIP_DEFLATED
+    paragraph = '<p>The quick brown fox jumps over the lazy dog. Book %d.</p>\n' % book_num
+    body = paragraph * (chapter_size // len(paragraph) + 1)
+    html_names = ['chapter%02d.xhtml' % i for i in range(chapter_count)]
+    if book_num % 3 == 0:
+        html_names.append('jacket.xhtml')
+    manifest = ['<item id="css" href="stylesheet.css" media-type="text/css"/>']
+    spine = []
+    for i, name in enumerate(html_names):
+        manifest.append('<item id="h%d" href="%s" media-type="application/xhtml+xml"/>' % (i, name))
+        spine.append('<itemref idref="h%d"/>' % i)
+    with WriteZipFile(path, 'w') as zf:
+        zf.writestr('mimetype', 'application/epub+zip', compress_type=ZIP_STORED)
+        zf.writestr('META-INF/container.xml', '<?xml version="1.0"?><container version="1.0" '
+                    'xmlns="%s"><rootfiles><rootfile full-path="OEBPS/content.opf" '
+                    'media-type="application/oebps-package+xml"/></rootfiles></container>' % OCF_NS)
+        zf.writestr('OEBPS/content.opf', '<?xml version="1.0"?><package version="2.0" xmlns="%s">'
+                    '<metadata/><manifest>%s</manifest><spine>%s</spine></package>' % (
+                        OPF_NS, ''.join(manifest), ''.join(spine)), compress_type=ZIP_DEFLATED)
+        css = 'p { margin: 0; text-align: %s; }\n' % ('left' if book_num % 4 == 0 else 'justify')
+        if book_num % 5 == 0:
+            css += '@font-face { font-family: "Serif"; src: url(serif.ttf); }\n'
+        zf.writestr('OEBPS/stylesheet.css', css, compress_type=ZIP_DEFLATED)
+        for name in html_names:
+            head = '<link href="stylesheet.css" rel="stylesheet" type="text/css"/>'
+            if name == 'jacket.xhtml':
+                head += '<meta name="calibre-content" content="jacket"/>'
+            if book_num % 7 == 0 and name == html_names[0]:
+                head += '<script src="a.js" type="text/javascript"></script>'
+            zf.writestr('OEBPS/' + name, '<html xmlns="http://www.w3.org/1999/xhtml"><head>%s</head>'
+                        '<body>%s</body></html>' % (head, body), compress_type=ZIP_DEFLATED)
+        if book_num % 11 == 0:
+            zf.writestr('OEBPS/notes.txt', 'Unmanifested', compress_type=ZIP_DEFLATED)
+
+
+def do_epub_scan_benchmark(book_count=1000, menu_keys=BENCHMARK_CHECKS):
+    '''
+    Time running several checks over synthetic ePubs one check at a time, as
+    when running each check from its menu, against a single pass visiting
+    each ePub with every check as done by perform_checks.
+    '''
+    import shutil, tempfile, time
+    from calibre import prints
+
+    class BenchmarkDb(object):
+        def __init__(self, paths):
+            self.paths = paths
+        def format_abspath(self, book_id, fmt, index_is_id=True):
+            return self.paths[book_id]
+        def title(self, book_id, index_is_id=True):
+            return 'Book %d' % book_id
+        def authors(self, book_id, index_is_id=True):
+            return 'Joe Bloggs'
+
+    tdir = tempfile.mkdtemp()
+    try:
+        paths = {}
+        for book_id in range(1, book_count + 1):
+            paths[book_id] = os.path.join(tdir, '%d.epub' % book_id)
+            create_benchmark_epub(paths[book_id], book_id)
+        db = BenchmarkDb(paths)
+        check = EpubCheck(None)
+        visitors = check.get_check_visitors(menu_keys)
+
+        start = time.time()
+        separate_results = dict((menu_key, set()) for menu_key, evaluate_book in visitors)
+        for menu_key, evaluate_book in visitors:
+            for book_id in paths:
+                if evaluate_book(book_id, db):
+                    separate_results[menu_key].add(book_id)
+        separate_elapsed = time.time() - start
+
+        start = time.time()
+        single_pass_results = dict((menu_key, set()) for menu_key, evaluate_book in visitors)
+        for book_id in paths:
+            for menu_key in check.evaluate_checks(visitors, book_id, db):
+                single_pass_results[menu_key].add(book_id)
+        single_pass_elapsed = time.time() - start
+
+        if separate_results != single_pass_results:
+            prints('Failed: single pass results differ from running each check separately')
+        for menu_key, book_ids in separate_results.items():
+            prints('%-24s %d matches' % (menu_key, len(book_ids)))
+        prints('%d checks over %d ePubs   separately: %.2fs   single pass: %.2fs' % (
+                    len(visitors), book_count, separate_elapsed, single_pass_elapsed))
+    finally:
+        shutil.rmtree(tdir, ignore_errors=True)
+
+
+# For testing, run from command line with this:
+# calibre-debug -e check_epub.py
+if __name__ == '__main__':
+    do_epub_scan_benchmark()
@@ -143,116 +143,58 @@ class MetadataCheck(BaseCheck):
 
 
     def check_duplicate_isbn(self):
-
-        books_by_isbn = {}
-
-        def evaluate_book(book_id, db):
-            isbn = db.isbn(book_id, index_is_id=True)
-            if isbn:
-                if isbn not in books_by_isbn:
-                    books_by_isbn[isbn] = set()
-                books_by_isbn[isbn].add(book_id)
-            # We will determine the match as a post step, not in this function
-            return False
-
-        total_count, _result_ids, cancelled_msg = self.check_all_files(evaluate_book, show_matches=False,
-                                                                  status_msg_type=_('books for duplicate ISBN'))
-        result_ids = list()
-        for values in books_by_isbn.values():
-            if len(values) > 1:
-                result_ids.extend(values)
+        book_ids = self.get_book_ids_to_check()
+        identifiers_map = self.gui.current_db.new_api.all_field_for('identifiers', book_ids, default_value={})
+        isbn_map = dict((book_id, (identifiers or {}).get('isbn', None))
+                        for book_id, identifiers in identifiers_map.items())
+        result_ids = get_duplicate_isbn_ids(book_ids, isbn_map)
         # Time to display the results
         if len(result_ids) > 0:
             self.show_invalid_rows(result_ids, 'duplicate_isbn')
 
-        msg = 'Checked %d books, found %d matches' %(total_count, len(result_ids))
+        msg = 'Checked %d books, found %d matches' %(len(book_ids), len(result_ids))
         self.gui.status_bar.showMessage(msg)
         if len(result_ids) == 0:
-            info_dialog(self.gui, _('No Matches%s')%cancelled_msg,
+            info_dialog(self.gui, _('No Matches'),
                                _('All searched books have unique ISBNs'), show=True)
 
 
     def check_duplicate_series(self):
-
-        books_by_series = {}
-
-        def evaluate_book(book_id, db):
-            series = db.series(book_id, index_is_id=True)
-            if series:
-                series_index = db.series_index(book_id, index_is_id=True)
-                _hash = '%s%0.4f'%(series, series_index)
-                if _hash not in books_by_series:
-                    books_by_series[_hash] = set()
-                books_by_series[_hash].add(book_id)
-            # We will determine the match as a post step, not in this function
-            return False
-
-        total_count, _result_ids, cancelled_msg = self.check_all_files(evaluate_book, show_matches=False,
-                                                                  status_msg_type=_('books for duplicate series'))
-        result_ids = list()
-        for values in books_by_series.values():
-            if len(values) > 1:
-                result_ids.extend(values)
+        book_ids = self.get_book_ids_to_check()
+        db = self.gui.current_db.new_api
+        series_map = db.all_field_for('series', book_ids)
+        series_index_map = db.all_field_for('series_index', book_ids)
+        result_ids = get_duplicate_series_ids(book_ids, series_map, series_index_map)
         # Time to display the results
         if len(result_ids) > 0:
             self.show_invalid_rows(result_ids, 'duplicate_series')
             self.gui.library_view.sort_by_named_field('series', True)
 
-        msg = 'Checked %d books, found %d matches' %(total_count, len(result_ids))
+        msg = 'Checked %d books, found %d matches' %(len(book_ids), len(result_ids))
         self.gui.status_bar.showMessage(msg)
         if len(result_ids) == 0:
-            info_dialog(self.gui, _('No Matches%s')%cancelled_msg,
+            info_dialog(self.gui, _('No Matches'),
                                _('All searched books have unique series indexes'), show=True)
 
 
     def check_series_gaps(self):
+        book_ids = self.get_book_ids_to_check()
+        db = self.gui.current_db.new_api
+        series_map = db.all_field_for('series', book_ids)
+        series_index_map = db.all_field_for('series_index', book_ids)
 
-        series_name_book_map = defaultdict(list)
-        series_name_indexes_map = defaultdict(list)
-
-        def evaluate_book(book_id, db):
-            series = db.series(book_id, index_is_id=True)
-            if series:
-                series_index = db.series_index(book_id, index_is_id=True)
-                series_name_book_map[series].append(book_id)
-                if round(series_index) == series_index and series_index > 0:
-                    series_name_indexes_map[series].append(int(series_index))
-            # We will determine the match as a post step, not in this function
-            return False
-
-        total_count, _result_ids, cancelled_msg = self.check_all_files(evaluate_book, show_matches=False,
-                                                                  status_msg_type='books for series gaps')
         result_ids = list()
         series_gap_count = book_gap_count = 0
-        for series_name in sorted(list(series_name_indexes_map.keys()), key=lambda s: s.lower()):
-            # Identify whether there are any gaps in this series
-            series_indexes = sorted(series_name_indexes_map[series_name])
-            max_value = max(series_indexes)
-
-            book_id = series_name_book_map[series_name][0]
-            authors = self.gui.current_db.authors(book_id, index_is_id=True)
-            if authors:
-                authors = [x.replace('|', ',') for x in authors.split(',')]
-                header_text = 'Series: <b>%s</b> - Author: <b>%s</b> - Last: #%d' % (series_name, authors_to_string(authors), max_value)
-            else:
-                header_text = 'Series: <b>%s</b> - Last: #%d'%(series_name, max_value)
-            if max_value >= 1000:
-                #self.log('\t<span style="color:orange">Ignored due to series index too large (>=1000)</span>')
-                continue
-
+        for series_name, series_book_ids, max_value, missing_ids in get_series_gaps(book_ids, series_map, series_index_map):
             series_gap_count += 1
-            series_indexes = sorted(series_indexes)
-            idx = 0
-            missing_ids = []
-            for expected_idx in range(1,max_value):
-                if expected_idx != series_indexes[idx]:
-                    missing_ids.append(expected_idx)
-                    book_gap_count += 1
-                else:
-                    while expected_idx == series_indexes[idx]:
-                        idx += 1
             if missing_ids:
-                result_ids.extend(series_name_book_map[series_name])
+                book_gap_count += len(missing_ids)
+                result_ids.extend(series_book_ids)
+                authors = db.field_for('authors', series_book_ids[0])
+                if authors:
+                    header_text = 'Series: <b>%s</b> - Author: <b>%s</b> - Last: #%d' % (series_name, authors_to_string(authors), max_value)
+                else:
+                    header_text = 'Series: <b>%s</b> - Last: #%d'%(series_name, max_value)
                 self.log(header_text)
                 self.log('\tMissing#: ', ','.join(map(str, missing_ids)))
 
@@ -260,13 +202,13 @@ class MetadataCheck(BaseCheck):
             self.show_invalid_rows(result_ids, 'series_gaps')
             self.gui.library_view.sort_by_named_field('series', True)
 
-        msg = _('Checked %d books, found %d gaps in %d series') %(total_count, book_gap_count, series_gap_count)
+        msg = _('Checked %d books, found %d gaps in %d series') %(len(book_ids), book_gap_count, series_gap_count)
         self.gui.status_bar.showMessage(msg)
         if len(result_ids) == 0:
-            info_dialog(self.gui, _('No Matches%s')%cancelled_msg,
+            info_dialog(self.gui, _('No Matches'),
                                _('No series gaps exist in the books searched'), show=True)
         else:
-            ResultsSummaryDialog(self.gui, _('Series Gaps Found%s')%cancelled_msg, msg, self.log).exec_()
+            ResultsSummaryDialog(self.gui, _('Series Gaps Found'), msg, self.log).exec_()
 
 
     def check_series_pubdate(self):
@@ -562,3 +504,129 @@ class MetadataCheck(BaseCheck):
                              marked_text='invalid_title_case',
                              status_msg_type=_('books for invalid title casing'))
 
+
+def get_duplicate_isbn_ids(book_ids, isbn_map):
+    '''
+    Return the ids of the books sharing an ISBN with another book, given a
+    map of the ISBN of each book id
+    '''
+    books_by_isbn = defaultdict(list)
+    for book_id in book_ids:
+        isbn = isbn_map.get(book_id, None)
+        if isbn:
+            books_by_isbn[isbn].append(book_id)
+    return [book_id for values in books_by_isbn.values() if len(values) > 1 for book_id in values]
+
+
+def get_duplicate_series_ids(book_ids, series_map, series_index_map):
+    '''
+    Return the ids of the books sharing both a series and series index with
+    another book, given maps of the series and series index of each book id
+    '''
+    books_by_series = defaultdict(list)
+    for book_id in book_ids:
+        series = series_map.get(book_id, None)
+        if series:
+            books_by_series[(series, '%0.4f'%series_index_map.get(book_id, 1.0))].append(book_id)
+    return [book_id for values in books_by_series.values() if len(values) > 1 for book_id in values]
+
+
+def get_series_gaps(book_ids, series_map, series_index_map):
+    '''
+    Return a list of (series_name, book_ids, last_index, missing_indexes)
+    ordered by series name, for each series with whole number indexes below
+    1000. The missing indexes are those from 1 up to the last index which
+    no book in the series has.
+    '''
+    series_name_book_map = defaultdict(list)
+    series_name_indexes_map = defaultdict(set)
+    for book_id in book_ids:
+        series = series_map.get(book_id, None)
+        if series:
+            series_index = series_index_map.get(book_id, 1.0)
+            series_name_book_map[series].append(book_id)
+            if round(series_index) == series_index and series_index > 0:
+                series_name_indexes_map[series].add(int(series_index))
+    series_gaps = []
+    for series_name in sorted(series_name_indexes_map.keys(), key=lambda s: s.lower()):
+        series_indexes = series_name_indexes_map[series_name]
+        max_value = max(series_indexes)
+        if max_value >= 1000:
+            continue
+        missing_ids = [idx for idx in range(1, max_value) if idx not in series_indexes]
+        series_gaps.append((series_name, series_name_book_map[series_name], max_value, missing_ids))
+    return series_gaps
+
+
+def do_bulk_metadata_benchmark(book_count=100000):
+    '''
+    Time the duplicate ISBN, duplicate series and series gaps checks over a
+    synthetic library, reading the fields of one book at a time through the
+    legacy api as these checks used to, against loading each whole column
+    through the new api.
+    '''
+    import random, shutil, tempfile, time
+    from calibre import prints
+    from calibre.db.legacy import LibraryDatabase
+
+    tdir = tempfile.mkdtemp()
+    try:
+        db = LibraryDatabase(tdir)
+        db.new_api.backend.executemany('INSERT INTO books (title) VALUES (?)',
+                                       [('Book %d'%i,) for i in range(book_count)])
+        db.close()
+        db = LibraryDatabase(tdir)
+        api = db.new_api
+        book_ids = sorted(api.all_book_ids())
+        # Every 50th book shares an ISBN, and books are in series of up to
+        # ten with the odd duplicated or missing index
+        rand = random.Random(42)
+        identifiers_map, series_map, series_index_map = {}, {}, {}
+        for i, book_id in enumerate(book_ids):
+            identifiers_map[book_id] = {'isbn': '978%010d' % (i - 1 if i % 50 == 0 else i)}
+            if i % 4:
+                series_map[book_id] = 'Series %d' % (i // 10)
+                series_index_map[book_id] = rand.choice([i % 10 + 1, i % 10 + 1, i % 10 + 2, 1.5])
+        api.set_field('identifiers', identifiers_map)
+        api.set_field('series', series_map)
+        api.set_field('series_index', series_index_map)
+        db.close()
+        db = LibraryDatabase(tdir)
+        api = db.new_api
+
+        start = time.time()
+        isbn_map = dict((book_id, db.isbn(book_id, index_is_id=True)) for book_id in book_ids)
+        series_map = dict((book_id, db.series(book_id, index_is_id=True)) for book_id in book_ids)
+        series_index_map = dict((book_id, db.series_index(book_id, index_is_id=True)) for book_id in book_ids)
+        legacy_results = (get_duplicate_isbn_ids(book_ids, isbn_map),
+                          get_duplicate_series_ids(book_ids, series_map, series_index_map),
+                          get_series_gaps(book_ids, series_map, series_index_map))
+        legacy_elapsed = time.time() - start
+
+        start = time.time()
+        identifiers_map = api.all_field_for('identifiers', book_ids, default_value={})
+        isbn_map = dict((book_id, (identifiers or {}).get('isbn', None))
+                        for book_id, identifiers in identifiers_map.items())
+        series_map = api.all_field_for('series', book_ids)
+        series_index_map = api.all_field_for('series_index', book_ids)
+        bulk_results = (get_duplicate_isbn_ids(book_ids, isbn_map),
+                        get_duplicate_series_ids(book_ids, series_map, series_index_map),
+                        get_series_gaps(book_ids, series_map, series_index_map))
+        bulk_elapsed = time.time() - start
+        db.close()
+
+        if legacy_results != bulk_results:
+            prints('Failed: bulk results differ from reading each book')
+        prints('Duplicate ISBN: %d books   Duplicate series: %d books   Series with gaps: %d of %d' % (
+                    len(bulk_results[0]), len(bulk_results[1]),
+                    len([g for g in bulk_results[2] if g[3]]), len(bulk_results[2])))
+        prints('%d books   per book legacy api: %.2fs   whole columns: %.2fs' % (
+                    book_count, legacy_elapsed, bulk_elapsed))
+    finally:
+        shutil.rmtree(tdir, ignore_errors=True)
+
+
+# For testing, run from command line with this:
+# calibre-debug -e check_metadata.py
+if __name__ == '__main__':
+    do_bulk_metadata_benchmark()
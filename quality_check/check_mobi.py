@@ -21,6 +21,8 @@ class MobiCheck(BaseCheck):
     All checks related to working with MOBI formats.
     '''
     MOBI_FORMATS = ['MOBI', 'AZW', 'AZW3']
+    worker_cat = 'mobi'
+    worker_formats = MOBI_FORMATS
 
     def __init__(self, gui):
         BaseCheck.__init__(self, gui, 'formats:=mobi or formats:=azw or formats:=azw3')
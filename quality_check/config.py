@@ -43,6 +43,7 @@ KEY_MAX_TAG_EXCLUSIONS = 'maxTagExclusions'
 KEY_HIDDEN_MENUS = 'hiddenMenus'
 KEY_SEARCH_SCOPE = 'searchScope'
 KEY_SEARCH_HISTORY_LENGTH = 'searchHistoryLength'
+KEY_USE_SEARCH_INDEX = 'useSearchIndex'
 
 SCOPE_LIBRARY = 'Library'
 SCOPE_SELECTION = 'Selection'
@@ -51,7 +52,8 @@ DEFAULT_STORE_VALUES = {
                            KEY_MAX_TAGS: 5,
                            KEY_MAX_TAG_EXCLUSIONS: [],
                            KEY_HIDDEN_MENUS: [],
-                           KEY_SEARCH_HISTORY_LENGTH: 10
+                           KEY_SEARCH_HISTORY_LENGTH: 10,
+                           KEY_USE_SEARCH_INDEX: False
                        }
 
 # Per library we store an exclusions map
@@ -152,6 +154,7 @@ PLUGIN_MENUS = OrderedDict([
        ('check_missing_cover',      {'name': _('Check missing cover'),            'cat':'missing',  'sub_menu': _('Check missing'),  'group': 1, 'excludable': False,  'image': 'images/check_book.png',               'tooltip':_('Find books missing a cover')}),
        ('check_missing_formats',    {'name': _('Check missing formats'),          'cat':'missing',  'sub_menu': _('Check missing'),  'group': 1, 'excludable': False,  'image': 'images/check_book.png',               'tooltip':_('Find books missing formats')}),
 
+       ('check_epub_multiple',      {'name': _('Run several ePub checks')+'...',  'cat':'epub',     'sub_menu': '',               'group': 0, 'excludable': False, 'image': 'images/check_book.png',                 'tooltip':_('Run your chosen ePub checks together, reading each ePub book only once')}),
        ('search_epub',              {'name': _('Search ePubs')+'...',             'cat':'epub',     'sub_menu': '',               'group': 0, 'excludable': False, 'image': 'search.png',                           'tooltip':_('Find ePub books with text matching your own regular expression')}),
        ])
 
@@ -339,6 +342,13 @@ class ConfigWidget(QWidget):
         self.search_history_spin.setMaximum(100)
         self.search_history_spin.setProperty('value', c.get(KEY_SEARCH_HISTORY_LENGTH, 10))
         other_layout.addWidget(self.search_history_spin, 2, 1, 1, 1)
+
+        self.search_index_checkbox = QCheckBox(_('Use an index to speed up Search ePubs'), self)
+        self.search_index_checkbox.setToolTip(_('Keep an index of the text of your ePub books, updated in the background after each search, '
+                                                'so searches only read the books and files which could contain the text searched for'))
+        if c.get(KEY_USE_SEARCH_INDEX, False):
+            self.search_index_checkbox.setCheckState(Qt.Checked)
+        other_layout.addWidget(self.search_index_checkbox, 3, 0, 1, 2)
         other_layout.setColumnStretch(2, 1)
 
         menus_groupbox = QGroupBox(_('Visible menus'))
@@ -375,6 +385,7 @@ class ConfigWidget(QWidget):
         new_prefs[KEY_SUPPRESS_FIX_DIALOG] = self.suppress_dialog_checkbox.checkState() == Qt.Checked
         new_prefs[KEY_SEARCH_SCOPE] = plugin_prefs[STORE_OPTIONS].get(KEY_SEARCH_SCOPE, SCOPE_LIBRARY)
         new_prefs[KEY_SEARCH_HISTORY_LENGTH] = int(unicode(self.search_history_spin.value()))
+        new_prefs[KEY_USE_SEARCH_INDEX] = self.search_index_checkbox.checkState() == Qt.Checked
         
         new_prefs[KEY_HIDDEN_MENUS] = self.visible_menus_list.get_hidden_menus()
         # For each menu that was visible but now is not, we need to unregister any
@@ -5,6 +5,7 @@ __copyright__ = '2011, Grant Drake'
 
 import six
 from six.moves import range
+from six.moves.queue import Empty
 from six import text_type as unicode
 
 try:
@@ -16,21 +17,26 @@ try:
     from qt.core import (QVBoxLayout, QLabel, QRadioButton, QDialogButtonBox,
                           QGroupBox, QGridLayout, QComboBox, QProgressDialog,
                           QTimer, QIcon, QTableWidget, QHBoxLayout, QSpacerItem, QSizePolicy,
-                          QAbstractItemView, Qt, QCheckBox, QSpinBox, QToolButton)
+                          QAbstractItemView, Qt, QCheckBox, QSpinBox, QToolButton,
+                          QListWidget, QListWidgetItem, QSize)
 except:
     from PyQt5.Qt import (QVBoxLayout, QLabel, QRadioButton, QDialogButtonBox,
                           QGroupBox, QGridLayout, QComboBox, QProgressDialog,
                           QTimer, QIcon, QTableWidget, QHBoxLayout, QSpacerItem, QSizePolicy,
-                          QAbstractItemView, Qt, QCheckBox, QSpinBox, QToolButton)
+                          QAbstractItemView, Qt, QCheckBox, QSpinBox, QToolButton,
+                          QListWidget, QListWidgetItem, QSize)
 
 from calibre.ebooks.metadata import authors_to_string, fmt_sidx
 from calibre.gui2 import gprefs, error_dialog
 from calibre.gui2.dialogs.message_box import MessageBox
+from calibre.utils.ipc.job import ParallelJob
+from calibre.utils.ipc.server import Server
 
 import calibre_plugins.quality_check.config as cfg
 from calibre_plugins.quality_check.common_dialogs import SizePersistedDialog, ViewLogDialog
 from calibre_plugins.quality_check.common_icons import get_icon
 from calibre_plugins.quality_check.common_widgets import ImageTitleLayout, ReadOnlyTableWidgetItem
+from calibre_plugins.quality_check.jobs import get_batch_size
 
 def truncate_title(title, length = 75):
     return (title[:length] + '...') if len(title) > length else title
@@ -72,6 +78,102 @@ class QualityProgressDialog(QProgressDialog):
         self.gui = None
 
 
+class QualityJobProgressDialog(QProgressDialog):
+    '''
+    Performs a check of book files on a pool of worker processes, the books
+    being sent to the workers in batches. As each batch completes its matches
+    are counted, with the result and log written by the check for each book
+    kept in book_results as (matched, log_entries).
+    '''
+    def __init__(self, gui, book_ids, worker_cat, worker_formats, menu_key, options, db,
+                 status_msg_type='books', action_type=_('Checking')):
+        self.total_count = len(book_ids)
+        QProgressDialog.__init__(self, '', _('Cancel'), 0, self.total_count, gui)
+        self.setMinimumWidth(500)
+        self.book_ids, self.db = book_ids, db
+        self.worker_cat, self.worker_formats = worker_cat, worker_formats
+        self.menu_key, self.options = menu_key, options
+        self.action_type, self.status_msg_type = action_type, status_msg_type
+        self.gui = gui
+        self.setWindowTitle('%s %d %s...' % (self.action_type, self.total_count, self.status_msg_type))
+        self.result_ids, self.book_results, self.error_entries = [], {}, []
+        self.pool_size = gui.job_manager.server.pool_size
+        batch_size = get_batch_size(self.total_count, self.pool_size)
+        self.batches = [book_ids[i:i+batch_size] for i in range(0, self.total_count, batch_size)]
+        self.running_jobs, self.checked_count = [], 0
+        self.server = None
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.poll_jobs)
+        # QTimer workaround on Win 10 on first go for Win10/Qt6 users not displaying dialog properly.
+        QTimer.singleShot(100, self.start_jobs)
+        self.exec_()
+
+    def start_jobs(self):
+        self.server = Server(pool_size=self.pool_size)
+        self.timer.start(100)
+
+    def queue_batch(self, batch_ids):
+        books = []
+        for book_id in batch_ids:
+            format_paths = {}
+            for fmt in self.worker_formats:
+                if self.db.has_format(book_id, fmt, index_is_id=True):
+                    format_paths[fmt] = self.db.format_abspath(book_id, fmt, index_is_id=True)
+            books.append((book_id, self.db.title(book_id, index_is_id=True),
+                          self.db.authors(book_id, index_is_id=True), format_paths))
+        args = ['calibre_plugins.quality_check.jobs', 'do_check_books',
+                (self.worker_cat, self.menu_key, self.options, books)]
+        job = ParallelJob('arbitrary_n', 'Quality Check: %s' % self.menu_key, done=None, args=args)
+        job._batch_ids = batch_ids
+        self.server.add_job(job)
+        self.running_jobs.append(job)
+
+    def poll_jobs(self):
+        if self.wasCanceled():
+            return self.do_close()
+        # Keep the pool busy while only resolving the paths of a few batches ahead
+        while self.batches and len(self.running_jobs) < self.pool_size * 2:
+            self.queue_batch(self.batches.pop(0))
+        while True:
+            try:
+                job = self.server.changed_jobs_queue.get_nowait()
+            except Empty:
+                break
+            # A job 'changes' for each book it notifies of, as well as when it finishes
+            job.update()
+            if job.is_finished and job in self.running_jobs:
+                self.job_finished(job)
+        if not self.batches and not self.running_jobs:
+            return self.do_close()
+
+        running_count = sum(len(job._batch_ids) * job.percent / 100. for job in self.running_jobs)
+        self.setWindowTitle(_('%s %d %s  (%d matches)...') % (self.action_type, self.total_count, self.status_msg_type, len(self.result_ids)))
+        self.setLabelText(_('%s: %d of %d books') % (self.action_type, self.checked_count, self.total_count))
+        self.setValue(min(self.total_count, self.checked_count + int(running_count)))
+
+    def job_finished(self, job):
+        self.running_jobs.remove(job)
+        self.checked_count += len(job._batch_ids)
+        if job.failed or job.result is None:
+            self.error_entries.append(('error', [_('ERROR: Check failed for %d books:')%len(job._batch_ids),
+                                                 job.details]))
+            return
+        for book_id, matched, entries in job.result:
+            if matched:
+                self.result_ids.append(book_id)
+            self.book_results[book_id] = (matched, entries)
+
+    def do_close(self):
+        self.timer.stop()
+        if self.server is not None:
+            # Stops any workers still running if the check was cancelled
+            self.server.close()
+            self.server = None
+        self.hide()
+        self.gui = None
+
+
+
 class CompareTypeComboBox(QComboBox):
 
     def __init__(self, parent, allow_equality=True):
@@ -667,6 +769,69 @@ class SearchEpubDialog(SizePersistedDialog):
         return self.search_opts
 
 
+class SelectEpubChecksDialog(SizePersistedDialog):
+
+    def __init__(self, parent):
+        SizePersistedDialog.__init__(self, parent, _('quality check plugin:select epub checks dialog'))
+
+        self.initialize_controls()
+
+        # Check the same checks as the last time the dialog was used
+        selected_keys = self.load_custom_pref('menu_keys', [])
+        for x in range(self.checks_list.count()):
+            item = self.checks_list.item(x)
+            if unicode(item.data(Qt.UserRole)) in selected_keys:
+                item.setCheckState(Qt.Checked)
+
+        # Cause our dialog size to be restored from prefs or created on first usage
+        self.resize_dialog()
+
+    def initialize_controls(self):
+        self.setWindowTitle('Quality Check')
+        layout = QVBoxLayout(self)
+        self.setLayout(layout)
+        title_layout = ImageTitleLayout(self, 'images/check_book.png', _('Run several ePub checks'))
+        layout.addLayout(title_layout)
+        self.setMinimumSize(300, 350)
+
+        layout.addWidget(QLabel(_('Choose the checks to run, each ePub book is read once for all of them:'), self))
+        self.checks_list = QListWidget(self)
+        self.checks_list.setSelectionMode(QAbstractItemView.NoSelection)
+        self.checks_list.setIconSize(QSize(16,16))
+        for menu_key, value in cfg.PLUGIN_MENUS.items():
+            if value['cat'] != 'epub' or not value['excludable']:
+                continue
+            name = value['name']
+            if value['sub_menu']:
+                name = value['sub_menu'] + ' -> ' + name
+            item = QListWidgetItem(get_icon(value['image']), name, self.checks_list)
+            item.setData(Qt.UserRole, menu_key)
+            item.setCheckState(Qt.Unchecked)
+        layout.addWidget(self.checks_list)
+
+        button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        button_box.accepted.connect(self.ok_clicked)
+        button_box.rejected.connect(self.reject)
+        layout.addWidget(button_box)
+
+    def ok_clicked(self):
+        if not self.menu_keys:
+            return error_dialog(self, _('No checks selected'),
+                                _('You must choose at least one check to run.'),
+                                show=True, show_copy_button=False)
+        self.save_custom_pref('menu_keys', self.menu_keys)
+        self.accept()
+
+    @property
+    def menu_keys(self):
+        keys = []
+        for x in range(self.checks_list.count()):
+            item = self.checks_list.item(x)
+            if item.checkState() == Qt.Checked:
+                keys.append(unicode(item.data(Qt.UserRole)))
+        return keys
+
+
 class ApplyFixProgressDialog(QProgressDialog):
 
     def __init__(self, gui, title, book_ids, tdir, apply_fix_callback):
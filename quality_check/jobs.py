@@ -0,0 +1,116 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import traceback
+
+from six import text_type as unicode
+
+# Number of books given to each worker job. A worker process is started for
+# every job, so batches must be large enough for that cost to be negligible,
+# while still giving each worker of the pool a share of the books.
+MIN_BATCH_SIZE = 25
+MAX_BATCH_SIZE = 500
+
+
+def get_batch_size(book_count, pool_size):
+    return max(MIN_BATCH_SIZE, min(MAX_BATCH_SIZE, book_count // (pool_size * 4)))
+
+
+class WorkerDb(object):
+    '''
+    Answers the calls made on the library database by the checks of book files,
+    from the format paths, titles and authors sent to the worker for each book.
+    '''
+    def __init__(self, books):
+        self.books_map = dict((book_id, (title, authors, format_paths))
+                              for book_id, title, authors, format_paths in books)
+
+    def title(self, book_id, index_is_id=True):
+        return self.books_map[book_id][0]
+
+    def authors(self, book_id, index_is_id=True):
+        return self.books_map[book_id][1]
+
+    def has_format(self, book_id, fmt, index_is_id=True):
+        return fmt.upper() in self.books_map[book_id][2]
+
+    def format_abspath(self, book_id, fmt, index_is_id=True):
+        return self.books_map[book_id][2].get(fmt.upper(), None)
+
+
+class BookLog(object):
+    '''
+    Records what a check logs for a book, to be written to the log of the
+    check in the GUI once the results are known, as well as cached with them.
+    '''
+    def __init__(self):
+        self.entries = []
+
+    def _add(self, level, args):
+        self.entries.append((level, [unicode(arg) for arg in args]))
+
+    def __call__(self, *args):
+        self._add('info', args)
+
+    def info(self, *args):
+        self._add('info', args)
+
+    def debug(self, *args):
+        self._add('debug', args)
+
+    def warn(self, *args):
+        self._add('warn', args)
+
+    def error(self, *args):
+        self._add('error', args)
+
+
+def create_check(worker_cat, options):
+    if worker_cat == 'epub':
+        from calibre_plugins.quality_check.check_epub import EpubCheck
+        check = EpubCheck(None)
+    elif worker_cat == 'mobi':
+        from calibre_plugins.quality_check.check_mobi import MobiCheck
+        check = MobiCheck(None)
+    else:
+        raise ValueError('No worker check for category: %s' % worker_cat)
+    check.options = options
+    return check
+
+
+def do_check_books(worker_cat, menu_key, options, books, notification=lambda x, y:x):
+    '''
+    Worker job, running the check of this menu key on each book in the batch.
+
+    Each book is a tuple of (book_id, title, authors, {format: path}). Returns
+    a list of (book_id, matched, log_entries) in the order of the books.
+    '''
+    check = create_check(worker_cat, options)
+    check.menu_key = menu_key
+    check.log = BookLog()
+    visitors = check.get_check_visitors([menu_key])
+    db = WorkerDb(books)
+    results = []
+    for i, (book_id, title, authors, format_paths) in enumerate(books):
+        check.log = BookLog()
+        try:
+            matched = bool(check.evaluate_checks(visitors, book_id, db))
+        except:
+            check.log.error(traceback.format_exc())
+            matched = False
+        results.append((book_id, matched, check.log.entries))
+        notification(float(i + 1) / len(books), unicode(book_id))
+    return results
+
+
+def do_update_search_index(index_path, books, notification=lambda x, y:x):
+    '''
+    Job to bring the ePub search index of a library up to date for these
+    (book_id, path_to_book), returning the count of books indexed.
+    '''
+    from calibre_plugins.quality_check.check_epub import EpubCheck
+    from calibre_plugins.quality_check.search_index import SearchIndex
+    check = EpubCheck(None)
+    return SearchIndex(index_path).update(books, check.get_search_texts, notification)
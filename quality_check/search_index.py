@@ -0,0 +1,255 @@
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake'
+
+import os, sqlite3, traceback, zlib
+from six import unichr
+
+try:
+    load_translations()
+except NameError:
+    pass # load_translations() added in calibre 1.9
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse, sre_constants
+
+from calibre.utils.config import config_dir
+
+SEARCH_INDEX_DIR = os.path.join(config_dir, 'plugins', 'Quality Check', 'search_index')
+# Increment when the way the index is built changes, so it is rebuilt
+INDEX_VERSION = 1
+# Name under which the file names of the members of an ePub are indexed
+NAMES_KEY = ''
+# Bits set in the trigram bitset of a member for each distinct trigram, so
+# around a fifth of the bits are set and each trigram tested passes 1 in 5
+BITS_PER_TRIGRAM = 4
+MIN_BITS = 64
+
+
+def get_search_index_path(library_id):
+    return os.path.join(SEARCH_INDEX_DIR, '%s.db' % library_id)
+
+
+class _FoldTable(dict):
+    '''
+    Maps each character to a single lowercase character, taking characters
+    matched by another under re.IGNORECASE (such as the long s and kelvin
+    sign) to the same character. Built as characters are seen.
+    '''
+    def __missing__(self, code):
+        folded = unichr(code).lower()[:1]
+        upper = folded.upper()
+        if len(upper) == 1:
+            folded = upper.lower()[:1]
+        self[code] = folded
+        return folded
+
+_fold_table = _FoldTable()
+
+
+def fold_text(text):
+    '''
+    Fold the case of this text, preserving its length so any substring of
+    the text folds to a substring of the folded text
+    '''
+    return text.translate(_fold_table)
+
+
+def get_trigrams(text):
+    text = fold_text(text)
+    return set(text[i:i+3] for i in range(len(text) - 2))
+
+
+def hash_trigram(trigram):
+    return zlib.crc32(trigram.encode('utf-8', 'replace')) & 0xffffffff
+
+
+def get_required_literals(pattern, flags=0):
+    '''
+    Return the literal strings any match of this regular expression must
+    contain, from runs of literal characters outside of any alternation,
+    optional or repeated part. Returns an empty list if there are none.
+    '''
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except:
+        return []
+    literals = []
+    current = []
+
+    def end_literal():
+        if current:
+            literals.append(''.join(current))
+            del current[:]
+
+    def walk(items):
+        for op, av in items:
+            if op == sre_constants.LITERAL:
+                current.append(unichr(av))
+            elif op == sre_constants.AT:
+                # Anchors match no characters, so the literals either side are adjacent
+                continue
+            elif op == sre_constants.SUBPATTERN:
+                # A group matches its contents once, in sequence with the rest
+                walk(av[-1])
+            elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+                end_literal()
+                walk(av[2])
+                end_literal()
+            else:
+                end_literal()
+
+    walk(parsed)
+    end_literal()
+    return literals
+
+
+def get_required_trigram_hashes(search_expression):
+    '''
+    Return the hashes of the trigrams in the literals any match of this
+    compiled regular expression must contain, which is empty if the index
+    is not able to narrow the books to search for it.
+    '''
+    trigrams = set()
+    for literal in get_required_literals(search_expression.pattern, search_expression.flags):
+        trigrams.update(get_trigrams(literal))
+    return set(hash_trigram(t) for t in trigrams)
+
+
+def create_bitset(trigrams):
+    nbits = MIN_BITS
+    while nbits < len(trigrams) * BITS_PER_TRIGRAM:
+        nbits *= 2
+    bits = bytearray(nbits // 8)
+    mask = nbits - 1
+    for trigram in trigrams:
+        h = hash_trigram(trigram) & mask
+        bits[h >> 3] |= 1 << (h & 7)
+    return bytes(bits)
+
+
+def bitset_contains(bits, trigram_hashes):
+    bits = bytearray(bits)
+    mask = len(bits) * 8 - 1
+    for h in trigram_hashes:
+        h &= mask
+        if not bits[h >> 3] & (1 << (h & 7)):
+            return False
+    return True
+
+
+class SearchIndex(object):
+    '''
+    An index on disk of the text of the ePubs in a library, for each member
+    of a book holding a bitset of the trigrams of the text the search could
+    match in it. Searching for an expression only reads those members whose
+    bitset has all the trigrams of the literals the expression requires.
+
+    Each book is indexed with the path, size and modification time of its
+    ePub, so the index is only used for books whose ePub is unchanged since.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None and os.path.exists(self.path):
+            conn = sqlite3.connect(self.path, timeout=30)
+            if conn.execute('PRAGMA user_version').fetchone()[0] != INDEX_VERSION:
+                conn.close()
+                return None
+            self._conn = conn
+        return self._conn
+
+    def get_candidate_names(self, book_id, path_to_book, trigram_hashes):
+        '''
+        Return the set of names of the members of this book which could match,
+        including NAMES_KEY if any member file name could. Returns None if the
+        book is not indexed or its ePub has changed since it was indexed.
+        '''
+        try:
+            conn = self._connect()
+            if conn is None:
+                return None
+            row = conn.execute('SELECT path, size, mtime FROM books WHERE book_id=?', (book_id,)).fetchone()
+            stat = os.stat(path_to_book)
+            if row is None or tuple(row) != (path_to_book, stat.st_size, stat.st_mtime):
+                return None
+            return set(name for name, bits in conn.execute('SELECT name, bits FROM members WHERE book_id=?', (book_id,))
+                       if bitset_contains(bits, trigram_hashes))
+        except (sqlite3.Error, OSError, IOError):
+            # Such as the index being updated by the background job
+            return None
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def update(self, books, get_search_texts, notification=lambda x, y:x):
+        '''
+        Bring the index up to date for these (book_id, path_to_book), indexing
+        only books whose ePub has changed and removing any other books. The
+        get_search_texts function returns the (name, texts) of a book.
+        Returns the count of books indexed.
+        '''
+        index_dir = os.path.dirname(self.path)
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            # Allows searches to read the index while it is being updated
+            conn.execute('PRAGMA journal_mode=WAL')
+            if conn.execute('PRAGMA user_version').fetchone()[0] != INDEX_VERSION:
+                conn.executescript('''
+                    DROP TABLE IF EXISTS books;
+                    DROP TABLE IF EXISTS members;
+                    CREATE TABLE books (book_id INTEGER PRIMARY KEY, path TEXT, size INTEGER, mtime REAL);
+                    CREATE TABLE members (book_id INTEGER, name TEXT, bits BLOB);
+                    CREATE INDEX members_book_id ON members (book_id);
+                    PRAGMA user_version=%d;
+                    ''' % INDEX_VERSION)
+            indexed_map = dict((row[0], tuple(row[1:])) for row in
+                               conn.execute('SELECT book_id, path, size, mtime FROM books'))
+            book_ids = set(book_id for book_id, path_to_book in books)
+            for book_id in indexed_map:
+                if book_id not in book_ids:
+                    self._remove_book(conn, book_id)
+
+            indexed_count = 0
+            for i, (book_id, path_to_book) in enumerate(books):
+                notification(float(i) / len(books), _('Indexing ePub books'))
+                try:
+                    stat = os.stat(path_to_book)
+                except OSError:
+                    continue
+                book_key = (path_to_book, stat.st_size, stat.st_mtime)
+                if indexed_map.get(book_id, None) == book_key:
+                    continue
+                self._remove_book(conn, book_id)
+                try:
+                    search_texts = get_search_texts(path_to_book)
+                except:
+                    # Leave the book to be searched in full, reporting the error
+                    traceback.print_exc()
+                    continue
+                conn.executemany('INSERT INTO members (book_id, name, bits) VALUES (?, ?, ?)',
+                    [(book_id, name, sqlite3.Binary(create_bitset(set().union(*[get_trigrams(t) for t in texts]))))
+                     for name, texts in search_texts])
+                conn.execute('INSERT INTO books (book_id, path, size, mtime) VALUES (?, ?, ?, ?)',
+                             (book_id,) + book_key)
+                indexed_count += 1
+                if indexed_count % 50 == 0:
+                    conn.commit()
+            conn.commit()
+            print('Indexed %d ePub books of %d' % (indexed_count, len(books)))
+            return indexed_count
+        finally:
+            conn.close()
+
+    def _remove_book(self, conn, book_id):
+        conn.execute('DELETE FROM books WHERE book_id=?', (book_id,))
+        conn.execute('DELETE FROM members WHERE book_id=?', (book_id,))
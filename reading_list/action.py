@@ -4,7 +4,6 @@ __license__ = 'GPL v3'
 __copyright__ = '2011, Grant Drake'
 
 import threading, re
-from collections import OrderedDict
 from functools import partial
 
 import six
@@ -257,19 +256,19 @@ class ReadingListAction(InterfaceAction):
                                         triggered=partial(self._toggle_selected_on_list, list_name))
 
             m.addSeparator()
-            list_content = library[cfg.KEY_LISTS][default_list_name][cfg.KEY_CONTENT]
+            list_count = cfg.get_book_list_count(db, default_list_name)
             std_name = _('View default list')
             unq_name = 'View default list'
-            self.view_list_action = create_menu_action_unique(self, m, _('View %s list (%d)') % (default_list_name, len(list_content)),
+            self.view_list_action = create_menu_action_unique(self, m, _('View %s list (%d)') % (default_list_name, list_count),
                                                         image='search.png', unique_name=unq_name,
                                                         shortcut_name=std_name, favourites_menu_unique_name=std_name,
                                                         triggered=partial(self.view_list, default_list_name))
             if view_topmenu_names:
                 for list_name in view_topmenu_names:
-                    list_content = library[cfg.KEY_LISTS][list_name][cfg.KEY_CONTENT]
+                    list_count = cfg.get_book_list_count(db, list_name)
                     std_name = _('View books on the "%s" list') % list_name
                     unq_name = 'View books on the "%s" list' % list_name
-                    create_menu_action_unique(self, m, _('View %s list (%d)') % (list_name, len(list_content)),
+                    create_menu_action_unique(self, m, _('View %s list (%d)') % (list_name, list_count),
                                         image='search.png',
                                         tooltip=std_name, unique_name=unq_name, shortcut_name=std_name,
                                         favourites_menu_unique_name=_('View list: %s') % list_name,
@@ -282,10 +281,10 @@ class ReadingListAction(InterfaceAction):
                 self.view_sub_menu_action.unique_name = 'View list'
                 if view_submenu_list_names:
                     for list_name in view_submenu_list_names:
-                        list_content = library[cfg.KEY_LISTS][list_name][cfg.KEY_CONTENT]
+                        list_count = cfg.get_book_list_count(db, list_name)
                         std_name = _('View books on the "%s" list') % list_name
                         unq_name = 'View books on the "%s" list' % list_name
-                        create_menu_action_unique(self, self.view_sub_menu, '%s (%d)' % (list_name, len(list_content)),
+                        create_menu_action_unique(self, self.view_sub_menu, '%s (%d)' % (list_name, list_count),
                                             tooltip=std_name, unique_name=unq_name, shortcut_name=std_name,
                                             favourites_menu_unique_name=_('View list: %s') % list_name,
                                             triggered=partial(self.view_list, list_name))
@@ -293,10 +292,10 @@ class ReadingListAction(InterfaceAction):
                     if view_submenu_list_names:
                         self.view_sub_menu.addSeparator()
                     for list_name in view_submenu_auto_names:
-                        list_content = library[cfg.KEY_LISTS][list_name][cfg.KEY_CONTENT]
+                        list_count = cfg.get_book_list_count(db, list_name)
                         std_name = _('View books on the "%s" list') % list_name
                         unq_name = 'View books on the "%s" list' % list_name
-                        create_menu_action_unique(self, self.view_sub_menu, '%s (%d)' % (list_name, len(list_content)),
+                        create_menu_action_unique(self, self.view_sub_menu, '%s (%d)' % (list_name, list_count),
                                             tooltip=std_name, unique_name=unq_name, shortcut_name=std_name,
                                             favourites_menu_unique_name=_('View list: %s') % list_name,
                                             triggered=partial(self.view_list, list_name))
@@ -336,11 +335,11 @@ class ReadingListAction(InterfaceAction):
                 self.clear_sub_menu_action.favourites_menu_unique_name = _('Clear list')
                 total_count = 0
                 for list_name in list_names:
-                    list_content = library[cfg.KEY_LISTS][list_name][cfg.KEY_CONTENT]
-                    total_count += len(list_content)
+                    list_count = cfg.get_book_list_count(db, list_name)
+                    total_count += list_count
                     std_name = _('Clear the "%s" list') % list_name
                     unq_name = 'Clear the "%s" list' % list_name
-                    create_menu_action_unique(self, self.clear_sub_menu, '%s (%d)' % (list_name, len(list_content)),
+                    create_menu_action_unique(self, self.clear_sub_menu, '%s (%d)' % (list_name, list_count),
                                         tooltip=std_name, unique_name=unq_name, shortcut_name=std_name,
                                         favourites_menu_unique_name=_('Clear list: %s') % list_name,
                                         triggered=partial(self._clear_list, list_name))
@@ -487,12 +486,9 @@ class ReadingListAction(InterfaceAction):
 
         lists_in_use = []
         for list_name in list_names:
-            book_ids = cfg.get_book_list(db, list_name)
-            id_map = dict([(book_id, True) for book_id in book_ids])
-            for book_id in selected_ids:
-                if book_id in id_map:
-                    lists_in_use.append(list_name)
-                    break
+            book_ids = set(cfg.get_book_list(db, list_name))
+            if not book_ids.isdisjoint(selected_ids):
+                lists_in_use.append(list_name)
 
         # Prompt user to figure out which lists to remove from and move to
         d = MoveBooksDialog(self.gui, lists_in_use, list_names)
@@ -548,19 +544,7 @@ class ReadingListAction(InterfaceAction):
         db = self.gui.current_db
 
         with self.sync_lock:
-            book_ids = cfg.get_book_list(db, list_name)
-            id_map = OrderedDict([(book_id, True) for book_id in book_ids])
-            new_ids = []
-            removed_ids = []
-            for calibre_id in book_id_list:
-                if calibre_id not in id_map:
-                    new_ids.append(calibre_id)
-                    book_ids.append(calibre_id)
-                else:
-                    removed_ids.append(calibre_id)
-                    book_ids.remove(calibre_id)
-
-            cfg.set_book_list(db, list_name, book_ids)
+            book_ids, new_ids, removed_ids = cfg.update_book_list(db, list_name, toggle_ids=book_id_list)
 
             # Add /remove tags to the books if necessary
             any_tags_changed = False
@@ -594,13 +578,7 @@ class ReadingListAction(InterfaceAction):
         db = self.gui.current_db
 
         with self.sync_lock:
-            book_ids = cfg.get_book_list(db, list_name)
-            id_map = OrderedDict([(book_id, True) for book_id in book_ids])
-            new_ids = []
-            for calibre_id in book_id_list:
-                if calibre_id not in id_map:
-                    new_ids.append(calibre_id)
-                    book_ids.append(calibre_id)
+            book_ids, new_ids, _removed_ids = cfg.update_book_list(db, list_name, add_ids=book_id_list)
 
             if not new_ids:
                 if display_warnings:
@@ -608,7 +586,6 @@ class ReadingListAction(InterfaceAction):
                                 'reading_list_already_on_list', self.gui,
                                 title=_('Failed to add to list'))
                 return False
-            cfg.set_book_list(db, list_name, book_ids)
 
             # Add tags to the books if necessary
             any_tags_changed = self.apply_tags_to_list(list_name, new_ids, add=True)
@@ -641,16 +618,9 @@ class ReadingListAction(InterfaceAction):
             any_tags_changed = False
             changed_series_ids = set()
             for list_name in list_names:
-                book_ids = cfg.get_book_list(db, list_name)
-                id_map = OrderedDict([(book_id, True) for book_id in book_ids])
-                new_ids = []
-                for calibre_id in book_id_list:
-                    if calibre_id not in id_map:
-                        new_ids.append(calibre_id)
-                        book_ids.append(calibre_id)
+                book_ids, new_ids, _removed_ids = cfg.update_book_list(db, list_name, add_ids=book_id_list)
                 if new_ids:
                     updated_lists += 1
-                    cfg.set_book_list(db, list_name, book_ids)
                     # Add tags to the books if necessary
                     any_tags_changed |= self.apply_tags_to_list(list_name, new_ids, add=True)
                 changed_series_id_list = self.update_series_custom_column(list_name, book_ids)
@@ -687,20 +657,13 @@ class ReadingListAction(InterfaceAction):
         db = self.gui.current_db
 
         with self.sync_lock:
-            book_ids = cfg.get_book_list(db, list_name)
-            id_map = OrderedDict([(book_id, True) for book_id in book_ids])
-            removed_ids = []
-            for calibre_id in book_id_list:
-                if calibre_id in id_map:
-                    removed_ids.append(calibre_id)
-                    book_ids.remove(calibre_id)
+            book_ids, _new_ids, removed_ids = cfg.update_book_list(db, list_name, remove_ids=book_id_list)
 
             if not removed_ids:
                 if display_warnings:
                     confirm(_('The selected book(s) do not exist on this list'),
                                 'reading_list_not_on_list', self.gui)
                 return None, False
-            cfg.set_book_list(db, list_name, book_ids)
 
             # Remove tags from the books if necessary
             any_tags_changed = self.apply_tags_to_list(list_name, removed_ids, add=False)
@@ -738,16 +701,9 @@ class ReadingListAction(InterfaceAction):
             any_tags_changed = False
             changed_series_ids = set()
             for list_name in list_names:
-                book_ids = cfg.get_book_list(db, list_name)
-                id_map = OrderedDict([(book_id, True) for book_id in book_ids])
-                removed_ids = []
-                for calibre_id in book_id_list:
-                    if calibre_id in id_map:
-                        removed_ids.append(calibre_id)
-                        book_ids.remove(calibre_id)
+                book_ids, _new_ids, removed_ids = cfg.update_book_list(db, list_name, remove_ids=book_id_list)
                 if removed_ids:
                     updated_lists += 1
-                    cfg.set_book_list(db, list_name, book_ids)
                     # Add tags to the books if necessary
                     any_tags_changed |= self.apply_tags_to_list(list_name, removed_ids, add=False)
                 changed_series_id_list = self.update_series_custom_column(list_name, book_ids)
@@ -1068,29 +1024,29 @@ class ReadingListAction(InterfaceAction):
         custom_columns = db.field_metadata.custom_field_metadata()
         col = custom_columns.get(series_column, None)
         if col is None:
-            return
+            return changed_series_book_ids
         label = db.field_metadata.key_to_label(series_column)
 
         # Find all the books currently with this series name:
         query = '#%s:"%s"' % (label, series_name)
-        existing_series_book_ids = db.data.search_getting_ids(query, search_restriction='', use_virtual_library=False)
-
-        # Go through all the books on our list and assign the series name/index
+        existing_series_book_ids = set(db.data.search_getting_ids(query, search_restriction='', use_virtual_library=False))
+
+        # Work out the series name/index for the books on our list which differ, and
+        # clear it for any books left with this series which are no longer on the list
+        api = db.new_api
+        existing_names_map = api.all_field_for(series_column, book_ids, default_value=None)
+        existing_indices_map = api.all_field_for(series_column + '_index', book_ids, default_value=None)
+        series_values_map = {}
         for idx, book_id in enumerate(book_ids):
             series_idx = idx + 1
-            existing_series_name = db.get_custom(book_id, label=label, index_is_id=True)
-            existing_series_idx = db.get_custom_extra(book_id, label=label, index_is_id=True)
-            if series_name != existing_series_name or series_idx != existing_series_idx:
-                db.set_custom(book_id, series_name, label=label, commit=False, extra=series_idx)
-                changed_series_book_ids.append(book_id)
-            if book_id in existing_series_book_ids:
-                existing_series_book_ids.remove(book_id)
-
-        # Any books left on the existing series list are no longer on our reading list
-        for book_id in existing_series_book_ids:
-            db.set_custom(book_id, '', label=label, commit=False, extra=None)
-            changed_series_book_ids.append(book_id)
-        db.commit()
+            if series_name != existing_names_map.get(book_id) or series_idx != existing_indices_map.get(book_id):
+                series_values_map[book_id] = '%s [%d]' % (series_name, series_idx)
+        for book_id in existing_series_book_ids.difference(book_ids):
+            series_values_map[book_id] = ''
+
+        if series_values_map:
+            api.set_field(series_column, series_values_map)
+            changed_series_book_ids = list(series_values_map.keys())
         return changed_series_book_ids
 
     def _convert_calibre_ids_to_books(self, db, ids):
@@ -1145,8 +1101,8 @@ class ReadingListAction(InterfaceAction):
                     if lists_map:
                         all_lists_map.update(lists_map)
         total_count = 0
-        for list_info in all_lists_map.values():
-            total_count += len(list_info[cfg.KEY_CONTENT])
+        for list_name in all_lists_map:
+            total_count += cfg.get_book_list_count(db, list_name)
         return total_count
 
     def _get_connected_uuids_to_sync(self):
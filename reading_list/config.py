@@ -9,6 +9,7 @@ except NameError:
     pass # load_translations() added in calibre 1.9
 
 import copy, traceback
+from collections import OrderedDict
 import six
 from six import text_type as unicode
 
@@ -46,7 +47,7 @@ PREFS_NAMESPACE = 'ReadingListPlugin'
 
 PREFS_KEY_SETTINGS = 'settings'
 # 'settings': { 'default':'DefaultListName',
-#               'lists': { 'name': {'content':[],
+#               'lists': { 'name': {
 #                          'tagsColumn':'tags', 'tagsText: '',
 #                          'seriesColumn':'#foo', 'seriesName: '',
 #                          'syncDevice':'xxx_uuid',
@@ -56,6 +57,10 @@ PREFS_KEY_SETTINGS = 'settings'
 #                          'populateType': 'xxx',
 #                          'populateSearch': 'xxx',
 #                        }, ...
+PREFS_KEY_CONTENT = 'content:%s'
+# 'content:name': [book_id, ...]
+# The book ids of each list are stored in a separate key from the settings, so
+# that changing the books on one list only rewrites the ids of that list.
 KEY_LISTS = 'lists'
 KEY_DEFAULT_LIST = 'default'
 KEY_QUICK_ACCESS = 'quickAccess'
@@ -96,7 +101,7 @@ MODIFY_TYPES = [('TAGNONE',      _('Do not update calibre column')),
                 ('TAGREMOVE',    _('Update column for remove from list only'))]
 
 KEY_SCHEMA_VERSION = STORE_SCHEMA_VERSION = 'SchemaVersion'
-DEFAULT_SCHEMA_VERSION = 1.65
+DEFAULT_SCHEMA_VERSION = 1.66
 
 STORE_OPTIONS = 'Options'
 KEY_REMOVE_DIALOG = 'removeDialog'
@@ -111,7 +116,6 @@ STORE_DEVICES = 'Devices'
 DEFAULT_DEVICES_VALUES = {}
 
 DEFAULT_LIST_VALUES = {
-                        KEY_CONTENT: [],
                         KEY_MODIFY_ACTION: 'TAGADDREMOVE',
                         KEY_TAGS_COLUMN: '',
                         KEY_TAGS_TEXT: '',
@@ -227,6 +231,12 @@ def migrate_library_config_if_required(db, library_config):
         for list_info in six.itervalues(lists):
             list_info[KEY_RESTORE_SORT] = False
 
+    if schema_version < 1.66:
+        # Move the contents of each list out of the settings into its own key
+        lists = library_config[KEY_LISTS]
+        for list_name, list_info in six.iteritems(lists):
+            set_book_list(db, list_name, list_info.pop(KEY_CONTENT, []))
+
     set_library_config(db, library_config)
 
 def show_help():
@@ -276,19 +286,57 @@ def get_list_info(db, list_name):
     list_map = lists.get(list_name, DEFAULT_LIST_VALUES)
     return list_map
 
+def _get_stored_book_list(db, list_name):
+    return db.prefs.get_namespaced(PREFS_NAMESPACE, PREFS_KEY_CONTENT % list_name, [])
+
 def get_book_list(db, list_name):
-    list_map = get_list_info(db, list_name)
-    book_ids = list_map[KEY_CONTENT]
+    book_ids = _get_stored_book_list(db, list_name)
     valid_book_ids = [book_id for book_id in book_ids if db.data.has_id(book_id)]
     if len(book_ids) != len(valid_book_ids):
         set_book_list(db, list_name, valid_book_ids)
     return valid_book_ids
 
+def get_book_list_count(db, list_name):
+    return len(_get_stored_book_list(db, list_name))
+
 def set_book_list(db, list_name, book_ids):
-    library_config = get_library_config(db)
-    lists = library_config[KEY_LISTS]
-    lists[list_name][KEY_CONTENT] = book_ids
-    set_library_config(db, library_config)
+    db.prefs.set_namespaced(PREFS_NAMESPACE, PREFS_KEY_CONTENT % list_name, list(book_ids))
+
+def delete_book_list(db, list_name):
+    key = 'namespaced:%s:%s' % (PREFS_NAMESPACE, PREFS_KEY_CONTENT % list_name)
+    if key in db.prefs:
+        del db.prefs[key]
+
+def update_book_list(db, list_name, add_ids=(), remove_ids=(), toggle_ids=()):
+    '''
+    Change the books on a list treating it as an ordered set, so membership
+    checks are constant time and added books are appended to the end once.
+    Books to toggle are added if not on the list, otherwise removed.
+    Returns a tuple of (book_ids, added_ids, removed_ids) where book_ids is
+    the resulting content of the list. The list is only stored if changed.
+    '''
+    id_map = OrderedDict([(book_id, True) for book_id in get_book_list(db, list_name)])
+    added_ids = []
+    removed_ids = []
+    for book_id in remove_ids:
+        if book_id in id_map:
+            del id_map[book_id]
+            removed_ids.append(book_id)
+    for book_id in add_ids:
+        if book_id not in id_map:
+            id_map[book_id] = True
+            added_ids.append(book_id)
+    for book_id in toggle_ids:
+        if book_id in id_map:
+            del id_map[book_id]
+            removed_ids.append(book_id)
+        else:
+            id_map[book_id] = True
+            added_ids.append(book_id)
+    book_ids = list(id_map.keys())
+    if added_ids or removed_ids:
+        set_book_list(db, list_name, book_ids)
+    return book_ids, added_ids, removed_ids
 
 def set_default_list(db, list_name):
     library_config = get_library_config(db)
@@ -332,7 +380,7 @@ def get_view_topmenu_list_names(db):
 
 def create_list(db, list_name, book_ids):
     new_list = copy.deepcopy(DEFAULT_LIST_VALUES)
-    new_list[KEY_CONTENT] = list(book_ids)
+    set_book_list(db, list_name, book_ids)
     library_config = get_library_config(db)
     lists = library_config[KEY_LISTS]
     lists[list_name] = new_list
@@ -530,6 +578,10 @@ class ListsTab(QWidget):
         self.library_config = get_library_config(self.gui.current_db)
         self.lists = self.library_config[KEY_LISTS]
         self.default_list = self.library_config[KEY_DEFAULT_LIST]
+        # The contents of each list are stored under its name, so keep track of the
+        # original name of each list (None if added) to move its books when saved
+        self.stored_list_names = set(self.lists)
+        self.original_list_names = dict((list_name, list_name) for list_name in self.lists)
         self.populate_custom_columns = self._get_custom_columns(['text','bool','enumeration'])
         self.tags_custom_columns = self._get_custom_columns(['text','bool','enumeration'])
         self.series_custom_columns = self._get_custom_columns(['series'])
@@ -925,6 +977,7 @@ class ListsTab(QWidget):
         self.persist_list_config()
         self.list_name = new_list_name
         self.lists[new_list_name] = copy.deepcopy(DEFAULT_LIST_VALUES)
+        self.original_list_names[new_list_name] = None
         # Now update the lists combobox
         self.select_list_combo.populate_combo(self.lists, new_list_name)
         self.refresh_current_list_info()
@@ -954,6 +1007,7 @@ class ListsTab(QWidget):
         # As we are about to rename list, persist the current lists details if any
         self.persist_list_config()
         self.lists[new_list_name] = self.lists[old_list_name]
+        self.original_list_names[new_list_name] = self.original_list_names.pop(old_list_name)
         if self.default_list == old_list_name:
             self.default_list = new_list_name
         del self.lists[old_list_name]
@@ -976,6 +1030,7 @@ class ListsTab(QWidget):
         self.plugin_action.apply_tags_to_list(self.list_name, book_ids, add=False)
         self.plugin_action.update_series_custom_column(self.list_name, book_ids)
         del self.lists[self.list_name]
+        del self.original_list_names[self.list_name]
         if self.default_list == self.list_name:
             # Set new default first by manual vs auto, then by name
             # order instead of previous random.
@@ -985,6 +1040,21 @@ class ListsTab(QWidget):
         self.select_list_combo.populate_combo(self.lists)
         self.refresh_current_list_info()
 
+    def save_list_contents(self):
+        # Move the books of any renamed lists, and remove those of deleted lists.
+        # Read all the moved contents first, as lists may have swapped names.
+        db = self.gui.current_db
+        moved_contents = {}
+        for list_name, original_list_name in six.iteritems(self.original_list_names):
+            if list_name != original_list_name:
+                moved_contents[list_name] = get_book_list(db, original_list_name) if original_list_name else []
+        for list_name in self.stored_list_names - set(self.lists):
+            delete_book_list(db, list_name)
+        for list_name, book_ids in six.iteritems(moved_contents):
+            set_book_list(db, list_name, book_ids)
+        self.stored_list_names = set(self.lists)
+        self.original_list_names = dict((list_name, list_name) for list_name in self.lists)
+
 
 class DevicesTab(QWidget):
 
@@ -1286,6 +1356,7 @@ class ConfigWidget(QWidget):
         # We only need to update the store for the current list, as switching lists
         # will have updated the other lists
         self.lists_tab.persist_list_config()
+        self.lists_tab.save_list_contents()
 
         library_config = self.lists_tab.library_config
         library_config[KEY_LISTS] = self.lists_tab.lists